@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Headless benchmark of the edone user interface.
+
+The real gui code (EdoneWin, TasksList, Filters, TaskNote, the menus...)
+runs against the stand-in efl in bench/fake, on a synthetic todo file.
+Every user action is timed and the widget operations it performed are
+counted (genlist items appended/deleted/updated, list items, popups...).
+
+Usage:
+    python bench/edone_bench.py [-n 2000 20000] [--files 1] [--realize 30]
+                                [--storage txt|sqlite] [--json FILE]
+                                [--check]
+
+With --check the CHECKS are run instead of the timings: they assert the
+widget churn of the actions (ex: editing a task update only its item) and
+the exit status is 1 if any of them fail.
+
+The Harness class can also be used from a test, to assert widget churn:
+    h = Harness(1000)
+    res = h.measure('edit', h.task_edit)
+    assert res.lists['tasks'].get('Genlist.clear', 0) == 0
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(BENCH_PATH)
+
+# never touch the user config, cache and notes
+HOME = tempfile.mkdtemp(prefix='edone-bench-')
+os.environ['EDONE_BENCH_HOME'] = HOME
+for _var in 'XDG_CONFIG_HOME', 'XDG_CACHE_HOME', 'XDG_DATA_HOME':
+    os.environ[_var] = os.path.join(HOME, _var[4:-5].lower())
+
+sys.path.insert(0, ROOT_PATH)
+sys.path.insert(0, os.path.join(BENCH_PATH, 'fake'))
+try:
+    import xdg.BaseDirectory
+except ImportError:
+    sys.path.insert(0, os.path.join(BENCH_PATH, 'fallback'))
+
+from efl import elementary as elm
+from efl import ecore
+
+from edone import gui
+from edone.utils import options, Options
+from edone.tasks import Task
+
+
+NOTES_EVERY = 50  # one task every NOTES_EVERY has a note file
+
+
+def synthetic_todo(path, count, seed=0):
+    """ Write a todo.txt file with count random (but reproducible) tasks """
+    rnd = random.Random(seed)
+    today = date.today()
+    projects = max(count // 20, 1)
+    contexts = max(count // 100, 1)
+    notes_path = path + '.notes'
+    if not os.path.exists(notes_path):
+        os.makedirs(notes_path)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            words = []
+            if rnd.random() < 0.3:
+                day = today - timedelta(rnd.randint(0, 60))
+                words.append('x %s' % day.isoformat())
+            elif rnd.random() < 0.4:
+                words.append('(%s)' % rnd.choice('ABCDE'))
+            day = today - timedelta(rnd.randint(60, 400))
+            words.append(day.isoformat())
+            words.append('task number %d' % i)
+            words.append('+prj%d' % rnd.randrange(projects))
+            if rnd.random() < 0.2:
+                words.append('+prj%d' % rnd.randrange(projects))
+            words.append('@ctx%d' % rnd.randrange(contexts))
+            if rnd.random() < 0.2:
+                day = today + timedelta(rnd.randint(-10, 30))
+                words.append('due:%s' % day.isoformat())
+            if rnd.random() < 0.1:
+                day = today + timedelta(rnd.randint(-10, 30))
+                words.append('t:%s' % day.isoformat())
+            if rnd.random() < 0.2:
+                words.append('prog:%d' % rnd.randint(0, 100))
+            if i % NOTES_EVERY == 0:
+                fname = 'note%d.txt' % i
+                with open(os.path.join(notes_path, fname), 'w') as n:
+                    n.write('Note of task %d\n' % i)
+                words.append('note:%s' % fname)
+            f.write(' '.join(words) + '\n')
+
+
+class Result(object):
+    """ Timing and widget operations of a single action """
+
+    def __init__(self, name, secs, ops, lists=None):
+        self.name = name
+        self.secs = secs
+        self.ops = ops  # key: 'Class.operation'  val: count
+        self.lists = lists or {}  # key: list name  val: ops of that list
+
+    def __repr__(self):
+        return '<Result %s %.2fms %s>' % (self.name, self.secs * 1000,
+                                          self.ops_str())
+
+    def ops_str(self):
+        return ' '.join('%s=%d' % (k, self.ops[k]) for k in sorted(self.ops))
+
+    def as_dict(self):
+        return {'name': self.name, 'ms': round(self.secs * 1000, 3),
+                'ops': self.ops}
+
+
+class Harness(object):
+    """ An edone window on a synthetic todo file, driven by fake actions
+
+    Every action is a method of this class, measure() runs one of them and
+    returns a Result. The window is created (and the file loaded) in the
+    constructor, measured as 'startup'. The tasks are split in the given
+    number of files. Other keyword arguments are set in the options
+    (ex: group_by='prj').
+    """
+
+    def __init__(self, tasks_count=1000, seed=0, realize=30, files=1, **opts):
+        self.tasks_count = tasks_count
+        self.files = files
+        self.realize = realize  # items the genlist builds after each action
+        self.results = []
+        self.win = None
+
+        self.paths = []
+        for i in range(files):
+            path = os.path.join(HOME, 'todo-%d-%d.txt' % (tasks_count, i))
+            synthetic_todo(path, tasks_count // files, seed + i)
+            self.paths.append(path)
+
+        options.__dict__.update(Options().__dict__)
+        options.txt_file = self.paths[0]
+        options.other_files = self.paths[1:]
+        options.sqlite_file = os.path.join(HOME, 'edone-%d.db' % tasks_count)
+        for key, value in opts.items():
+            setattr(options, key, value)
+
+        self.measure('startup', self._startup)
+
+    def close(self):
+        """ Stop the workers and unregister the window indexes """
+        from edone.tasks import index_unregister
+        if self.win.column_store is not None:
+            index_unregister(self.win.column_store)
+        index_unregister(self.win.rollups)
+        for sv in self.win.saved_views:
+            index_unregister(sv)
+        self.win.notes.close()
+        self.win.storage.close()
+        if self.win.sync is not None:
+            self.win.sync.close()
+
+    def measure(self, name, func, *args, **kargs):
+        """ Run func, as a user action, and return its Result
+
+        Calls posted by other threads (ex: notes read by the worker) are
+        waited for (up to 'settle' seconds, not timed) and then run.
+        """
+        settle = kargs.pop('settle', 0)
+        elm.OPS.clear()
+        for widget in self.lists().values():
+            widget.ops.clear()
+        t0 = time.perf_counter()
+        func(*args, **kargs)
+        secs = time.perf_counter() - t0
+        if settle:
+            ecore.calls_wait(settle)
+        t0 = time.perf_counter()
+        ecore.loop_iterate()
+        if self.win is not None and self.realize:
+            self.win.tasks_list.realize(self.realize)
+        secs += time.perf_counter() - t0
+        res = Result(name, secs, dict(elm.OPS),
+                     dict((key, dict(widget.ops))
+                          for key, widget in self.lists().items()))
+        self.results.append(res)
+        return res
+
+    ### helpers ###
+    def lists(self):
+        """ The lists of the window, their ops are kept in the Result """
+        if self.win is None:
+            return {}
+        filters = self.win.filters
+        return {'tasks': self.win.tasks_list, 'projects': filters.projs_list,
+                'contexts': filters.cxts_list, 'files': filters.files_list}
+
+    def menu_click(self, *labels):
+        """ Open the main menu and click the item with the given labels """
+        self.options_menu._button_pressed_cb(self.options_menu)
+        elm.LAST['Menu'].item_find(*labels).click()
+
+    def task_items(self):
+        return [ it for it in self.win.tasks_list.all_items
+                 if isinstance(it.data, Task) ]
+
+    def first_task(self):
+        return self.task_items()[0].data
+
+    ### actions ###
+    def _startup(self):
+        self.win = gui.EdoneWin()
+        self.options_menu = gui.OptionsMenu(self.win)
+        self.win.reload()
+
+    def reload(self):
+        self.win.reload()
+
+    def rebuild(self):
+        self.win.tasks_list.rebuild()
+
+    def populate_lists(self):
+        self.win.filters.populate_lists()
+
+    def project_select(self, index=0, selected=True):
+        self.win.filters.projs_list.all_items[index].selected = selected
+
+    def project_unselect(self, index=0):
+        self.project_select(index, False)
+
+    def file_select(self, index=0, selected=True):
+        self.win.filters.files_list.items[index].selected = selected
+
+    def file_unselect(self, index=0):
+        self.file_select(index, False)
+
+    def status_set(self, view):
+        self.win.filters._seg_items['view', view].selected = True
+
+    def due_set(self, due_view):
+        self.win.filters._seg_items['due_view', due_view].selected = True
+
+    def search(self, text):
+        en = self.win.search_entry
+        en.text = text
+        en.emit('changed_user')
+
+    def group_expand(self):
+        gl = self.win.tasks_list
+        gl.emit('expand_request', gl.first_item)
+
+    def group_contract(self):
+        gl = self.win.tasks_list
+        gl.emit('contract_request', gl.first_item)
+
+    def task_select(self):
+        self.task_items()[0].selected = True
+
+    def task_add(self):
+        self.win.task_add()
+        popup = elm.LAST['Popup']
+        popup.part_content_get('default').delete()
+        popup.delete()
+
+    def task_edit(self):
+        task = self.first_task()
+        popup = elm.Popup(self.win)
+        entry = elm.Entry(popup, text=task.raw_txt + ' +benchprj @benchctx')
+        self.win.tasks_list._task_edit_end(task, entry, popup)
+
+    def task_done(self):
+        gui.TaskPropsMenu(self.win.tasks_list, self.first_task())
+        m = elm.LAST['Menu']
+        m.items[0].click()
+
+    def task_priority(self, prio='A'):
+        gui.TaskPropsMenu(self.win.tasks_list, self.first_task())
+        elm.LAST['Menu'].item_find('Priority', prio).click()
+
+    def task_delete(self):
+        gui.TaskPropsMenu(self.win.tasks_list, self.first_task())
+        elm.LAST['Menu'].item_find('Delete task').click()
+        elm.LAST['Popup'].part_content_get('button2').click()
+
+    def undo(self):
+        self.win.key_down('z', 'Control')
+
+    def redo(self):
+        self.win.key_down('y', 'Control')
+
+    def save(self):
+        self.win.save()
+
+    def stats_view(self):
+        gui.StatsWin(self.win).delete()
+
+    def run_all(self):
+        """ Measure a typical session, return the list of Result """
+        m = self.measure
+        m('reload', self.reload)
+        m('rebuild', self.rebuild)
+        m('populate_lists', self.populate_lists)
+        m('select project', self.project_select)
+        m('unselect project', self.project_unselect)
+        if self.files > 1:
+            m('select file', self.file_select, 1)
+            m('unselect file', self.file_unselect, 1)
+        m('view todo', self.status_set, 'todo')
+        m('view all', self.status_set, 'all')
+        m('due this week', self.due_set, 'week')
+        m('due any', self.due_set, 'all')
+        m('search', self.search, '+prj1 pri:A-C')
+        m('clear search', self.search, '')
+        m('group by projects', self.menu_click, 'Group by', 'Projects')
+        m('collapsible groups', self.menu_click,
+          'Group by', 'Collapsible groups')
+        m('expand group', self.group_expand)
+        m('contract group', self.group_contract)
+        m('flat groups', self.menu_click, 'Group by', 'Collapsible groups')
+        m('group by none', self.menu_click, 'Group by', 'None')
+        m('no sort', self.menu_click, 'Sort by', 'No sort')
+        m('sort by priority', self.menu_click, 'Sort by', 'Priority')
+        m('select task', self.task_select, settle=1.0)
+        m('new task popup', self.task_add)
+        m('edit task', self.task_edit)
+        m('task priority', self.task_priority, 'B')
+        m('mark done', self.task_done)
+        m('delete task', self.task_delete)
+        m('undo', self.undo)
+        m('redo', self.redo)
+        m('save', self.save)
+        m('stats view', self.stats_view)
+        m('stats view again', self.stats_view)
+        return self.results
+
+
+### checks ###
+
+REBUILD_OPS = ('Genlist.clear', 'Genlist.item_append',
+               'Genlist.item_insert_before', 'GenlistItem.delete',
+               'List.clear', 'List.item_append', 'List.item_insert_before',
+               'ListItem.delete')
+
+
+def _not_rebuilt(res, *lists):
+    for name in lists:
+        ops = res.lists[name]
+        for key in REBUILD_OPS:
+            assert not ops.get(key), \
+                '%s: %s list %s=%d' % (res.name, name, key, ops[key])
+
+
+def check_task_edit(h):
+    """ Changing the selected task update its item, nothing else """
+    h.measure('select task', h.task_select, settle=1.0)
+    for res in (h.measure('edit task', h.task_edit),
+                h.measure('task priority', h.task_priority, 'B'),
+                h.measure('mark done', h.task_done),
+                h.measure('undo', h.undo),
+                h.measure('redo', h.redo)):
+        ops = res.lists['tasks']
+        assert not ops.get('Genlist.clear'), '%s: tasks list cleared' % res.name
+        assert ops.get('GenlistItem.update') == 1, \
+            '%s: %d task items updated' % (res.name,
+                                           ops.get('GenlistItem.update', 0))
+        _not_rebuilt(res, 'tasks')
+        # the tags counts are updated in place (new tags are inserted)
+        for name in 'projects', 'contexts':
+            for key in 'Genlist.clear', 'GenlistItem.delete':
+                assert not res.lists[name].get(key), \
+                    '%s: %s list %s' % (res.name, name, key)
+
+
+def check_filters(h):
+    """ Toggling the filters does not rebuild the side lists """
+    for res in (h.measure('select project', h.project_select),
+                h.measure('unselect project', h.project_unselect),
+                h.measure('view todo', h.status_set, 'todo'),
+                h.measure('view all', h.status_set, 'all'),
+                h.measure('due this week', h.due_set, 'week'),
+                h.measure('due any', h.due_set, 'all'),
+                h.measure('search', h.search, '+prj1 pri:A-C'),
+                h.measure('clear search', h.search, '')):
+        _not_rebuilt(res, 'projects', 'contexts', 'files')
+
+
+def check_save(h):
+    """ Saving (with no changes by others) does not touch the widgets """
+    h.measure('edit task', h.task_edit)
+    res = h.measure('save', h.save)
+    assert not res.ops, 'save: %s' % res.ops_str()
+
+
+# every check run on a new Harness
+CHECKS = [check_task_edit, check_filters, check_save]
+
+
+def run_checks(tasks_count, **kargs):
+    """ Run all the CHECKS, return the list of failures messages """
+    failures = []
+    for check in CHECKS:
+        h = Harness(tasks_count, **kargs)
+        try:
+            check(h)
+        except AssertionError as e:
+            failures.append('%s: %s' % (check.__name__, e))
+        finally:
+            h.close()
+    return failures
+
+
+def report(harness):
+    print('\n%d tasks in %d files' % (harness.tasks_count, harness.files))
+    width = max(len(r.name) for r in harness.results)
+    for res in harness.results:
+        print('  %-*s %9.2f ms  %s' % (width, res.name, res.secs * 1000,
+                                       res.ops_str()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--tasks', type=int, nargs='+',
+                        default=[2000, 20000], help='synthetic tasks count')
+    parser.add_argument('--files', type=int, default=1,
+                        help='split the tasks in this number of files')
+    parser.add_argument('--realize', type=int, default=30,
+                        help='genlist items realized after each action')
+    parser.add_argument('--storage', choices=('txt', 'sqlite'), default='txt')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE')
+    parser.add_argument('--check', action='store_true',
+                        help='assert the widget churn instead of timing')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        failed = False
+        for count in args.tasks:
+            failures = run_checks(count, seed=args.seed, realize=args.realize,
+                                  files=args.files, storage=args.storage)
+            print('\n%d tasks: %d checks, %d failed' %
+                  (count, len(CHECKS), len(failures)))
+            for msg in failures:
+                print('  FAIL ' + msg)
+            failed = failed or bool(failures)
+        sys.exit(1 if failed else 0)
+
+    results = {}
+    for count in args.tasks:
+        h = Harness(count, seed=args.seed, realize=args.realize,
+                    files=args.files, storage=args.storage)
+        h.run_all()
+        h.close()
+        report(h)
+        results[count] = [ r.as_dict() for r in h.results ]
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+"""
+Stand-in for python-efl, used by the headless benchmark harness.
+
+Only the (small) part of the API used by edone is implemented, widgets do
+not draw anything: they keep their state in python attributes and count
+every operation in elementary.OPS (see bench/edone_bench.py).
+"""
+
+__version_info__ = (1, 18, 0)
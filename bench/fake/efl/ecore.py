@@ -0,0 +1,59 @@
+""" Stand-in for efl.ecore (see efl/__init__.py)
+
+There is no real main loop: timers are only collected (fire them with
+Timer.fire) and the calls posted from other threads are run by
+loop_iterate(), calls_wait() can be used to wait for them.
+"""
+
+import threading
+from collections import deque
+
+
+ECORE_CALLBACK_RENEW = True
+ECORE_CALLBACK_CANCEL = False
+
+TIMERS = []        # the active timers
+_calls = deque()   # calls posted with main_loop_thread_safe_call_async
+_calls_cond = threading.Condition()
+
+
+class Timer(object):
+    def __init__(self, interval, func, *args, **kargs):
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.kargs = kargs
+        TIMERS.append(self)
+
+    def delete(self):
+        if self in TIMERS:
+            TIMERS.remove(self)
+
+    def fire(self):
+        """ Run the timer callback now, as the main loop would """
+        if not self.func(*self.args, **self.kargs):
+            self.delete()
+
+
+def main_loop_thread_safe_call_async(func, *args, **kargs):
+    with _calls_cond:
+        _calls.append((func, args, kargs))
+        _calls_cond.notify_all()
+
+
+def calls_wait(timeout):
+    """ Wait up to timeout seconds for a call posted by another thread """
+    with _calls_cond:
+        if not _calls:
+            _calls_cond.wait(timeout)
+        return len(_calls)
+
+
+def loop_iterate():
+    """ Run the calls posted by other threads, return how many """
+    with _calls_cond:
+        calls = list(_calls)
+        _calls.clear()
+    for func, args, kargs in calls:
+        func(*args, **kargs)
+    return len(calls)
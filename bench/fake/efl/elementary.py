@@ -0,0 +1,543 @@
+""" Stand-in for efl.elementary (see efl/__init__.py)
+
+Every widget and item operation is counted in OPS, with keys like
+'Genlist.item_append', 'GenlistItem.delete' or 'Popup.new', the item ones
+are also counted in the ops of their widget (to tell apart the operations
+on different genlists of the same window). LAST keep the
+last created widget of each class, to reach popups and menus created by
+the application.
+
+Callbacks registered with callback_<event>_add() are triggered by
+emit('<event>', ...) (ex: emit('changed_user') for callback_changed_user_add)
+and as a side effect of the fake user actions: click(), item selection,
+expansion and key_down().
+"""
+
+import html
+from collections import Counter
+
+
+OPS = Counter()  # key: 'Class.operation'  val: count
+LAST = {}        # key: class name  val: the last created instance
+EXITED = [False]
+
+ELM_LIST_COMPRESS = 0
+ELM_GENLIST_ITEM_NONE = 0
+ELM_GENLIST_ITEM_TREE = 1
+ELM_GENLIST_ITEM_GROUP = 2
+ELM_OBJECT_SELECT_MODE_DEFAULT = 0
+ELM_OBJECT_SELECT_MODE_DISPLAY_ONLY = 3
+ELM_TEXT_FORMAT_PLAIN_UTF8 = 0
+ELM_ICON_NONE = 0
+ELM_ICON_FILE = 1
+ELM_ICON_STANDARD = 2
+
+
+def op(name, widget=None):
+    OPS[name] += 1
+    if widget is not None:
+        widget.ops[name] += 1
+
+
+def init():
+    EXITED[0] = False
+
+
+def run():
+    pass
+
+
+def shutdown():
+    pass
+
+
+def exit():
+    EXITED[0] = True
+
+
+def utf8_to_markup(text):
+    return html.escape(text, quote=False).replace('\n', '<br/>')
+
+
+def markup_to_utf8(text):
+    return html.unescape(text.replace('<br/>', '\n'))
+
+
+def _noop(*args, **kargs):
+    pass
+
+
+### widgets ###
+
+class Object(object):
+    """ Base of all the widgets """
+
+    def __init__(self, parent=None, *args, **kargs):
+        self.parent = parent
+        self._callbacks = {}  # key: event  val: list of (func, args, kargs)
+        self._event_cbs = []  # elm_event_callback_add functions
+        self._parts = {}      # part texts and contents
+        self.visible = False
+        self.deleted = False
+        self.ops = Counter()  # operations on this widget and its items
+        if 'text' not in self.__dict__:
+            self.text = ''
+        if 'disabled' not in self.__dict__:
+            self.disabled = False
+        for key, value in kargs.items():
+            setattr(self, key, value)
+        name = type(self).__name__
+        for cls in type(self).__mro__:
+            if cls.__module__ == __name__:
+                name = cls.__name__
+                break
+        self._fake_name = name
+        op(name + '.new')
+        LAST[name] = self
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name.startswith('callback_') and name.endswith('_add'):
+            event = name[9:-4]
+            def add(func, *args, **kargs):
+                self._callbacks.setdefault(event, []).append((func, args, kargs))
+            return add
+        if name.startswith('callback_') and name.endswith('_del'):
+            event = name[9:-4]
+            def remove(func, *args, **kargs):
+                cbs = self._callbacks.get(event, [])
+                cbs[:] = [ c for c in cbs if c[0] != func ]
+            return remove
+        return _noop
+
+    @property
+    def top_widget(self):
+        obj = self
+        while isinstance(obj.parent, Object):
+            obj = obj.parent
+        return obj
+
+    @property
+    def evas(self):
+        from efl.evas import CANVAS
+        return CANVAS
+
+    @property
+    def geometry(self):
+        return (0, 0, 100, 30)
+
+    def emit(self, event, *args):
+        """ Call the callbacks of the given event, as the widget would """
+        for func, cb_args, cb_kargs in list(self._callbacks.get(event, ())):
+            func(self, *(args + cb_args), **cb_kargs)
+
+    def click(self):
+        self.emit('clicked')
+
+    def show(self):
+        self.visible = True
+
+    def hide(self):
+        self.visible = False
+
+    def delete(self):
+        op(self._fake_name + '.delete')
+        self.deleted = True
+
+    def part_text_set(self, part, text):
+        self._parts[part] = text
+
+    def part_text_get(self, part):
+        return self._parts.get(part)
+
+    def part_content_set(self, part, obj):
+        self._parts[part] = obj
+
+    def part_content_get(self, part):
+        return self._parts.get(part)
+
+    content_set = part_content_set
+    content_get = part_content_get
+
+    def elm_event_callback_add(self, func, *args, **kargs):
+        self._event_cbs.append((func, args, kargs))
+
+    def key_down(self, keyname, *modifiers):
+        """ Feed a key press, return True if a callback handled it """
+        from efl.evas import EventKeyDown, EVAS_CALLBACK_KEY_DOWN
+        event = EventKeyDown(keyname, modifiers)
+        for func, args, kargs in self._event_cbs:
+            if func(self, self, EVAS_CALLBACK_KEY_DOWN, event, *args, **kargs):
+                return True
+        return False
+
+
+class StandardWindow(Object):
+    def __init__(self, name=None, title=None, *args, **kargs):
+        Object.__init__(self, None, **kargs)
+        self.name = name
+        self.title = title
+
+
+class Entry(Object):
+    def file_set(self, path, fmt=None):
+        op('Entry.file_set')
+
+
+for _name in ('Box', 'Frame', 'Button', 'Label', 'Panes', 'Icon', 'Popup',
+              'Table', 'Fileselector', 'Colorselector', 'Progressbar',
+              'InnerWindow', 'Separator', 'Check', 'Spinner'):
+    globals()[_name] = type(_name, (Object,), {})
+
+
+### items ###
+
+class ObjectItem(object):
+    """ Base of all the items """
+
+    def __init__(self, widget, text=None, data=None, callback=None,
+                 cb_args=()):
+        self.widget = widget
+        self.text = text
+        self.data = {} if data is None else data
+        self.callback = callback
+        self.cb_args = cb_args
+        self.disabled = False
+        self.deleted = False
+        self._selected = False
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _noop
+
+    @property
+    def selected(self):
+        return self._selected
+
+    @selected.setter
+    def selected(self, value):
+        if bool(value) != self._selected:
+            self.widget._item_selected_set(self, bool(value))
+
+    def click(self):
+        """ Call the item callback (menu and hoversel items) """
+        if self.callback is not None:
+            self.callback(self.widget, self, *self.cb_args)
+
+    def update(self):
+        op(self.widget._fake_name + 'Item.update', self.widget)
+
+    def delete(self):
+        if not self.deleted:
+            op(self.widget._fake_name + 'Item.delete', self.widget)
+            self.deleted = True
+            self.widget._item_deleted(self)
+
+
+class _ItemsWidget(Object):
+    """ Widget with a list of items and single/multi selection """
+
+    def __init__(self, parent=None, *args, **kargs):
+        self._items_list = []
+        self.multi_select = False
+        Object.__init__(self, parent, *args, **kargs)
+
+    @property
+    def items(self):
+        return list(self._items_list)
+
+    @property
+    def selected_items(self):
+        return [ it for it in self._items_list if it.selected ]
+
+    @property
+    def selected_item(self):
+        for it in self._items_list:
+            if it.selected:
+                return it
+
+    def clear(self):
+        op(self._fake_name + '.clear', self)
+        for it in self._items_list:
+            it.deleted = True
+        self._items_list = []
+
+    def _item_insert(self, item, before=None):
+        if before is None:
+            self._items_list.append(item)
+        else:
+            self._items_list.insert(self._items_list.index(before), item)
+        return item
+
+    def _item_deleted(self, item):
+        self._items_list.remove(item)
+
+    def _item_selected_set(self, item, value):
+        if value and not self.multi_select:
+            for it in self._items_list:
+                if it.selected and it is not item:
+                    it._selected = False
+                    self.emit('unselected', it)
+        item._selected = value
+        self.emit('selected' if value else 'unselected', item)
+
+
+class ListItem(ObjectItem):
+    def __init__(self, widget, label, icon=None, end=None, callback=None,
+                 cb_args=()):
+        ObjectItem.__init__(self, widget, label, None, callback, cb_args)
+        self.icon = icon
+        self.end = end
+
+
+class List(_ItemsWidget):
+    def item_append(self, label, icon=None, end=None, callback=None, *args):
+        op('List.item_append', self)
+        return self._item_insert(ListItem(self, label, icon, end, callback,
+                                          args))
+
+    def item_insert_before(self, before, label, icon=None, end=None,
+                           callback=None, *args):
+        op('List.item_insert_before', self)
+        return self._item_insert(ListItem(self, label, icon, end, callback,
+                                          args), before)
+
+    def go(self):
+        pass
+
+
+class SegmentControlItem(ObjectItem):
+    pass
+
+
+class SegmentControl(_ItemsWidget):
+    def item_add(self, icon=None, label=None):
+        op('SegmentControl.item_add', self)
+        return self._item_insert(SegmentControlItem(self, label))
+
+    def _item_selected_set(self, item, value):
+        # one segment is always selected, selecting emit 'changed'
+        if value:
+            for it in self._items_list:
+                it._selected = False
+            item._selected = True
+            self.emit('changed', item)
+
+
+class MenuItem(ObjectItem):
+    def __init__(self, widget, parent, label, icon, callback, cb_args):
+        ObjectItem.__init__(self, widget, label, None, callback, cb_args)
+        self.parent = parent
+        self.icon = icon
+
+    def click(self):
+        # the menu is dismissed when an item is clicked
+        self.widget.hide()
+        ObjectItem.click(self)
+
+
+class Menu(_ItemsWidget):
+    def item_add(self, parent=None, label=None, icon=None, callback=None,
+                 *args):
+        op('Menu.item_add', self)
+        return self._item_insert(MenuItem(self, parent, label, icon,
+                                          callback, args))
+
+    def item_separator_add(self, parent=None):
+        op('Menu.item_separator_add', self)
+
+    def item_find(self, *labels):
+        """ The item with the given labels path (ex: 'Group by', 'None') """
+        parent = None
+        for label in labels:
+            for it in self._items_list:
+                if it.parent is parent and it.text == label:
+                    parent = it
+                    break
+            else:
+                raise KeyError(' > '.join(labels))
+        return parent
+
+
+class HoverselItem(ObjectItem):
+    def __init__(self, widget, label, icon, icon_type, callback, cb_args):
+        ObjectItem.__init__(self, widget, label, None, callback, cb_args)
+        self.icon = icon
+        self.icon_type = icon_type
+
+
+class Hoversel(_ItemsWidget):
+    def item_add(self, label=None, icon_file=None, icon_type=ELM_ICON_NONE,
+                 callback=None, *args):
+        op('Hoversel.item_add', self)
+        return self._item_insert(HoverselItem(self, label, icon_file,
+                                              icon_type, callback, args))
+
+    def click(self):
+        # the application fill the hoversel on click
+        Object.click(self)
+
+
+### genlist ###
+
+class GenlistItemClass(object):
+    def __init__(self, item_style='default', text_get_func=None,
+                 content_get_func=None, state_get_func=None,
+                 del_func=None, **kargs):
+        self.item_style = item_style
+        self.text_get_func = text_get_func
+        self.content_get_func = content_get_func
+
+
+class GenlistItem(ObjectItem):
+    def __init__(self, widget, itc, data, parent, flags):
+        ObjectItem.__init__(self, widget, None, data)
+        self.item_class = itc
+        self.parent = parent
+        self.flags = flags
+        self.select_mode = ELM_OBJECT_SELECT_MODE_DEFAULT
+        self._children = {}  # sub items (dict used as an ordered set)
+        self._expanded = False
+        self._realized = False
+
+    def update(self):
+        ObjectItem.update(self)
+        self._realized = False
+
+    @property
+    def expanded(self):
+        return self._expanded
+
+    @expanded.setter
+    def expanded(self, value):
+        if bool(value) != self._expanded:
+            self._expanded = bool(value)
+            self.widget.emit('expanded' if value else 'contracted', self)
+
+    @property
+    def subitems_count(self):
+        return len(self._children)
+
+    def subitems_get(self):
+        return list(self._children)
+
+    def subitems_clear(self):
+        op('GenlistItem.subitems_clear', self.widget)
+        for it in list(self._children):
+            it.delete()
+
+
+class Genlist(Object):
+    def __init__(self, parent=None, *args, **kargs):
+        self._top = {}  # top level items (dict used as an ordered set)
+        self._count = 0
+        self._selected = None
+        self.multi_select = False
+        Object.__init__(self, parent, *args, **kargs)
+
+    def item_append(self, itc, data, parent=None, flags=ELM_GENLIST_ITEM_NONE,
+                    func=None, func_data=None):
+        op('Genlist.item_append', self)
+        it = GenlistItem(self, itc, data, parent, flags)
+        (self._top if parent is None else parent._children)[it] = None
+        self._count += 1
+        return it
+
+    def item_insert_before(self, itc, data, before, flags=ELM_GENLIST_ITEM_NONE,
+                           func=None, func_data=None):
+        op('Genlist.item_insert_before', self)
+        it = GenlistItem(self, itc, data, before.parent, flags)
+        siblings = self._top if before.parent is None \
+                   else before.parent._children
+        items = list(siblings)
+        items.insert(items.index(before), it)
+        siblings.clear()
+        siblings.update((i, None) for i in items)
+        self._count += 1
+        return it
+
+    def clear(self):
+        op('Genlist.clear', self)
+        for it in self._walk(self._top):
+            it.deleted = True
+        self._top = {}
+        self._count = 0
+        self._selected = None
+
+    def _item_deleted(self, item):
+        for child in list(item._children):
+            child.delete()
+        (self._top if item.parent is None else item.parent._children) \
+            .pop(item, None)
+        self._count -= 1
+        if self._selected is item:
+            self._selected = None
+
+    def _item_selected_set(self, item, value):
+        if value:
+            prev = self._selected
+            if prev is not None and prev is not item and not self.multi_select:
+                prev._selected = False
+                self.emit('unselected', prev)
+            self._selected = item
+        elif self._selected is item:
+            self._selected = None
+        item._selected = value
+        self.emit('selected' if value else 'unselected', item)
+
+    def _walk(self, items):
+        for it in items:
+            yield it
+            if it._children:
+                for sub in self._walk(it._children):
+                    yield sub
+
+    @property
+    def all_items(self):
+        """ All the items, in display order (not in the real genlist) """
+        return list(self._walk(self._top))
+
+    @property
+    def items_count(self):
+        return self._count
+
+    @property
+    def selected_item(self):
+        return self._selected
+
+    @property
+    def selected_items(self):
+        return [ it for it in self._walk(self._top) if it._selected ]
+
+    @property
+    def first_item(self):
+        return next(iter(self._top), None)
+
+    def realized_items_update(self):
+        op('Genlist.realized_items_update', self)
+        for it in self._walk(self._top):
+            it._realized = False
+
+    def realize(self, count=30):
+        """ Call the item class functions of the first count items
+
+        This is what the real genlist does for the visible items, after a
+        change, to build their texts and contents. Items are realized again
+        only after update() or realized_items_update().
+        """
+        for i, it in enumerate(self._walk(self._top)):
+            if i >= count:
+                break
+            if it._realized:
+                continue
+            it._realized = True
+            itc = it.item_class
+            if itc.text_get_func is not None:
+                op('Genlist.text_get', self)
+                itc.text_get_func(self, 'elm.text', it.data)
+            if itc.content_get_func is not None:
+                for part in ('elm.swallow.icon', 'elm.swallow.end'):
+                    op('Genlist.content_get', self)
+                    itc.content_get_func(self, part, it.data)
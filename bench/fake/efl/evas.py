@@ -0,0 +1,47 @@
+""" Stand-in for efl.evas (see efl/__init__.py) """
+
+EXPAND_BOTH = (1.0, 1.0)
+EXPAND_HORIZ = (1.0, 0.0)
+EXPAND_VERT = (0.0, 1.0)
+FILL_BOTH = (-1.0, -1.0)
+FILL_HORIZ = (-1.0, 0.5)
+FILL_VERT = (0.5, -1.0)
+
+EVAS_CALLBACK_KEY_DOWN = 10
+EVAS_EVENT_FLAG_NONE = 0
+EVAS_EVENT_FLAG_ON_HOLD = 1
+
+
+class Canvas(object):
+    def pointer_canvas_xy_get(self):
+        return (0, 0)
+
+CANVAS = Canvas()  # the canvas of all the widgets
+
+
+class Rectangle(object):
+    def __init__(self, evas=None, **kargs):
+        self.evas = evas
+        self.color = (0, 0, 0, 255)
+        for key, value in kargs.items():
+            setattr(self, key, value)
+
+    def on_mouse_down_add(self, func, *args):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *a, **k: None
+
+
+class EventKeyDown(object):
+    """ Fake key event, as received by elm_event_callback_add callbacks """
+
+    def __init__(self, keyname, modifiers=()):
+        self.keyname = keyname
+        self.modifiers = set(modifiers)
+        self.event_flags = EVAS_EVENT_FLAG_NONE
+
+    def modifier_is_set(self, name):
+        return name in self.modifiers
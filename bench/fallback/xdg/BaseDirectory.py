@@ -0,0 +1,11 @@
+""" Stand-in for xdg.BaseDirectory (see __init__.py) """
+
+import os
+import tempfile
+
+_home = os.environ.get('EDONE_BENCH_HOME') or \
+        os.path.join(tempfile.gettempdir(), 'edone-bench')
+
+xdg_config_home = os.path.join(_home, 'config')
+xdg_cache_home = os.path.join(_home, 'cache')
+xdg_data_home = os.path.join(_home, 'data')
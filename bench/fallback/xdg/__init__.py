@@ -0,0 +1,4 @@
+"""
+Minimal stand-in for pyxdg, only used by the benchmark harness when pyxdg
+is not installed. Directories point inside $EDONE_BENCH_HOME.
+"""
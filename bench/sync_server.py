@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local stand-in for a sync server (see edone/sync.py for the protocol).
+
+Lines are kept in memory (and optionally in a json file), every request
+and connection is counted, to check the batching and the connection reuse.
+
+Usage:
+    python bench/sync_server.py [--port 8765] [--data FILE]
+
+Then set http://localhost:8765/todo as the sync server in edone. From a
+script or a test:
+    server = start_server()  # on a free port, in a thread
+    url = server.url + '/todo'
+    ...
+    server.shutdown()
+"""
+
+import json
+import gzip
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Collection(object):
+    """ The lines of a file: key: id  val: [ver, rev, text or None] """
+
+    def __init__(self):
+        self.rev = 0
+        self.lines = {}
+
+    def changes(self, since):
+        return [ self._line(lid) for lid, (ver, rev, text)
+                 in self.lines.items() if rev > since ]
+
+    def apply(self, ops):
+        applied, conflicts = [], []
+        for op in ops:
+            lid = op['id']
+            cur = self.lines.get(lid)
+            ver = cur[0] if cur else 0
+            if op['base'] != ver:
+                conflicts.append(self._line(lid) if cur else
+                                 {'id': lid, 'ver': 0, 'deleted': True})
+                continue
+            self.rev += 1
+            text = None if op.get('deleted') else op['text']
+            self.lines[lid] = [ver + 1, self.rev, text]
+            applied.append({'id': lid, 'ver': ver + 1})
+        return applied, conflicts
+
+    def _line(self, lid):
+        ver, rev, text = self.lines[lid]
+        if text is None:
+            return {'id': lid, 'ver': ver, 'deleted': True}
+        return {'id': lid, 'ver': ver, 'text': text}
+
+
+class SyncServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, data_file=None):
+        ThreadingHTTPServer.__init__(self, address, Handler)
+        self.data_file = data_file
+        self.collections = {}  # key: name  val: Collection
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.ops = 0
+        if data_file:
+            self._load()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def collection(self, name):
+        if name not in self.collections:
+            self.collections[name] = Collection()
+        return self.collections[name]
+
+    def lines(self, name):
+        """ The text of the lines of a collection, in creation order """
+        return [ text for ver, rev, text in self.collection(name).lines.values()
+                 if text is not None ]
+
+    def save(self):
+        if self.data_file:
+            data = dict((name, {'rev': c.rev, 'lines': c.lines})
+                        for name, c in self.collections.items())
+            with open(self.data_file, 'w') as f:
+                json.dump(data, f)
+
+    def _load(self):
+        try:
+            with open(self.data_file) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        for name, d in data.items():
+            c = self.collection(name)
+            c.rev = d['rev']
+            c.lines = d['lines']
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep the connections alive
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _name(self):
+        parts = urlsplit(self.path)
+        path = unquote(parts.path).strip('/')
+        if not path.endswith('/lines'):
+            return None, parts
+        return path[:-len('/lines')], parts
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        name, parts = self._name()
+        if name is None:
+            return self._reply(404, {'error': 'not found'})
+        since = int(parse_qs(parts.query).get('since', ['0'])[0])
+        with self.server.lock:
+            self.server.requests += 1
+            c = self.server.collection(name)
+            data = {'rev': c.rev, 'lines': c.changes(since)}
+        self._reply(200, data)
+
+    def do_POST(self):
+        name, parts = self._name()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if name is None:
+            return self._reply(404, {'error': 'not found'})
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        ops = json.loads(body.decode('utf-8'))['ops']
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.ops += len(ops)
+            c = self.server.collection(name)
+            applied, conflicts = c.apply(ops)
+            data = {'rev': c.rev, 'applied': applied, 'conflicts': conflicts}
+            self.server.save()
+        self._reply(200, data)
+
+
+def start_server(port=0, data_file=None):
+    """ Start a server in a thread, on a free port by default """
+    server = SyncServer(('127.0.0.1', port), data_file)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--data', metavar='FILE',
+                        help='keep the lines in this json file')
+    args = parser.parse_args(argv)
+    server = SyncServer(('127.0.0.1', args.port), args.data)
+    print('Serving on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Optional columnar (numpy) copy of TASKS, used to filter and sort very big
+task lists with vectorized operations instead of a python loop.
+
+The store is an index (see tasks.INDEXES): every task own a row, that is
+kept in place when the task change. New rows are appended, so a task
+inserted in the middle of the file is out of file order: the rows are then
+sorted by task._slot when returned, until the next compaction puts them
+back in file order. Deleted rows are only marked dead and reclaimed when
+they are too many.
+"""
+
+# optional, install with: pip install edone[columnar]
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import datetime
+
+from edone.tasks import TagsFilter, tags_ids, due_range
+
+
+PRIORITY_NONE = 26  # priority code for tasks without priority (A=0 ... Z=25)
+
+
+def available():
+    return np is not None
+
+
+class ColumnStore(object):
+    """ Columnar, numpy backed, copy of the tasks properties """
+
+    def __init__(self, capacity=1024):
+        if np is None:
+            raise RuntimeError('numpy is required for the columnar store')
+        self.tasks = []  # task for each row (None for dead rows)
+        self.rows = {}   # key: task  val: row
+        self._dead = 0
+        self._ordered = True  # rows in file order
+        self._alloc(capacity, 1)
+
+    def _alloc(self, capacity, words):
+        """ (Re)allocate all the columns, keeping the current content """
+        old = getattr(self, 'alive', None)
+        n = len(self.tasks)
+
+        columns = (
+            ('alive', np.bool_, ()),
+            ('completed', np.bool_, ()),
+            ('priority', np.uint8, ()),
+            ('creation', np.int32, ()),    # date ordinal (0 = no date)
+            ('completion', np.int32, ()),  # date ordinal (0 = no date)
+            ('due', np.int32, ()),         # date ordinal (0 = no date)
+            ('threshold', np.int32, ()),   # date ordinal (0 = no date)
+            ('progress', np.int16, ()),    # -1 = no progress
+            ('tags', np.uint64, (words,)), # tags membership bitsets
+            ('raw', object, ()),
+        )
+        for name, dtype, shape in columns:
+            col = np.zeros((capacity,) + shape, dtype=dtype)
+            if old is not None:
+                prev = getattr(self, name)
+                if shape:
+                    col[:n, :prev.shape[1]] = prev[:n]
+                else:
+                    col[:n] = prev[:n]
+            setattr(self, name, col)
+
+    def clear(self):
+        self.tasks = []
+        self.rows = {}
+        self._dead = 0
+        self._ordered = True
+        self.alive[:] = False
+        self.tags[:] = 0
+        self.raw[:] = None
+
+    def add(self, task):
+        row = self.rows.get(task)
+        if row is None:
+            row = len(self.tasks)
+            if row == len(self.alive):
+                self._alloc(row * 2, self.tags.shape[1])
+            if self.tasks and task._slot < self.tasks[-1]._slot:
+                self._ordered = False
+            self.tasks.append(task)
+            self.rows[task] = row
+        else:
+            self._dead -= 1
+
+        self.alive[row] = True
+        self.completed[row] = task.completed
+        self.priority[row] = \
+            ord(task.priority) - 65 if task.priority else PRIORITY_NONE
+        self.creation[row] = \
+            task.creation_date.toordinal() if task.creation_date else 0
+        self.completion[row] = \
+            task.completion_date.toordinal() if task.completion_date else 0
+        self.due[row] = task.due.toordinal() if task.due else 0
+        self.threshold[row] = \
+            task.threshold.toordinal() if task.threshold else 0
+        self.progress[row] = -1 if task.progress is None else task.progress
+        self.raw[row] = task.raw_txt
+
+        self.tags[row] = 0
+        for i in tags_ids(task._tags):
+            if i >> 6 >= self.tags.shape[1]:
+                self._alloc(len(self.alive), (i >> 6) + 1)
+            self.tags[row, i >> 6] |= np.uint64(1 << (i & 63))
+
+    def remove(self, task):
+        # the row is kept, it will be reused if the task is added back
+        row = self.rows[task]
+        self.alive[row] = False
+        self._dead += 1
+
+    def compact(self):
+        """ Drop all the dead rows, the alive ones are put in file order """
+        n = len(self.tasks)
+        keep = self._file_order(np.flatnonzero(self.alive[:n]))
+        for name in ('alive', 'completed', 'priority', 'creation',
+                     'completion', 'due', 'threshold', 'progress',
+                     'tags', 'raw'):
+            col = getattr(self, name)
+            col[:len(keep)] = col[keep]
+            col[len(keep):n] = None if col.dtype == object else 0
+        self.tasks = [ self.tasks[row] for row in keep ]
+        self.rows = { t: row for row, t in enumerate(self.tasks) }
+        self._dead = 0
+        self._ordered = True
+
+    def _file_order(self, rows):
+        if self._ordered:
+            return rows
+        tasks = self.tasks
+        slots = np.fromiter((tasks[row]._slot for row in rows),
+                            dtype=np.int64, count=len(rows))
+        return rows[np.argsort(slots, kind='stable')]
+
+    def tags_mask(self, names):
+        """ Rows having at least one of the given tags (or subtags) """
+        n = len(self.tasks)
+        query = np.zeros(self.tags.shape[1], dtype=np.uint64)
+        for i in TagsFilter(names).ids:
+            if i >> 6 < self.tags.shape[1]:
+                query[i >> 6] |= np.uint64(1 << (i & 63))
+        return (self.tags[:n] & query).any(axis=1)
+
+    def masks(self, view='all', projects=None, contexts=None, search=None,
+              due_view='all', hide_future=False):
+        """ Filter masks (bool arrays) as used by TasksList
+
+        Return a tuple with 3 masks: view and search, contexts and projects
+        """
+        if self._dead > len(self.tasks) // 2:
+            self.compact()
+        n = len(self.tasks)
+
+        m0 = self.alive[:n].copy()
+        if view == 'done':
+            m0 &= self.completed[:n]
+        elif view == 'todo':
+            m0 &= ~self.completed[:n]
+
+        today = datetime.date.today()
+        if due_view != 'all':
+            due = self.due[:n]
+            start, end = due_range(due_view, today)
+            m0 &= due != 0
+            if start is not None:
+                m0 &= due >= start.toordinal()
+            if end is not None:
+                m0 &= due < end.toordinal()
+            if due_view == 'overdue':
+                m0 &= ~self.completed[:n]
+
+        if hide_future:
+            m0 &= self.threshold[:n] <= today.toordinal()
+
+        if search:
+            search = search.lower()
+            rows = np.flatnonzero(m0)
+            hits = np.fromiter((search in raw.lower() for raw in self.raw[rows]),
+                               dtype=np.bool_, count=len(rows))
+            m0[rows[~hits]] = False
+
+        m1 = self.tags_mask(contexts) if contexts else np.ones(n, np.bool_)
+        m2 = self.tags_mask(projects) if projects else np.ones(n, np.bool_)
+
+        return m0, m1, m2
+
+    def query(self, view='all', projects=None, contexts=None, search=None,
+              due_view='all', hide_future=False, sort_by='none'):
+        """ Ordered array of the visible rows """
+        m0, m1, m2 = self.masks(view, projects, contexts, search,
+                                due_view, hide_future)
+        return self.sort(np.flatnonzero(m0 & m1 & m2), sort_by)
+
+    def sort(self, rows, sort_by='none'):
+        rows = self._file_order(rows)
+        if sort_by == 'pri':
+            # same order as sorting by raw_txt, as the plain TasksList do
+            rows = rows[np.argsort(self.raw[rows], kind='stable')]
+        return rows
+
+    def tasks_get(self, rows):
+        tasks = self.tasks
+        return [ tasks[row] for row in rows ]
+
+    def tasks_mask(self, tasks):
+        """ Mask of the rows of the given tasks """
+        mask = np.zeros(len(self.tasks), dtype=np.bool_)
+        rows = [ self.rows[t] for t in tasks ]
+        if rows:
+            mask[rows] = True
+        return mask
+
+    def tasks_where(self, mask, sort_by='none'):
+        """ Tasks of the rows selected by the given mask """
+        return self.tasks_get(self.sort(np.flatnonzero(mask), sort_by))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Import and export of tasks in other formats: JSON Lines, CSV and todo.txt.
+
+Exporters are generators of text chunks and importers are generators of
+Task, both work on one task at a time so any amount of tasks can be
+streamed in constant memory. Exported records contain the parsed fields of
+the task (see FIELDS) and the raw line, importers use the raw line if
+present and build the line from the fields otherwise.
+"""
+
+import io
+import os
+import sys
+import csv
+import json
+
+from edone.tasks import Task
+
+
+FIELDS = ('completed', 'priority', 'completion_date', 'creation_date', 'text',
+          'projects', 'contexts', 'due', 't', 'progress', 'note', 'keys', 'raw')
+
+KNOWN_KEYS = ('due', 't', 'prog', 'note')  # keys with their own field
+
+
+def _date_str(date):
+    return date.strftime('%Y-%m-%d') if date else None
+
+
+def task_to_dict(task):
+    """ The fields of the task (dates as YYYY-MM-DD strings) """
+    keys = task.keys
+    return {
+        'completed': task.completed,
+        'priority': task.priority,
+        'completion_date': _date_str(task.completion_date),
+        'creation_date': _date_str(task.creation_date),
+        'text': task.text,
+        'projects': task.projects,
+        'contexts': task.contexts,
+        'due': keys.get('due'),
+        't': keys.get('t'),
+        'progress': task.progress,
+        'note': keys.get('note'),
+        'keys': { k: v for k, v in keys.items() if k not in KNOWN_KEYS },
+        'raw': task.raw_txt,
+    }
+
+
+def _words(value):
+    # lists can be real lists (json) or space separated strings (csv)
+    if not value:
+        return []
+    if isinstance(value, str):
+        return value.split()
+    return list(value)
+
+
+def _keys(value):
+    # keys can be a dict (json) or space separated key:value (csv)
+    if not value:
+        return {}
+    if isinstance(value, str):
+        return dict(w.split(':', 1) for w in value.split() if ':' in w)
+    return dict(value)
+
+
+def _true(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'x')
+    return bool(value)
+
+
+def task_from_dict(d):
+    """ Create a Task from the given fields (see FIELDS) """
+    if d.get('raw'):
+        return Task(d['raw'].strip())
+
+    parts = []
+    completed = _true(d.get('completed'))
+    if completed:
+        parts.append('x')
+    if d.get('priority'):
+        parts.append('(%s)' % d['priority'])
+    if completed and d.get('completion_date') and d.get('creation_date'):
+        parts.append(d['completion_date'])
+    if d.get('creation_date'):
+        parts.append(d['creation_date'])
+
+    text = d.get('text') or ''
+    words = text.split()
+    parts.append(text)
+    for tag in _words(d.get('projects')) + _words(d.get('contexts')):
+        if tag not in words:
+            parts.append(tag)
+
+    keys = [ ('due', d.get('due')), ('t', d.get('t')),
+             ('prog', d.get('progress')), ('note', d.get('note')) ]
+    keys += _keys(d.get('keys')).items()
+    for key, value in keys:
+        if value not in (None, ''):
+            parts.append('%s:%s' % (key, value))
+
+    return Task(' '.join(p for p in parts if p))
+
+
+### exporters (tasks -> text chunks) ###
+
+def jsonl_export(tasks):
+    for t in tasks:
+        yield json.dumps(task_to_dict(t), ensure_ascii=False) + '\n'
+
+
+def csv_export(tasks):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(FIELDS)
+    for t in tasks:
+        d = task_to_dict(t)
+        d['projects'] = ' '.join(d['projects'])
+        d['contexts'] = ' '.join(d['contexts'])
+        d['keys'] = ' '.join('%s:%s' % kv for kv in d['keys'].items())
+        writer.writerow([ '' if d[f] is None else d[f] for f in FIELDS ])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def txt_export(tasks):
+    for t in tasks:
+        yield t.raw_txt + '\n'
+
+
+### importers (lines -> tasks) ###
+
+def jsonl_import(lines):
+    for num, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                d = json.loads(line)
+            except ValueError as e:
+                raise ValueError('line %d: %s' % (num, e))
+            if not isinstance(d, dict):
+                raise ValueError('line %d: not a JSON object' % num)
+            yield task_from_dict(d)
+
+
+def csv_import(lines):
+    for row in csv.DictReader(lines, strict=True):
+        yield task_from_dict(row)
+
+
+def txt_import(lines):
+    for line in lines:
+        if line.strip():
+            yield Task(line.strip())
+
+
+# key: format name  val: (exporter, importer)
+FORMATS = {
+    'jsonl': (jsonl_export, jsonl_import),
+    'csv': (csv_export, csv_import),
+    'txt': (txt_export, txt_import),
+}
+
+
+def format_guess(path):
+    """ The format name from the file extension ('txt' if unknown) """
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    if ext in ('json', 'jsonl', 'ndjson'):
+        return 'jsonl'
+    return ext if ext in FORMATS else 'txt'
+
+
+def export_to_file(tasks, path, fmt=None):
+    """ Write the tasks (any iterable) to path ('-' for stdout) """
+    exporter = FORMATS[fmt or format_guess(path)][0]
+    if path == '-':
+        sys.stdout.writelines(exporter(tasks))
+        return
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.writelines(exporter(tasks))
+
+
+def import_from_file(path, fmt=None):
+    """ Iterate the tasks read from path ('-' for stdin) """
+    importer = FORMATS[fmt or format_guess(path)][1]
+    if path == '-':
+        for t in importer(sys.stdin):
+            yield t
+        return
+    with open(path, encoding='utf-8', errors='replace', newline='') as f:
+        for t in importer(f):
+            yield t
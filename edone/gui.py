@@ -19,20 +19,41 @@
 # along with Edone.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import csv
+import datetime
+from bisect import bisect
 from operator import attrgetter
-from itertools import chain
 
 from efl import elementary as elm
+from efl import ecore
 from efl.evas import Rectangle, EXPAND_BOTH, EXPAND_HORIZ, EXPAND_VERT, \
-                     FILL_BOTH, FILL_HORIZ, FILL_VERT
-
-from edone.utils import options, theme_resource_get, tag_color_get
-from edone.tasks import Task, TASKS, load_from_file, save_to_file, need_save
+                     FILL_BOTH, FILL_HORIZ, FILL_VERT, \
+                     EVAS_CALLBACK_KEY_DOWN, EVAS_EVENT_FLAG_ON_HOLD
+
+from edone.utils import options, theme_resource_get, tag_color_get, \
+                        cache_path
+from edone.tasks import Task, TASKS, TAG_TREE, FILES, TagsFilter, task_add, \
+                        tag_parents, \
+                        index_register, TextStorage, \
+                        need_save, files, file_need_save, merges_pop, \
+                        group_tasks, group_keys, DATE_BUCKETS, \
+                        due_range, due_tasks, not_started_tasks, dates_next_change, \
+                        HISTORY, history_undo, history_redo, tasks_add
+from edone.columns import ColumnStore
+from edone import columns
+from edone import query
+from edone.views import SavedView, current_settings
+from edone.formats import export_to_file, import_from_file
+from edone.notes import NoteStore
+from edone.sync import Sync
+from edone.stats import Rollups, archive_path, report
 from edone import __version__ as VERSION
 
 
 
 DONE_FONT = 'color=#AAA strikethrough=on strikethrough_color=#222'
+EXTRA_FONT = 'color=#888'
+OVERDUE_FONT = 'color=#C00 font_weight=bold'
 INFO = """
 <subtitle>Info</subtitle><br>
 <hilight>Edone</hilight> is fully compliant with the <hilight>Todo.txt</hilight> specifications.<br>
@@ -44,7 +65,8 @@ This basically means that your todo items are stored in a <b>simple and readable
 3. Select one ore more +Project or @Context in the side lists to filter the tasks.<br>
 4. <b>Double-click</b> a task to edit.<br>
 5. <b>Right-click</b> (or longpress) a task to change it's properties.<br>
-6. Put your Todo.txt file in your <hilight>Dropbox</hilight> folder to keep your tasks in sync with other device/apps.<br>
+6. <b>Ctrl+Z</b> and <b>Ctrl+Y</b> undo and redo the changes to the tasks.<br>
+7. Put your Todo.txt file in your <hilight>Dropbox</hilight> folder to keep your tasks in sync with other device/apps.<br>
 
 <br><subtitle>License</subtitle><br>
 This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.<br><br>
@@ -69,10 +91,43 @@ class EdoneWin(elm.StandardWindow):
         self.task_note = None
         self.search_entry = None
         self.main_panes = None
+        self.column_store = None
+        self.rollups = None
+        self.storage = None
+        self.sync = None
+        self._refresh_timer = None
+        self._refresh_rebuild = False  # the next refresh rebuilds the list
+        self._sync_timer = None
+        self._loads = 0  # number of reloads, sync results are for one load
+
+        # notes are read and written in a worker thread
+        self.notes = NoteStore(post=ecore.main_loop_thread_safe_call_async)
+
+        # saved views (with their materialized results)
+        self.saved_views = [ SavedView(st) for st in options.saved_views ]
+        self.active_view = None
+
+        HISTORY.budget = options.undo_budget
+
+        # where the tasks are loaded from and saved to
+        self.storage = self._storage_create()
+
+        # line level sync with a server (optional), in a worker thread
+        self.sync_url_set(options.sync_url)
+
+        # tasks created and completed per day, cached between runs
+        self.rollups = Rollups(os.path.join(cache_path, 'rollups'))
+        index_register(self.rollups)
+
+        # vectorized filtering and sorting (optional, needs numpy)
+        if options.columnar_store and columns.available():
+            self.column_store = ColumnStore()
+            index_register(self.column_store)
 
         # the window
         elm.StandardWindow.__init__(self, 'edone', 'Edone')
         self.callback_delete_request_add(lambda o: self.safe_quit())
+        self.elm_event_callback_add(self._key_down_cb)
         # self.focus_highlight_enabled = True
 
         # main vertical box
@@ -110,7 +165,7 @@ class EdoneWin(elm.StandardWindow):
         # search entry
         en = elm.Entry(hbox1, single_line=True, scrollable=True,
                        size_hint_weight=EXPAND_HORIZ, size_hint_align=FILL_HORIZ)
-        en.part_text_set('guide', 'search')
+        en.part_text_set('guide', 'search (ex: +work pri:A-B -done "invoice")')
         en.callback_changed_user_add(self._search_changed_user_cb)
         en.content_set('icon', SafeIcon(en, 'edit-find', size_hint_min=(16,16)))
         hbox1.pack_end(en)
@@ -154,15 +209,124 @@ class EdoneWin(elm.StandardWindow):
         self.show()
 
     def reload(self):
-        load_from_file(options.txt_file)
+        paths = [options.txt_file]
+        for path in options.other_files:
+            if path in paths:
+                continue
+            if os.path.exists(path):
+                paths.append(path)
+            else:
+                print('WARNING: Todo.txt file not found: "%s"' % path)
+        self._loads += 1
+        self.storage.load(paths, options.encoding_errors)
+        self.rollups.loaded(paths)
         self.filters.populate_lists()
         self.tasks_list.rebuild()
 
+    def sync_url_set(self, url):
+        """ Use another sync server (empty url to disable the sync) """
+        options.sync_url = url
+        if self.sync is not None:
+            self.sync.close()
+            self.sync = None
+        if self._sync_timer is not None:
+            self._sync_timer.delete()
+            self._sync_timer = None
+        if url:
+            self.sync = Sync(url, post=ecore.main_loop_thread_safe_call_async)
+            if options.sync_interval:
+                self._sync_timer = ecore.Timer(options.sync_interval * 60,
+                                               self._sync_timer_cb)
+
+    def sync_start(self):
+        """ Send and receive the changed lines of all the files """
+        if self.sync is None:
+            return
+        by_file = dict((path, []) for path in files())
+        for t in TASKS:
+            by_file[t._file].append(t)
+        self.sync.start(list(by_file.items()), self._sync_done, self._loads)
+
+    def _sync_timer_cb(self):
+        self.sync_start()
+        return ecore.ECORE_CALLBACK_RENEW
+
+    def _sync_done(self, results, error, loads):
+        if error is not None:
+            print('ERROR: Sync failed: %s' % error)
+            return
+        if loads != self._loads:
+            # the files were reloaded meanwhile, sync again later
+            return
+        changed = False
+        for fs in results:
+            changed = fs.apply() or changed
+        if changed:
+            self.filters.populate_lists()
+            self.tasks_list.rebuild()
+        # the sync state is valid only for the saved files
+        if need_save():
+            self.save()
+        for fs in results:
+            fs.state.save()
+
+    def _storage_create(self):
+        if options.storage == 'sqlite':
+            from edone.sqlstore import SqliteStorage
+            return SqliteStorage(options.sqlite_file)
+        return TextStorage()
+
+    def storage_set(self, name):
+        """ Switch to another storage ('txt' or 'sqlite') saving the changes """
+        if name == options.storage:
+            return
+        if need_save():
+            self.save()
+        self.storage.close()
+        options.storage = name
+        self.storage = self._storage_create()
+        self.reload()
+
     def save(self, and_quit=False):
-        save_to_file(options.txt_file)
+        self.notes.flush()
+        self.storage.save()
+        self.rollups.saved([ p for p in files() if not file_need_save(p) ])
+        merges = merges_pop()
+        if merges:
+            # the files were changed by others, their changes are merged
+            self.filters.populate_lists()
+            self.tasks_list.rebuild()
+            conflicts = [ c for path, cs in merges for c in cs ]
+            if conflicts:
+                self._conflicts_popup(conflicts)
+                and_quit = False
+        self.filters.files_update()
         if and_quit is True:
             elm.exit()
 
+    def _conflicts_popup(self, conflicts):
+        lines = []
+        for local, disk in conflicts:
+            lines += [ 'edone:  ' + l for l in local ]
+            lines += [ 'others: ' + l for l in disk ]
+            lines.append('')
+        pp = elm.Popup(self, text='<code>%s</code>' %
+                       elm.utf8_to_markup('\n'.join(lines)))
+        pp.part_text_set('title,text', 'Lines changed also by others, '
+                                       'both versions were kept')
+        btn = elm.Button(pp, text='Close')
+        btn.callback_clicked_add(lambda b: pp.delete())
+        pp.part_content_set('button1', btn)
+        pp.show()
+
+    def error_popup(self, title, text):
+        pp = elm.Popup(self, text=elm.utf8_to_markup(text))
+        pp.part_text_set('title,text', title)
+        btn = elm.Button(pp, text='Close')
+        btn.callback_clicked_add(lambda b: pp.delete())
+        pp.part_content_set('button1', btn)
+        pp.show()
+
     def safe_quit(self):
         if need_save() is False:
             elm.exit()
@@ -184,14 +348,107 @@ class EdoneWin(elm.StandardWindow):
 
             pp.show()
 
+    def refresh_schedule(self):
+        """ Schedule a refresh for the next midnight
+
+        Only one timer is used. The items are always updated (the overdue
+        dates are shown in red), the list is rebuilt only if a due/threshold
+        date (or the creation date buckets) cross the new day.
+        """
+        if self._refresh_timer is not None:
+            self._refresh_timer.delete()
+            self._refresh_timer = None
+
+        today = datetime.date.today()
+        date = today + datetime.timedelta(days=1)
+        if options.group_by == 'date':
+            self._refresh_rebuild = True
+        elif options.due_view != 'all' or options.hide_future:
+            self._refresh_rebuild = dates_next_change(today) == date
+        else:
+            self._refresh_rebuild = False
+
+        midnight = datetime.datetime.combine(date, datetime.time())
+        secs = (midnight - datetime.datetime.now()).total_seconds()
+        self._refresh_timer = ecore.Timer(max(secs, 1.0), self._refresh_cb)
+
+    def _key_down_cb(self, obj, src, event_type, event):
+        if event_type != EVAS_CALLBACK_KEY_DOWN or \
+           event.event_flags & EVAS_EVENT_FLAG_ON_HOLD or \
+           not event.modifier_is_set('Control'):
+            return False
+        if event.keyname == 'z':
+            self.undo()
+        elif event.keyname == 'y':
+            self.redo()
+        else:
+            return False
+        event.event_flags |= EVAS_EVENT_FLAG_ON_HOLD
+        return True
+
+    def undo(self):
+        self.tasks_list.history_applied(history_undo())
+
+    def redo(self):
+        self.tasks_list.history_applied(history_redo())
+
+    def _refresh_cb(self):
+        self._refresh_timer = None
+        if self._refresh_rebuild:
+            self.tasks_list.rebuild()
+        else:
+            self.tasks_list.realized_items_update()
+            self.refresh_schedule()
+        return ecore.ECORE_CALLBACK_CANCEL
+
     def task_add(self):
         t = Task('A new task')
-        TASKS.append(t)
+        task_add(t)
         self.tasks_list.item_add(t, start_editing=True)
 
-    def _search_changed_user_cb(self, en):
+    def view_save(self, name):
+        """ Save the current filters as a new view """
+        filters = self.filters
+        st = current_settings(name, options.view, options.due_view,
+                              filters.project_filter, filters.context_filter,
+                              self.search_entry.text,
+                              options.sort_by, options.group_by)
+        options.saved_views.append(st)
+        self.active_view = SavedView(st)
+        self.saved_views.append(self.active_view)
+        self.filters.views_label_update()
+
+    def view_apply(self, sv):
+        """ Switch to a saved view, using its materialized results """
+        st = sv.settings
+        options.view = st['view']
+        options.due_view = st['due_view']
+        options.sort_by = st['sort_by']
+        options.group_by = st['group_by']
+        self.search_entry.text = st['query']
+        self.filters.state_set(st['projects'], st['contexts'])
+        self.active_view = sv
+        self.filters.views_label_update()
         self.tasks_list.rebuild()
 
+    def view_delete(self, sv):
+        sv.delete()
+        self.saved_views.remove(sv)
+        options.saved_views.remove(sv.settings)
+        if self.active_view is sv:
+            self.active_view = None
+        self.filters.views_label_update()
+
+    def filters_changed(self):
+        """ The user changed a filter, the active saved view (if any) is over """
+        if self.active_view is not None:
+            self.active_view = None
+            self.filters.views_label_update()
+        self.tasks_list.rebuild()
+
+    def _search_changed_user_cb(self, en):
+        self.filters_changed()
+
 
 class OptionsMenu(elm.Button):
     def __init__(self, parent):
@@ -220,16 +477,48 @@ class OptionsMenu(elm.Button):
         m.item_add(None, 'Reload', 'view-refresh',
                    lambda m,i: self.top_widget.reload())
 
+        if options.sync_url:
+            it = m.item_add(None, 'Sync now', None,
+                            lambda m,i: self.top_widget.sync_start())
+            it.disabled = self.top_widget.sync.busy
+
+        it = m.item_add(None, 'Undo', 'edit-undo',
+                        lambda m,i: self.top_widget.undo())
+        it.disabled = not HISTORY.can_undo()
+
+        it = m.item_add(None, 'Redo', 'edit-redo',
+                        lambda m,i: self.top_widget.redo())
+        it.disabled = not HISTORY.can_redo()
+
         m.item_add(None, 'Quit', 'window-close',
                    lambda m,i: self.top_widget.safe_quit())
 
         m.item_add(None, 'Info and help', 'help-about',
                    lambda m,i: InfoWin(self.top_widget))
 
+        m.item_add(None, 'Explain search query', 'edit-find',
+                   lambda m,i: self._explain_query())
+
+        m.item_add(None, 'Statistics', None,
+                   lambda m,i: StatsWin(self.top_widget))
+
         # Todo.txt file...
         m.item_separator_add()
         m.item_add(None, 'Choose Todo.txt file', None,
                    lambda m,i: self._file_change())
+        m.item_add(None, 'Add another Todo.txt file', None,
+                   lambda m,i: self._file_other_add())
+        if options.other_files:
+            it_close = m.item_add(None, 'Remove other file')
+            for path in options.other_files:
+                m.item_add(it_close, os.path.basename(path), None,
+                           lambda m,i,p=path: self._file_other_remove(p))
+        m.item_add(None, 'Sync server...', None,
+                   lambda m,i: self._sync_url_popup())
+        m.item_add(None, 'Import tasks (txt, jsonl or csv)', None,
+                   lambda m,i: self._file_import())
+        m.item_add(None, 'Export tasks (txt, jsonl or csv)', None,
+                   lambda m,i: self._file_export())
         m.item_separator_add()
         
         # group by >
@@ -243,6 +532,16 @@ class OptionsMenu(elm.Button):
         icon = 'arrow_right' if options.group_by == 'ctx' else None
         m.item_add(it_groupby, 'Contexts', icon,
                    lambda m,i: self._groupby_set('ctx'))
+        icon = 'arrow_right' if options.group_by == 'pri' else None
+        m.item_add(it_groupby, 'Priority', icon,
+                   lambda m,i: self._groupby_set('pri'))
+        icon = 'arrow_right' if options.group_by == 'date' else None
+        m.item_add(it_groupby, 'Creation date', icon,
+                   lambda m,i: self._groupby_set('date'))
+        m.item_separator_add(it_groupby)
+        icon = 'arrow_right' if options.tree_groups else None
+        m.item_add(it_groupby, 'Collapsible groups', icon,
+                   lambda m,i: self._tree_groups_toggle())
 
         # sort by >
         it_sortby = m.item_add(None, 'Sort by')
@@ -253,6 +552,20 @@ class OptionsMenu(elm.Button):
         m.item_add(it_sortby, 'Priority', icon,
                    lambda m,i: self._sortby_set('pri'))
 
+        # hide not yet started tasks (threshold date in the future)
+        icon = 'arrow_right' if options.hide_future else None
+        m.item_add(None, 'Hide not yet started', icon,
+                   lambda m,i: self._hide_future_toggle())
+
+        # storage >
+        it_storage = m.item_add(None, 'Storage')
+        icon = 'arrow_right' if options.storage == 'txt' else None
+        m.item_add(it_storage, 'Todo.txt files', icon,
+                   lambda m,i: self.top_widget.storage_set('txt'))
+        icon = 'arrow_right' if options.storage == 'sqlite' else None
+        m.item_add(it_storage, 'SQLite database', icon,
+                   lambda m,i: self.top_widget.storage_set('sqlite'))
+
         # layout >
         it_layout = m.item_add(None, 'Layout')
         icon = 'arrow_right' if options.horiz_layout is False else None
@@ -267,6 +580,46 @@ class OptionsMenu(elm.Button):
         m.move(x, y + h)
         m.show()
 
+    def _explain_query(self):
+        q = self.top_widget.tasks_list.search_query()
+        text = q.explain() if q else 'No search query'
+        pp = elm.Popup(self.top_widget,
+                       text='<code>%s</code>' % elm.utf8_to_markup(text))
+        pp.part_text_set('title,text', 'Search query plan')
+        pp.callback_block_clicked_add(lambda p: pp.delete())
+        btn = elm.Button(pp, text='Close')
+        btn.callback_clicked_add(lambda b: pp.delete())
+        pp.part_content_set('button1', btn)
+        pp.show()
+
+    def _sync_url_popup(self):
+        pp = elm.Popup(self.top_widget)
+        pp.part_text_set('title,text', 'Sync server url (empty to disable)')
+
+        en = elm.Entry(pp, editable=True, single_line=True, scrollable=True,
+                       text=options.sync_url)
+        en.part_text_set('guide', 'http://server/path')
+        en.callback_activated_add(lambda e: self._sync_url_done(en, pp))
+        en.callback_aborted_add(lambda e: pp.delete())
+        pp.part_content_set('default', en)
+
+        b = elm.Button(pp, text='Cancel')
+        b.callback_clicked_add(lambda b: pp.delete())
+        pp.part_content_set('button1', b)
+
+        b = elm.Button(pp, text='Sync')
+        b.callback_clicked_add(lambda b: self._sync_url_done(en, pp))
+        pp.part_content_set('button2', b)
+
+        pp.show()
+        en.focus = True
+
+    def _sync_url_done(self, entry, popup):
+        popup.delete()
+        win = self.top_widget
+        win.sync_url_set(entry.text.strip())
+        win.sync_start()
+
     def _layout_set(self, horiz):
         options.horiz_layout = horiz
         self.top_widget.main_panes.horizontal = not horiz
@@ -275,11 +628,19 @@ class OptionsMenu(elm.Button):
         options.group_by = group
         self.top_widget.tasks_list.rebuild()
 
+    def _hide_future_toggle(self):
+        options.hide_future = not options.hide_future
+        self.top_widget.tasks_list.rebuild()
+
+    def _tree_groups_toggle(self):
+        options.tree_groups = not options.tree_groups
+        self.top_widget.tasks_list.rebuild()
+
     def _sortby_set(self, sort):
         options.sort_by = sort
         self.top_widget.tasks_list.rebuild()
 
-    def _file_change(self):
+    def _fileselector_popup(self, title, done_cb, is_save=False):
         # hack to make popup respect min_size
         rect = Rectangle(self.parent.evas, size_hint_min=(400,400))
         tb = elm.Table(self.parent)
@@ -287,15 +648,15 @@ class OptionsMenu(elm.Button):
 
         # show the fileselector inside a popup
         popup = elm.Popup(self.top_widget, content=tb)
-        popup.part_text_set('title,text', 'Choose the Todo.txt file to use')
+        popup.part_text_set('title,text', title)
         popup.show()
 
         # the fileselector widget
-        fs = elm.Fileselector(popup, is_save=False, expandable=False,
+        fs = elm.Fileselector(popup, is_save=is_save, expandable=False,
                               size_hint_weight=EXPAND_BOTH,
                               size_hint_align=FILL_BOTH)
-        fs.callback_activated_add(self._file_change_done, popup)
-        fs.callback_done_add(self._file_change_done, popup)
+        fs.callback_activated_add(done_cb, popup)
+        fs.callback_done_add(done_cb, popup)
         try:
             fs.selected = options.txt_file
         except:
@@ -303,38 +664,127 @@ class OptionsMenu(elm.Button):
         fs.show()
         tb.pack(fs, 0, 0, 1, 1)
 
+    def _file_change(self):
+        self._fileselector_popup('Choose the Todo.txt file to use',
+                                 self._file_change_done)
+
     def _file_change_done(self, fs, new_path, popup):
         if new_path is not None:
             options.txt_file = new_path
             self.top_widget.reload()
         popup.delete()
 
+    def _file_other_add(self):
+        self._fileselector_popup('Choose a Todo.txt file to add to the view',
+                                 self._file_other_add_done)
+
+    def _file_other_add_done(self, fs, path, popup):
+        popup.delete()
+        if path is not None and path != options.txt_file and \
+           path not in options.other_files:
+            if need_save():
+                self.top_widget.save()
+            options.other_files.append(path)
+            self.top_widget.reload()
+
+    def _file_other_remove(self, path):
+        if file_need_save(path):
+            self.top_widget.save()
+        options.other_files.remove(path)
+        self.top_widget.reload()
+
+    def _file_import(self):
+        self._fileselector_popup('Choose the file to import',
+                                 self._file_import_done)
+
+    def _file_import_done(self, fs, path, popup):
+        popup.delete()
+        if path is not None:
+            # the whole file is read before adding anything, so a malformed
+            # one does not leave a partial import behind
+            try:
+                tasks = list(import_from_file(path))
+            except (ValueError, csv.Error, OSError) as e:
+                self.top_widget.error_popup('Cannot import %s' %
+                                            os.path.basename(path), str(e))
+                return
+            # all the tasks are added in a single step, then one update
+            tasks_add(tasks)
+            self.top_widget.filters.update_lists()
+            self.top_widget.tasks_list.rebuild()
+
+    def _file_export(self):
+        self._fileselector_popup('Export the tasks to (.txt, .jsonl or .csv)',
+                                 self._file_export_done, is_save=True)
+
+    def _file_export_done(self, fs, path, popup):
+        popup.delete()
+        if path is not None:
+            # blank lines are not tasks
+            export_to_file((t for t in TASKS if t.raw_txt), path)
+
 
 class Filters(elm.Box):
     def __init__(self, parent):
         self._freezed = False  # used in populate to not trigger callbacks
+        self._file_items = {}  # key: file path  data: list_item
         elm.Box.__init__(self, parent,
                          size_hint_weight=EXPAND_VERT,
                          size_hint_align=FILL_VERT)
 
+        self._seg_items = {}   # key: view or due_view  data: segment item
+
+        # saved views
+        hs = elm.Hoversel(self, text='Saved views', focus_allow=False,
+                          size_hint_weight=EXPAND_HORIZ,
+                          size_hint_align=FILL_HORIZ)
+        hs.callback_clicked_add(self._views_populate)
+        self.pack_end(hs)
+        hs.show()
+        self.views_hoversel = hs
+
         # status (view: all, todo or done)
         seg = elm.SegmentControl(self, focus_allow=False)
         for name, val in ('All', 'all'), ('Todo', 'todo'), ('Done', 'done'):
             it = seg.item_add(None, name)
             it.data['view'] = val
             it.selected = True if options.view == val else False
+            self._seg_items['view', val] = it
         seg.callback_changed_add(self._status_changed_cb)
         self.pack_end(seg)
         seg.show()
 
+        # due dates (all, overdue, due today or due this week)
+        seg = elm.SegmentControl(self, focus_allow=False)
+        for name, val in ('Any', 'all'), ('Overdue', 'overdue'), \
+                         ('Today', 'today'), ('Week', 'week'):
+            it = seg.item_add(None, name)
+            it.data['due_view'] = val
+            it.selected = True if options.due_view == val else False
+            self._seg_items['due_view', val] = it
+        seg.callback_changed_add(self._due_changed_cb)
+        self.pack_end(seg)
+        seg.show()
+
+        # Files list
+        label = elm.Label(self, text="<b>Files</b>", scale=1.4)
+        self.pack_end(label)
+        label.show()
+
+        self.files_list = elm.List(self, multi_select=True, focus_allow=False,
+                                   size_hint_weight=EXPAND_HORIZ,
+                                   size_hint_align=FILL_BOTH)
+        self.files_list.callback_selected_add(self._list_selection_changed_cb)
+        self.files_list.callback_unselected_add(self._list_selection_changed_cb)
+        self.pack_end(self.files_list)
+        self.files_list.show()
+
         # @Projects list
         label = elm.Label(self, text="<b>Projects +</b>", scale=1.4)
         self.pack_end(label)
         label.show()
 
-        self.projs_list = elm.List(self, multi_select=True, focus_allow=False,
-                                   size_hint_weight=EXPAND_BOTH,
-                                   size_hint_align=FILL_BOTH)
+        self.projs_list = TagsList(self, '+')
         self.projs_list.callback_selected_add(self._list_selection_changed_cb)
         self.projs_list.callback_unselected_add(self._list_selection_changed_cb)
         self.pack_end(self.projs_list)
@@ -345,9 +795,7 @@ class Filters(elm.Box):
         self.pack_end(label)
         label.show()
 
-        self.cxts_list = elm.List(self, multi_select=True, focus_allow=False,
-                                  size_hint_weight=EXPAND_BOTH,
-                                  size_hint_align=FILL_BOTH)
+        self.cxts_list = TagsList(self, '@')
         self.cxts_list.callback_selected_add(self._list_selection_changed_cb)
         self.cxts_list.callback_unselected_add(self._list_selection_changed_cb)
         self.pack_end(self.cxts_list)
@@ -357,53 +805,280 @@ class Filters(elm.Box):
 
     @property
     def context_filter(self):
-        L = [ item.text for item in self.cxts_list.selected_items ]
+        L = [ item.data for item in self.cxts_list.selected_items ]
         return set(L) if L else None
 
     @property
     def project_filter(self):
-        L = [ item.text for item in self.projs_list.selected_items ]
+        L = [ item.data for item in self.projs_list.selected_items ]
         return set(L) if L else None
 
     @property
-    def all_contexts(self):
-        return [ item.text for item in self.cxts_list.items ]
-
-    @property
-    def all_projects(self):
-        return [ item.text for item in self.projs_list.items ]
+    def file_filter(self):
+        L = [ item.data['path'] for item in self.files_list.selected_items ]
+        return set(L) if L else None
 
     def _status_changed_cb(self, seg, item):
-        options.view = item.data['view']
-        self.top_widget.tasks_list.rebuild()
+        if not self._freezed:
+            options.view = item.data['view']
+            self.top_widget.filters_changed()
+
+    def _due_changed_cb(self, seg, item):
+        if not self._freezed:
+            options.due_view = item.data['due_view']
+            self.top_widget.filters_changed()
 
     def _list_selection_changed_cb(self, li, it):
         if not self._freezed:
-            self.top_widget.tasks_list.rebuild()
+            self.top_widget.filters_changed()
 
-    def populate_lists(self):
-        tags = {} # key: tag_name  val: num_tasks
-        selected = [ it.text for it in chain(self.cxts_list.selected_items,
-                                             self.projs_list.selected_items) ]
+    def state_set(self, projects, contexts):
+        """ Show the current options and select the given tags """
+        self._freezed = True
+        self._seg_items['view', options.view].selected = True
+        self._seg_items['due_view', options.due_view].selected = True
+        self.projs_list.select(projects)
+        self.cxts_list.select(contexts)
+        for it in self._file_items.values():
+            it.selected = False
+        self._freezed = False
+
+    def views_label_update(self):
+        view = self.top_widget.active_view
+        self.views_hoversel.text = view.name if view else 'Saved views'
+
+    def _views_populate(self, hs):
+        win = self.top_widget
+        hs.clear()
+        for sv in win.saved_views:
+            hs.item_add(sv.name, None, elm.ELM_ICON_NONE,
+                        lambda h, i, sv: win.view_apply(sv), sv)
+        hs.item_add('Save current view...', 'document-save',
+                    elm.ELM_ICON_STANDARD, lambda h, i: self._view_save_popup())
+        if win.active_view is not None:
+            hs.item_add('Delete "%s"' % win.active_view.name, 'edit-delete',
+                        elm.ELM_ICON_STANDARD,
+                        lambda h, i: win.view_delete(win.active_view))
+
+    def _view_save_popup(self):
+        pp = elm.Popup(self.top_widget)
+        pp.part_text_set('title,text', 'Name for the saved view')
+
+        en = elm.Entry(pp, editable=True, single_line=True, scrollable=True)
+        en.callback_activated_add(lambda e: self._view_save_done(en, pp))
+        en.callback_aborted_add(lambda e: pp.delete())
+        pp.part_content_set('default', en)
 
-        for task in TASKS:
-            for name in chain(task.projects, task.contexts):
-                tags[name] = tags[name] + 1 if name in tags else 1
+        b = elm.Button(pp, text='Cancel')
+        b.callback_clicked_add(lambda b: pp.delete())
+        pp.part_content_set('button1', b)
+
+        b = elm.Button(pp, text='Save')
+        b.callback_clicked_add(lambda b: self._view_save_done(en, pp))
+        pp.part_content_set('button2', b)
+
+        pp.show()
+        en.focus = True
+
+    def _view_save_done(self, entry, popup):
+        if entry.text:
+            self.top_widget.view_save(entry.text)
+            popup.delete()
+
+    def populate_lists(self):
+        TAG_TREE.changed_pop()
 
         self._freezed = True
-        self.cxts_list.clear()
-        self.projs_list.clear()
-        for name, num in sorted(tags.items()):
-            rect = ColorRect(self, tag_color_get(name), name)
-            num = elm.Label(self, text=str(num), style='marker')
-            if name.startswith('+'):
-                it = self.projs_list.item_append(name, rect, num)
-            else:
-                it = self.cxts_list.item_append(name, rect, num)
-            if name in selected:
+        for li in self.projs_list, self.cxts_list:
+            li.populate(self.project_filter if li is self.projs_list
+                        else self.context_filter)
+
+        selected = self.file_filter or ()
+        self.files_list.clear()
+        self._file_items = {}
+        for path in files():
+            marker = elm.Label(self, style='marker')
+            it = self.files_list.item_append(os.path.basename(path),
+                                             None, marker)
+            it.data['path'] = path
+            it.data['marker'] = marker
+            if path in selected:
                 it.selected = True
+            self._file_items[path] = it
+        self.files_update()
         self._freezed = False
 
+    def files_update(self):
+        """ Update the tasks count and the unsaved marker of the files """
+        for path, it in self._file_items.items():
+            name = os.path.basename(path)
+            text = name + ' *' if file_need_save(path) else name
+            if it.text != text:
+                it.text = text
+            num = str(FILES.count(path))
+            if it.data['marker'].text != num:
+                it.data['marker'].text = num
+
+    def update_lists(self):
+        """ Update only the rows of the tags changed since the last update """
+        changed = TAG_TREE.changed_pop()
+        self._freezed = True
+        for li in self.projs_list, self.cxts_list:
+            li.update([ n for n in changed if n[0] == li.sigil ])
+        self.files_update()
+        self._freezed = False
+
+    def facets_update(self, prj_base, ctx_base):
+        """ Show the number of tasks for each tag given the other filters
+
+        prj_base and ctx_base are the sets of tasks matching all the active
+        filters except the projects (or contexts) selection, None means
+        no restriction at all (all the tasks).
+        """
+        self.projs_list.base = prj_base
+        self.cxts_list.base = ctx_base
+        self.projs_list.realized_items_update()
+        self.cxts_list.realized_items_update()
+
+    def facets_task_update(self, task, in_prj_base, in_ctx_base):
+        """ Move a single (changed) task in or out of the facets bases """
+        for base, inside in ((self.projs_list.base, in_prj_base),
+                             (self.cxts_list.base, in_ctx_base)):
+            if base is not None:
+                if inside:
+                    base.add(task)
+                else:
+                    base.discard(task)
+
+
+class TagsList(elm.Genlist):
+    """ Tree of the +projects (or @contexts), split at the dots
+
+    Nodes are created when their parent is expanded, the marker shows the
+    number of tasks in the whole subtree (only the ones in base, if set).
+    Item data is the node name (ex: +acme.web).
+    """
+    def __init__(self, parent, sigil):
+        self.filters = parent
+        self.sigil = sigil
+        self.base = None  # count only these tasks (facets), None = all
+        self.node_items = {}   # key: node name  data: genlist item (created ones)
+        self.itc = elm.GenlistItemClass(item_style='default',
+                                        text_get_func=self._gl_text_get,
+                                        content_get_func=self._gl_content_get)
+        elm.Genlist.__init__(self, parent, multi_select=True,
+                             focus_allow=False, mode=elm.ELM_LIST_COMPRESS,
+                             homogeneous=True, size_hint_weight=EXPAND_BOTH,
+                             size_hint_align=FILL_BOTH)
+        self.callback_expand_request_add(self._expand_request_cb)
+        self.callback_contract_request_add(self._contract_request_cb)
+        self.callback_expanded_add(self._expanded_cb)
+        self.callback_contracted_add(self._contracted_cb)
+
+    def populate(self, selected=None):
+        """ Recreate the first level, and the expanded nodes """
+        self.clear()
+        self.node_items = {}
+        for name in TAG_TREE.children(None, self.sigil):
+            self._item_add(name, append=True)
+        self.select(selected or ())
+
+    def select(self, names):
+        """ Select only the given nodes, expanding their parents """
+        for name in names:
+            for parent in tag_parents(name):
+                options.expanded_tags.add(parent)
+                it = self.node_items.get(parent)
+                if it is not None:
+                    it.expanded = True
+        for name, it in self.node_items.items():
+            it.selected = name in names
+
+    def update(self, changed):
+        """ Add, remove or update the items of the changed nodes """
+        for name in sorted(changed):  # parents first
+            it = self.node_items.get(name)
+            if name not in TAG_TREE.nodes:
+                if it is not None:
+                    self._item_del(name)
+            elif it is None:
+                parent = TAG_TREE.parent(name)
+                if parent is None or (parent in self.node_items and
+                                      self.node_items[parent].expanded):
+                    self._item_add(name)
+            elif bool(it.flags) != TAG_TREE.has_children(name):
+                # became (or is no more) a tree item: flags are fixed
+                selected = it.selected
+                self._item_del(name)
+                self._item_add(name).selected = selected
+            else:
+                it.update()
+
+    def _item_add(self, name, append=False):
+        parent = TAG_TREE.parent(name)
+        flags = elm.ELM_GENLIST_ITEM_TREE if TAG_TREE.has_children(name) \
+                else elm.ELM_GENLIST_ITEM_NONE
+        # before the next sibling already in the list, if any (append is
+        # used when the siblings are added in order)
+        before = None
+        if not append:
+            siblings = TAG_TREE.children(parent, self.sigil)
+            for sibling in siblings[bisect(siblings, name):]:
+                before = self.node_items.get(sibling)
+                if before is not None:
+                    break
+        if before is not None:
+            it = self.item_insert_before(self.itc, name, before, flags)
+        else:
+            it = self.item_append(self.itc, name, self.node_items.get(parent),
+                                  flags)
+        self.node_items[name] = it
+        if flags and name in options.expanded_tags:
+            it.expanded = True
+        return it
+
+    def _item_del(self, name):
+        # the subitems are deleted with the item
+        prefix = name + '.'
+        for n in [ n for n in self.node_items if n.startswith(prefix) ]:
+            del self.node_items[n]
+        self.node_items.pop(name).delete()
+
+    def _expand_request_cb(self, gl, it):
+        it.expanded = True
+
+    def _contract_request_cb(self, gl, it):
+        it.expanded = False
+
+    def _expanded_cb(self, gl, it):
+        options.expanded_tags.add(it.data)
+        for name in TAG_TREE.children(it.data):
+            if name not in self.node_items:
+                self._item_add(name, append=True)
+
+    def _contracted_cb(self, gl, it):
+        options.expanded_tags.discard(it.data)
+        prefix = it.data + '.'
+        hidden = [ n for n in self.node_items if n.startswith(prefix) ]
+        changed = any(self.node_items[n].selected for n in hidden)
+        for n in hidden:
+            del self.node_items[n]
+        it.subitems_clear()
+        # the selection of the hidden nodes is lost
+        if changed and not self.filters._freezed:
+            self.top_widget.filters_changed()
+
+    def _gl_text_get(self, gl, part, name):
+        parent = TAG_TREE.parent(name)
+        return name if parent is None else name[len(parent) + 1:]
+
+    def _gl_content_get(self, gl, part, name):
+        if part == 'elm.swallow.icon':
+            return ColorRect(self, tag_color_get(name), name)
+        elif part == 'elm.swallow.end':
+            return elm.Label(self, style='marker',
+                             text=str(TAG_TREE.count(name, self.base)))
+
 
 class ColorRect(elm.Frame):
     def __init__(self, parent, color, tag_name):
@@ -451,96 +1126,358 @@ class TasksList(elm.Genlist):
                                         content_get_func=self._gl_content_get)
         self.itcg = elm.GenlistItemClass(item_style="group_index",
                                          text_get_func=self._gl_g_text_get)
+        self.itct = elm.GenlistItemClass(item_style="default",
+                                         text_get_func=self._gl_g_text_get)
         elm.Genlist.__init__(self, parent, mode=elm.ELM_LIST_COMPRESS,
                              homogeneous=True)
         self.callback_selected_add(self._item_selected_cb)
         self.callback_clicked_right_add(self._item_clicked_right_cb)
         self.callback_longpressed_add(self._item_clicked_right_cb)
-        self.callback_activated_add(lambda gl,it: self._task_edit_start(it.data))
+        self.callback_activated_add(self._item_activated_cb)
+        self.callback_expand_request_add(self._expand_request_cb)
+        self.callback_contract_request_add(self._contract_request_cb)
+        self.callback_expanded_add(self._expanded_cb)
+        self.callback_contracted_add(self._contracted_cb)
         self.show()
         self.groups = {} # key: group_name  data: genlist_group_item
+        self.groups_tasks = {} # key: group_name  data: list of tasks (tree mode)
+        self.task_items = {} # key: task  data: dict (key: group_name  data: item)
 
     def rebuild(self):
         self.clear()
         self.groups = {}
+        self.groups_tasks = {}
+        self.task_items = {}
         self.top_widget.task_note.clear()
 
-        filters = self.top_widget.filters
-        ctx_set = filters.context_filter
-        prj_set = filters.project_filter
-        search = self.top_widget.search_entry.text
-
-        # first add all the group items (if grouping enable)
-        if   options.group_by == 'prj': L = filters.all_projects + ['+']
-        elif options.group_by == 'ctx': L = filters.all_contexts + ['@']
-        else:                           L = []
-        for group_name in L:
-            git = self.item_append(self.itcg, group_name,
+        visible, prj_base, ctx_base = self._filtered_tasks()
+
+        if options.group_by == 'none':
+            for t in visible:
+                self._task_append(t)
+        elif options.tree_groups:
+            # only the group headers, children are created on expand
+            expanded = options.expanded_groups.get(options.group_by, ())
+            for key, group in group_tasks(visible, options.group_by):
+                self.groups_tasks[key] = group
+                git = self._group_append(key, len(group))
+                if key in expanded:
+                    git.expanded = True
+        else:
+            for key, group in group_tasks(visible, options.group_by):
+                git = self._group_append(key, len(group))
+                for t in group:
+                    self._task_append(t, key)
+
+        self.top_widget.filters.facets_update(prj_base, ctx_base)
+        self.top_widget.refresh_schedule()
+
+    def _task_append(self, task, key=None):
+        git = None if key is None else self.groups[key]
+        it = self.item_append(self.itc, task, git)
+        if task in self.task_items:
+            self.task_items[task][key] = it
+        else:
+            self.task_items[task] = {key: it}
+        return it
+
+    def _group_append(self, key, count):
+        if options.tree_groups:
+            git = self.item_append(self.itct, [key, count],
+                                   flags=elm.ELM_GENLIST_ITEM_TREE)
+            self.groups_tasks.setdefault(key, [])
+        else:
+            git = self.item_append(self.itcg, [key, count],
                                    flags=elm.ELM_GENLIST_ITEM_GROUP)
             git.select_mode = elm.ELM_OBJECT_SELECT_MODE_DISPLAY_ONLY
-            self.groups[group_name] = git
+        self.groups[key] = git
+        return git
+
+    def _expanded_groups(self):
+        # expanded groups are remembered separately for each group_by
+        if options.group_by not in options.expanded_groups:
+            options.expanded_groups[options.group_by] = set()
+        return options.expanded_groups[options.group_by]
+
+    def _expand_request_cb(self, gl, git):
+        git.expanded = True
+
+    def _contract_request_cb(self, gl, git):
+        git.expanded = False
+
+    def _expanded_cb(self, gl, git):
+        key = git.data[0]
+        self._expanded_groups().add(key)
+        for t in self.groups_tasks[key]:
+            self._task_append(t, key)
+
+    def _contracted_cb(self, gl, git):
+        key = git.data[0]
+        self._expanded_groups().discard(key)
+        git.subitems_clear()
+        for t in self.groups_tasks[key]:
+            self.task_items[t].pop(key, None)
+
+    def _filtered_tasks(self):
+        """ Apply all the filters and the sorting to the tasks
+
+        Return the ordered list of visible tasks and the bases for the tags
+        facets (None when the facet is not restricted by other filters).
+        """
+        filters = self.top_widget.filters
+        prj_filtered = self._filtering(filters.context_filter)
+        ctx_filtered = self._filtering(filters.project_filter)
+        in_files = self._files_tasks()
+
+        # saved view: the results are already materialized
+        sv = self.top_widget.active_view
+        if sv is not None:
+            hidden = set(not_started_tasks()) if options.hide_future else ()
+            def shown(tasks):
+                return [ t for t in tasks if t not in hidden
+                         and (in_files is None or t in in_files) ]
+            visible = TASKS.sorted(shown(sv.tasks()))
+            if options.sort_by == 'pri':
+                visible.sort(key=attrgetter('raw_txt'))
+            # each facet ignores its own selection
+            prj_base = set(shown(sv.tasks('+'))) if prj_filtered else None
+            ctx_base = set(shown(sv.tasks('@'))) if ctx_filtered else None
+            return visible, prj_base, ctx_base
+
+        # the storage runs the queries itself (ex: in SQL)
+        if self.top_widget.storage.queries:
+            return self.top_widget.storage.filtered(
+                self.search_query(), options.view, filters.project_filter,
+                filters.context_filter, filters.file_filter, options.due_view,
+                options.hide_future, options.sort_by, prj_filtered,
+                ctx_filtered)
+
+        # vectorized version, using the columnar store
+        store = self.top_widget.column_store
+        if store is not None:
+            q = self.search_query()
+            m0, m1, m2 = store.masks(options.view, filters.project_filter,
+                                     filters.context_filter, None,
+                                     options.due_view, options.hide_future)
+            if q is not None:
+                m0 &= store.tasks_mask(q.run())
+            if in_files is not None:
+                m0 &= store.tasks_mask(in_files)
+            visible = store.tasks_where(m0 & m1 & m2, options.sort_by)
+            prj_base = set(store.tasks_where(m0 & m1)) if prj_filtered else None
+            ctx_base = set(store.tasks_where(m0 & m2)) if ctx_filtered else None
+            return visible, prj_base, ctx_base
+
+        # only look at the tasks in the due view and the ones that can match
+        # the search query (both from the indexes)
+        q = self.search_query()
+        candidates = q.candidates() if q is not None else None
+        if options.due_view != 'all':
+            due = set(due_tasks(options.due_view))
+            candidates = due if candidates is None else due & candidates
+        if in_files is not None:
+            candidates = in_files if candidates is None \
+                         else in_files & candidates
+        if candidates is not None:
+            candidates = TASKS.sorted(candidates)
+        else:
+            candidates = TASKS
 
         if options.sort_by == 'pri':
-            ordered = sorted(TASKS, key=attrgetter('raw_txt'))
+            ordered = sorted(candidates, key=attrgetter('raw_txt'))
         else:
-            ordered = TASKS
+            ordered = candidates
 
+        visible = []
+        prj_base = set() if prj_filtered else None
+        ctx_base = set() if ctx_filtered else None
+        match = self._task_match_func()
         for t in ordered:
-            if (options.view == 'done' and not t.completed) or \
-               (options.view == 'todo' and t.completed):
-                continue
-
-            f1 = True if ctx_set is None else \
-                    len(ctx_set.intersection(t.contexts)) > 0
-
-            f2 = True if prj_set is None else \
-                    len(prj_set.intersection(t.projects)) > 0
-
-            f3 = True if not search else \
-                    search.lower() in t.raw_txt.lower()
+            f0, f1, f2 = match(t)
+            if f0 and f1 and prj_base is not None:
+                prj_base.add(t)
+            if f0 and f2 and ctx_base is not None:
+                ctx_base.add(t)
+            if f0 and f1 and f2:
+                visible.append(t)
+
+        return visible, prj_base, ctx_base
+
+    def _filtering(self, tags_filter):
+        return tags_filter is not None or options.view != 'all' or \
+               options.due_view != 'all' or options.hide_future or \
+               self.top_widget.filters.file_filter is not None or \
+               bool(self.top_widget.search_entry.text)
+
+    def _files_tasks(self):
+        """ The tasks of the selected files (None if no file is selected) """
+        paths = self.top_widget.filters.file_filter
+        if paths is None:
+            return None
+        return set().union(*(FILES.tasks(p) for p in paths))
+
+    def search_query(self):
+        """ The compiled query from the search entry (None if empty) """
+        text = self.top_widget.search_entry.text
+        if not text.strip():
+            return None
+        try:
+            return query.compile(text)
+        except query.QueryError:
+            # not a valid query (yet), just search the text
+            return query.Query(text, query.Text(text))
 
-            if f1 and f2 and f3:
-                self.item_add(t)
+    def _task_match_func(self):
+        """ Return a function that given a task tell if it match the filters
 
-        # and finally delete empty group items
-        for name, item in self.groups.items():
-            # TODO this should be: item.subitems_count()... but it does not work
-            if len(item.subitems_get()) == 0:
-                item.delete()
+        The returned tuple contains 3 flags, for (view and search),
+        contexts filter and projects filter.
+        """
+        filters = self.top_widget.filters
+        ctx_set = filters.context_filter
+        prj_set = filters.project_filter
+        ctx_match = TagsFilter(ctx_set).match if ctx_set else None
+        prj_match = TagsFilter(prj_set).match if prj_set else None
+        file_set = filters.file_filter
+        q = self.search_query()
+        view = options.view
+        today = datetime.date.today()
+        due_view = options.due_view
+        due_start, due_end = due_range(due_view, today)
+        hidden = set(not_started_tasks(today)) if options.hide_future else ()
+
+        def match(t):
+            f0 = not ((view == 'done' and not t.completed) or \
+                      (view == 'todo' and t.completed)) and \
+                 (q is None or q.match(t)) and \
+                 t not in hidden and \
+                 (file_set is None or t._file in file_set)
+
+            if f0 and due_view != 'all':
+                f0 = t.due is not None and \
+                     (due_start is None or t.due.date() >= due_start) and \
+                     (due_end is None or t.due.date() < due_end) and \
+                     not (due_view == 'overdue' and t.completed)
+
+            f1 = True if ctx_match is None else ctx_match(t)
+            f2 = True if prj_match is None else prj_match(t)
+
+            return f0, f1, f2
+
+        return match
+
+    def task_changed(self, task):
+        """ Update the selected item and the side lists after a task edit """
+        f0, f1, f2 = self._task_match_func()(task)
+        self.update_selected()
+        self.top_widget.filters.facets_task_update(task, f0 and f1, f0 and f2)
+        self.top_widget.filters.update_lists()
+        self.top_widget.refresh_schedule()
 
     def item_add(self, t, start_editing=False):
         # no grouping (just append the item)
         if options.group_by == 'none':
-            it = self.item_append(self.itc, t)
-        # group by projects (append in every projects)
-        elif options.group_by == 'prj':
-            if len(t.projects) > 0:
-                for p in t.projects:
-                    it = self.item_append(self.itc, t, self.groups['+'+p])
-            else:
-                it = self.item_append(self.itc, t, self.groups['+'])
-        # group by contexts (append in every contexts)
-        elif options.group_by == 'ctx':
-            if len(t.contexts) > 0:
-                for c in t.contexts:
-                    it = self.item_append(self.itc, t, self.groups['@'+c])
-            else:
-                it = self.item_append(self.itc, t, self.groups['@'])
+            it = self._task_append(t)
+        # append in every group of the task (creating missing groups)
+        else:
+            for key in group_keys(t, options.group_by):
+                git = self.groups.get(key)
+                if git is None:
+                    git = self._group_append(key, 1)
+                else:
+                    git.data[1] += 1
+                    git.update()
+                if not options.tree_groups:
+                    it = self._task_append(t, key)
+                elif git.expanded:
+                    self.groups_tasks[key].append(t)
+                    it = self._task_append(t, key)
+                else:
+                    # expanding create all the children, t is the last one
+                    self.groups_tasks[key].append(t)
+                    git.expanded = True
+                    it = git.subitems_get()[-1]
         # start editing if requested
         if start_editing:
             it.selected = True
             self._task_edit_start(t)
 
+    def item_del(self, task):
+        """ Remove all the items of the task, and the groups left empty """
+        if self.top_widget.task_note.task is task:
+            self.top_widget.task_note.clear()
+
+        items = self.task_items.pop(task, {})
+        for it in items.values():
+            it.delete()
+
+        if options.group_by == 'none':
+            return
+        for key in group_keys(task, options.group_by):
+            git = self.groups.get(key)
+            if git is None:
+                continue
+            if options.tree_groups:
+                if task not in self.groups_tasks[key]:
+                    continue
+                self.groups_tasks[key].remove(task)
+            elif key not in items:
+                continue
+            git.data[1] -= 1
+            if git.data[1] > 0:
+                git.update()
+            else:
+                git.delete()
+                del self.groups[key]
+                self.groups_tasks.pop(key, None)
+
+    def task_deleted(self, task):
+        """ Update the list and the side lists after a task deletion """
+        self.item_del(task)
+        self.top_widget.filters.facets_task_update(task, False, False)
+        self.top_widget.filters.update_lists()
+        self.top_widget.refresh_schedule()
+
+    def history_applied(self, changes):
+        """ Update the list after an undo or redo (see tasks.history_undo) """
+        filters = self.top_widget.filters
+        match = self._task_match_func()
+        for task, action in changes:
+            if action == 'delete':
+                self.item_del(task)
+                filters.facets_task_update(task, False, False)
+                continue
+            f0, f1, f2 = match(task)
+            if action == 'add':
+                if f0 and f1 and f2:
+                    self.item_add(task)
+            else:
+                for it in self.task_items.get(task, {}).values():
+                    it.update()
+            filters.facets_task_update(task, f0 and f1, f0 and f2)
+        filters.update_lists()
+        self.top_widget.refresh_schedule()
+
     def update_selected(self):
         if self.selected_item:
             self.selected_item.update()
 
     def _item_clicked_right_cb(self, gl, item):
-        item.selected = True
-        TaskPropsMenu(gl, item.data)
+        if isinstance(item.data, Task):
+            item.selected = True
+            TaskPropsMenu(gl, item.data)
 
     def _item_selected_cb(self, gl, item):
-        self.top_widget.task_note.update(item.data)
+        if isinstance(item.data, Task):
+            self.top_widget.task_note.update(item.data)
+        else:
+            # tree group header: toggle expansion
+            item.selected = False
+            item.expanded = not item.expanded
+
+    def _item_activated_cb(self, gl, item):
+        if isinstance(item.data, Task):
+            self._task_edit_start(item.data)
 
     def _task_edit_start(self, task):
         pp = elm.Popup(self.top_widget)
@@ -572,13 +1509,21 @@ class TasksList(elm.Genlist):
         if new_raw:
             task.raw_txt = entry.text
             popup.delete()
-            self.update_selected()
-            self.top_widget.filters.populate_lists()
-
-    def _gl_g_text_get(self, obj, part, group_name):
-        if group_name == '+': return 'Tasks without any projects'
-        if group_name == '@': return 'Tasks without any contexts'
-        return group_name
+            self.task_changed(task)
+
+    def _gl_g_text_get(self, obj, part, group):
+        key, count = group
+        if options.group_by == 'pri':
+            name = 'Priority %s' % key if key else 'Tasks without priority'
+        elif options.group_by == 'date':
+            name = DATE_BUCKETS[key]
+        elif key == '+':
+            name = 'Tasks without any projects'
+        elif key == '@':
+            name = 'Tasks without any contexts'
+        else:
+            name = key
+        return '%s (%d)' % (name, count)
 
     def _gl_text_get(self, obj, part, task):
         # apply tag colors
@@ -591,6 +1536,18 @@ class TasksList(elm.Genlist):
                 words.append(word)
         formatted = ' '.join(words)
 
+        # due date
+        if task.due is not None:
+            overdue = task.due.date() < datetime.date.today()
+            formatted += ' <font %s>due:%s</font>' % (
+                         OVERDUE_FONT if overdue and not task.completed
+                         else EXTRA_FONT, task.due.strftime('%Y-%m-%d'))
+
+        # other key:value extensions
+        for key, value in task.keys.items():
+            if key not in ('due', 't', 'prog', 'note'):
+                formatted += ' <font %s>%s:%s</font>' % (EXTRA_FONT, key, value)
+
         # strikethrough todo tasks
         if task.completed:
             return '<font %s>%s</font>' % (DONE_FONT, formatted)
@@ -662,17 +1619,18 @@ class TaskPropsMenu(elm.Menu):
 
     def _completed_set(self, completed):
         self._task.completed = completed
-        self.top_widget.tasks_list.update_selected()
+        self.top_widget.tasks_list.task_changed(self._task)
 
     def _priority_cb(self, m, item):
         self._task.priority = item.text
-        self.top_widget.tasks_list.update_selected()
+        self.top_widget.tasks_list.task_changed(self._task)
 
     def _progress_cb(self, m, item):
         val = int(item.text[:-2])
-        self._task.progress = val
-        self._task.completed = True if val == 100 else False
-        self.top_widget.tasks_list.update_selected()
+        with HISTORY.group():
+            self._task.progress = val
+            self._task.completed = True if val == 100 else False
+        self.top_widget.tasks_list.task_changed(self._task)
 
     def _confirm_delete(self, m, item):
         pp = elm.Popup(self.top_widget, text=self._task.text)
@@ -690,10 +1648,8 @@ class TaskPropsMenu(elm.Menu):
 
     def _delete_confirmed(self, b, popup):
         popup.delete()
-        self.top_widget.task_note.clear()
         self._task.delete()
-        self.top_widget.tasks_list.rebuild()
-        self.top_widget.filters.populate_lists()
+        self.top_widget.tasks_list.task_deleted(self._task)
 
 
 class TaskNote(elm.Entry):
@@ -707,6 +1663,7 @@ class TaskNote(elm.Entry):
         self.part_text_set('guide', self.GUIDE1)
         self.callback_clicked_add(self._clicked_cb)
         self.callback_unfocused_add(self._unfocused_cb)
+        self.callback_changed_user_add(self._changed_user_cb)
         self.show()
 
     def update(self, task=None):
@@ -714,23 +1671,31 @@ class TaskNote(elm.Entry):
             self.task = task
 
         self.part_text_set('guide', self.GUIDE2 if self.task else self.GUIDE1)
+        self.text = ''
+        self.disabled = True
 
+        # the content is shown when loaded (at once if in the cache)
         if self.task and self.task.note:
-            try:
-                self.file_set(self.task.note, elm.ELM_TEXT_FORMAT_PLAIN_UTF8)
-            except:
-                pass
+            self.top_widget.notes.get(self.task.note, self._note_loaded)
+
+    def _note_loaded(self, path, text):
+        # ignore notes of tasks no more selected
+        if self.task and self.task.note == path:
+            self.text = elm.utf8_to_markup(text or '')
             self.disabled = False
-        else:
-            self.file_set(None, None)
-            self.disabled = True
 
     def clear(self):
         self.task = None
         self.update()
 
+    def _changed_user_cb(self, entry):
+        if self.task and self.task.note:
+            self.top_widget.notes.put(self.task.note,
+                                      elm.markup_to_utf8(entry.text))
+
     def _unfocused_cb(self, entry):
-        if self.task and not entry.text:
+        if self.task and self.task.note and not entry.text:
+            self.top_widget.notes.put(self.task.note, '')
             self.task.note = None
         self.top_widget.tasks_list.update_selected()
 
@@ -738,14 +1703,54 @@ class TaskNote(elm.Entry):
         if self.task is None:
             return
 
-        if self.file[0] is not None:
+        if self.task.note is not None:
             return
 
+        # the new note has no file yet: enabled at once, to type in it
         self.task.create_note_filename()
+        self.top_widget.notes.new(self.task.note)
         self.update()
         self.focus = True
 
 
+class StatsWin(elm.InnerWindow):
+    """ Tasks created and completed in the last days (from the rollups) """
+    def __init__(self, parent):
+        elm.InnerWindow.__init__(self, parent)
+
+        # the done.txt archive is counted only when changed (or not cached)
+        rollups = parent.rollups
+        rollups.archive([archive_path(options.txt_file)],
+                        options.encoding_errors)
+        rollups.flush()
+
+        vbox = elm.Box(self)
+        vbox.show()
+        self.content = vbox
+
+        title = elm.Label(self, scale=2.0, text='Statistics')
+        title.show()
+        vbox.pack_end(title)
+
+        text = elm.utf8_to_markup('\n'.join(report(rollups)))
+        en = elm.Entry(self, text='<code>%s</code>' % text,
+                       editable=False, scrollable=True,
+                       size_hint_weight=EXPAND_BOTH, size_hint_align=FILL_BOTH)
+        en.show()
+        vbox.pack_end(en)
+
+        sep = elm.Separator(self, horizontal=True)
+        sep.show()
+        vbox.pack_end(sep)
+
+        close = elm.Button(self, text='Close')
+        close.callback_clicked_add(lambda b: self.delete())
+        close.show()
+        vbox.pack_end(close)
+
+        self.activate()
+
+
 class InfoWin(elm.InnerWindow):
     def __init__(self, parent):
         elm.InnerWindow.__init__(self, parent)
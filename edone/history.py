@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Undo/redo stacks for the changes to the tasks.
+
+Every change is stored as a compact delta: a (pos, old, new) tuple with the
+position of the line (for edone.tasks: the index in TASKS and the file) and
+the old and new raw text. old is None for inserted tasks and new is None for
+deleted ones. Deltas recorded inside a group() are undone (and redone)
+together, as a single step.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+
+
+DELTA_OVERHEAD = 120  # estimated bytes used by a delta, excluding the text
+
+
+def delta_size(delta):
+    pos, old, new = delta
+    return DELTA_OVERHEAD + len(old or '') + len(new or '')
+
+
+def delta_invert(delta):
+    pos, old, new = delta
+    return pos, new, old
+
+
+class History(object):
+    """ Undo and redo stacks, using at most budget bytes (estimated) """
+
+    def __init__(self, budget=1024 * 1024):
+        self.budget = budget
+        self.undo_steps = deque()  # list of deltas for each step
+        self.redo_steps = []
+        self.size = 0     # estimated bytes used by all the steps
+        self.paused = 0   # nothing is recorded while > 0
+        self._group = None
+        self._depth = 0
+
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps = []
+        self.size = 0
+
+    def can_undo(self):
+        return bool(self.undo_steps)
+
+    def can_redo(self):
+        return bool(self.redo_steps)
+
+    def record(self, pos, old, new):
+        if self.paused:
+            return
+        delta = (pos, old, new)
+        if self._group is not None:
+            self._group.append(delta)
+        else:
+            self._push([delta])
+
+    @contextmanager
+    def group(self):
+        """ Record all the deltas in the block as a single step """
+        if self._depth == 0:
+            self._group = []
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                step, self._group = self._group, None
+                if step:
+                    self._push(step)
+
+    @contextmanager
+    def paused_block(self):
+        """ Do not record the changes made in the block """
+        self.paused += 1
+        try:
+            yield
+        finally:
+            self.paused -= 1
+
+    def _push(self, step):
+        # a new change make the undone steps unreachable
+        for s in self.redo_steps:
+            self.size -= sum(delta_size(d) for d in s)
+        self.redo_steps = []
+        self.undo_steps.append(step)
+        self.size += sum(delta_size(d) for d in step)
+        self._trim()
+
+    def _trim(self):
+        # forget the oldest steps until we are inside the budget
+        while self.size > self.budget and self.undo_steps:
+            step = self.undo_steps.popleft()
+            self.size -= sum(delta_size(d) for d in step)
+
+    def undo_pop(self):
+        """ The inverted deltas of the last step (in order), None if empty """
+        if not self.undo_steps:
+            return None
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        return [ delta_invert(d) for d in reversed(step) ]
+
+    def redo_pop(self):
+        """ The deltas of the last undone step, None if empty """
+        if not self.redo_steps:
+            return None
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        return step
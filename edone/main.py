@@ -20,28 +20,103 @@
 
 import os
 import sys
+import argparse
+import logging
 
-from efl import elementary as elm
-from edone.utils import options, config_path
-from edone.gui import EdoneWin
+from edone.utils import options, config_path, cache_path
 
-# setup efl logging
-import logging
-elog = logging.getLogger("efl")
-elog.addHandler(logging.StreamHandler())
-elog.setLevel(logging.INFO)
 
+def headless(argv):
+    """ Import/export and stats without the gui (efl is not even imported) """
+    from edone.tasks import tasks_read
+    from edone.formats import FORMATS, export_to_file, import_from_file
+
+    parser = argparse.ArgumentParser(prog='edone')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('export', help='export the tasks to another format')
+    p.add_argument('-f', '--format', choices=sorted(FORMATS),
+                   help='output format (default: from the file extension)')
+    p.add_argument('-o', '--output', default='-',
+                   help='output file (default: stdout)')
+    p.add_argument('todo_file', nargs='?', help='default: the configured one')
 
-def main():
+    p = sub.add_parser('import', help='append the tasks to the todo file')
+    p.add_argument('-f', '--format', choices=sorted(FORMATS),
+                   help='input format (default: from the file extension)')
+    p.add_argument('input', help='input file (- for stdin)')
+    p.add_argument('todo_file', nargs='?', help='default: the configured one')
+
+    p = sub.add_parser('stats', help='tasks created and completed per day')
+    p.add_argument('-d', '--days', type=int, default=28,
+                   help='number of days to show (default: 28)')
+    p.add_argument('--rebuild', action='store_true',
+                   help='count again all the tasks, ignoring the cache')
+    p.add_argument('todo_file', nargs='?', help='default: the configured '
+                   'files (the done.txt next to it is always counted)')
+
+    args = parser.parse_args(argv)
+    todo_file = args.todo_file or options.txt_file
+
+    if args.command == 'stats':
+        from edone.stats import Rollups, archive_path, report
+        if args.todo_file:
+            paths = [args.todo_file]
+        else:
+            paths = [todo_file] + options.other_files
+        paths.append(archive_path(paths[0]))
+        rollups = Rollups(os.path.join(cache_path, 'rollups'))
+        rollups.archive(list(dict.fromkeys(paths)), options.encoding_errors,
+                        args.rebuild)
+        rollups.flush()
+        print('\n'.join(report(rollups, days=args.days)))
+    elif args.command == 'export':
+        fmt = args.format or ('jsonl' if args.output == '-' else None)
+        tasks = tasks_read(todo_file, options.encoding_errors)
+        export_to_file(tasks, args.output, fmt)
+    else:
+        # append one line at a time, keeping the file newline terminated
+        count = 0
+        with open(todo_file, 'ab+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+            for t in import_from_file(args.input, args.format):
+                f.write(t.raw_txt.encode('utf-8', options.encoding_errors))
+                f.write(b'\n')
+                count += 1
+        print('Imported %d tasks in "%s"' % (count, todo_file),
+              file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
 
     # load config and create necessary folders and files
     options.load()
     if not os.path.exists(config_path):
         os.makedirs(config_path)
+
+    # import/export and stats from the command line
+    if argv and argv[0] in ('export', 'import', 'stats'):
+        return headless(argv)
+
     if not os.path.exists(options.txt_file):
         with open(options.txt_file, 'a') as f:
             print('(A) Welcome to Etodo', file=f)
 
+    # efl is only needed by the gui
+    from efl import elementary as elm
+    from edone.gui import EdoneWin
+
+    # setup efl logging
+    elog = logging.getLogger("efl")
+    elog.addHandler(logging.StreamHandler())
+    elog.setLevel(logging.INFO)
+
     # create the main window and load the todo file
     elm.init()
     win = EdoneWin()
@@ -51,6 +126,11 @@ def main():
     elm.run()
 
     # mainloop done, shutdown
+    win.notes.close()
+    win.storage.close()
+    win.rollups.flush()
+    if win.sync is not None:
+        win.sync.close()
     elm.shutdown()
     options.save()
 
@@ -59,4 +139,3 @@ def main():
 
 if __name__ == "__main__":
     sys.exit(main())
-
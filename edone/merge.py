@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Line level three-way merge (as diff3), of two versions of the same lines.
+"""
+
+import difflib
+
+
+def _matches(base, other):
+    """ key: base line index  val: index of the same line in other """
+    if base == other:
+        return dict((i, i) for i in range(len(base)))
+    sm = difflib.SequenceMatcher(None, base, other, autojunk=False)
+    return dict((a + n, b + n) for a, b, size in sm.get_matching_blocks()
+                for n in range(size))
+
+
+def _kind(base, local, other):
+    if local == base:
+        return 'other'
+    if other == base:
+        return 'local'
+    if local == other:
+        return 'both'
+    return 'conflict'
+
+
+def merge3(base, local, other):
+    """ Compare the local and other versions of the base lines
+
+    Return the list of the changed chunks, in order, as tuples:
+        (kind, (i1, i2), (j1, j2), (k1, k2))
+    with the ranges of the chunk in base, local and other. kind is 'local'
+    (changed only locally), 'other' (changed only in other), 'both' (same
+    change on both sides) or 'conflict'. Lines not in any chunk are equal
+    in the three versions. Unlike diff3, changes to adjacent lines are not a
+    conflict when no line is added or removed.
+    """
+    in_local = _matches(base, local)
+    in_other = _matches(base, other)
+    chunks = []
+    i = j = k = 0
+    while True:
+        # next base line kept in both versions (after the previous one)
+        i2 = i
+        while i2 < len(base) and not (in_local.get(i2, -1) >= j and
+                                      in_other.get(i2, -1) >= k):
+            i2 += 1
+        if i2 < len(base):
+            j2, k2 = in_local[i2], in_other[i2]
+        else:
+            j2, k2 = len(local), len(other)
+
+        if i2 > i or j2 > j or k2 > k:
+            b, l, o = base[i:i2], local[j:j2], other[k:k2]
+            kind = _kind(b, l, o)
+            if kind == 'conflict' and len(b) == len(l) == len(o):
+                # only changed lines (as adjacent lines changed on different
+                # sides): every line is merged on its own
+                for n in range(len(b)):
+                    if not b[n] == l[n] == o[n]:
+                        chunks.append((_kind(b[n], l[n], o[n]),
+                                       (i + n, i + n + 1), (j + n, j + n + 1),
+                                       (k + n, k + n + 1)))
+            else:
+                chunks.append((kind, (i, i2), (j, j2), (k, k2)))
+
+        if i2 >= len(base):
+            return chunks
+        i, j, k = i2 + 1, j2 + 1, k2 + 1
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Notes files access, without blocking the main loop.
+
+Notes are read and written by a worker thread: reads are delivered with a
+callback (through the given post function, to get back in the main loop),
+writes are delayed until the note has not been changed for a while and
+then atomically replace the file. Recently used notes are kept in a small
+LRU cache.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+
+
+CACHE_SIZE = 32    # number of notes kept in memory
+WRITE_DELAY = 1.0  # seconds without changes before writing a note
+
+
+def _direct_call(func, *args):
+    func(*args)
+
+
+def note_read(path):
+    """ The content of the note, None if the file does not exist """
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def note_write(path, text):
+    """ Write the note to a temp file and then replace the real one """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class NoteStore(object):
+    """ Asynchronous, cached, notes reader and (debounced) writer
+
+    post(func, *args) must call func in the main loop, the default call it
+    directly (in the worker thread).
+    """
+
+    def __init__(self, post=None, cache_size=CACHE_SIZE, delay=WRITE_DELAY):
+        self.post = post or _direct_call
+        self.cache_size = cache_size
+        self.delay = delay
+        self._cache = OrderedDict()  # key: path  val: text (None = no file)
+        self._reads = deque()        # (path, callback) to read
+        self._writes = {}            # key: path  val: (text, deadline)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._writing = False  # the worker is writing a note
+        self._quit = False
+
+    def get(self, path, callback):
+        """ Call callback(path, text) with the content of the note
+
+        From the cache the callback is called immediately, otherwise the
+        note is read in the worker thread. text is None for missing files.
+        """
+        with self._cond:
+            hit = path in self._cache
+            if hit:
+                self._cache.move_to_end(path)
+                text = self._cache[path]
+            else:
+                self._reads.append((path, callback))
+                self._start()
+                self._cond.notify_all()
+        if hit:
+            callback(path, text)
+
+    def new(self, path):
+        """ A note not created yet (no file), get() answers at once """
+        with self._cond:
+            if path not in self._cache:
+                self._cache_set(path, None)
+
+    def put(self, path, text):
+        """ Change the content of the note, written later by the worker """
+        with self._cond:
+            self._cache_set(path, text)
+            self._writes[path] = (text, time.monotonic() + self.delay)
+            self._start()
+            self._cond.notify_all()
+
+    def flush(self):
+        """ Write now all the pending notes, return when they are written """
+        with self._cond:
+            if self._thread is not None and not self._quit:
+                # let the worker write them all, to keep the writes ordered
+                for path, (text, _) in self._writes.items():
+                    self._writes[path] = (text, 0)
+                self._cond.notify_all()
+                while self._writes or self._writing:
+                    self._cond.wait()
+                return
+            writes = self._writes
+            self._writes = {}
+        for path, (text, _) in writes.items():
+            note_write(path, text)
+
+    def close(self):
+        """ Write all the pending notes and stop the worker """
+        with self._cond:
+            self._quit = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _cache_set(self, path, text):
+        self._cache[path] = text
+        self._cache.move_to_end(path)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _start(self):
+        if self._thread is None:
+            self._quit = False
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='edone-notes')
+            self._thread.start()
+
+    def _next_job(self):
+        # called with the lock held, wait for something to do
+        while not self._quit:
+            if self._reads:
+                return 'read', self._reads.popleft()
+            now = time.monotonic()
+            due = [ p for p, (_, dl) in self._writes.items() if dl <= now ]
+            if due:
+                path = due[0]
+                text, _ = self._writes.pop(path)
+                self._writing = True
+                return 'write', (path, text)
+            timeout = None
+            if self._writes:
+                timeout = min(dl for _, dl in self._writes.values()) - now
+            self._cond.wait(timeout)
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job, args = self._next_job()
+            if job is None:
+                return
+            if job == 'read':
+                path, callback = args
+                text = note_read(path)
+                with self._cond:
+                    # a pending write is newer than the file content
+                    if path in self._writes:
+                        text = self._writes[path][0]
+                    self._cache_set(path, text)
+                self.post(callback, path, text)
+            else:
+                path, text = args
+                try:
+                    note_write(path, text)
+                except OSError as e:
+                    print('ERROR: Cannot write note "%s": %s' % (path, e))
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
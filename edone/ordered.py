@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The ordered container used for TASKS.
+
+Tasks are stored in slots, in file order. A deleted task just leave an empty
+slot (the slots are compacted when more than half are empty) and a Fenwick
+tree, over the used slots, give the position of a task in the file (and
+the task at a given position) in O(log n).
+
+A task inserted in the middle takes the nearest empty slot, the tasks in
+between are moved by one slot. If there is none nearby the slots are laid
+out again, leaving an empty slot every GAP ones for the next inserts.
+
+Every task get a stable integer id (task._id) when added, to lookup the task
+in O(1). The slot of the task (task._slot) follow the file order, so it can
+be used to sort tasks in file order, but it change on compaction.
+"""
+
+
+GAP = 16  # an empty slot every GAP slots, when laid out for inserts
+
+
+class OrderedTasks(object):
+    """ List-like container of tasks with ids and O(log n) positions """
+
+    def __init__(self):
+        self._slots = []   # tasks in file order (None for deleted ones)
+        self._tree = [0]   # Fenwick tree of used slots (1-based)
+        self._by_id = {}   # key: task_id  val: task
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        for t in self._slots:
+            if t is not None:
+                yield t
+
+    def __contains__(self, task):
+        return self._by_id.get(task._id) is task
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return self._slice(pos)
+        return self._slots[self._slot_find(pos)]
+
+    def __delitem__(self, pos):
+        self._slot_clear(self._slot_find(pos))
+
+    def get(self, task_id):
+        """ The task with the given id (or None) """
+        return self._by_id.get(task_id)
+
+    def index(self, task):
+        """ Position of the task in the file """
+        if task not in self:
+            raise ValueError('%r is not in the list' % task)
+        return self._prefix(task._slot)
+
+    def sorted(self, tasks):
+        """ The given tasks sorted in file order """
+        return sorted(tasks, key=_slot_key)
+
+    def append(self, task):
+        self._id_assign(task)
+        task._slot = len(self._slots)
+        self._slots.append(task)
+
+        # the new node cover the slots (n - lowbit(n), n]
+        n = len(self._slots)
+        self._tree.append(1 + self._prefix(n - 1) - self._prefix(n - (n & -n)))
+
+    def insert(self, pos, task):
+        if pos >= len(self):
+            self.append(task)
+            return
+        self._id_assign(task)
+        slots = self._slots
+        slot = self._slot_find(pos)
+
+        # an empty slot just before the task at pos
+        if slot > 0 and slots[slot - 1] is None:
+            slot -= 1
+            free = slot
+        else:
+            # or the next empty slot, moving the tasks in between
+            free = slot + 1
+            end = min(len(slots), slot + 2 * GAP)
+            while free < end and slots[free] is not None:
+                free += 1
+            if free == end:
+                tasks = list(self)
+                tasks.insert(pos, task)
+                self._rebuild(tasks, gaps=True)
+                return
+            slots[slot + 1:free + 1] = slots[slot:free]
+            for i in range(slot + 1, free + 1):
+                slots[i]._slot = i
+
+        slots[slot] = task
+        task._slot = slot
+        self._update(free, 1)
+
+    def remove(self, task):
+        if task not in self:
+            raise ValueError('%r is not in the list' % task)
+        self._slot_clear(task._slot)
+
+    def clear(self):
+        self._slots = []
+        self._tree = [0]
+        self._by_id = {}
+
+    def _id_assign(self, task):
+        if task._id is None:
+            task._id = self._next_id
+            self._next_id += 1
+        self._by_id[task._id] = task
+
+    def _slot_clear(self, slot):
+        task = self._slots[slot]
+        self._slots[slot] = None
+        del self._by_id[task._id]
+        self._update(slot, -1)
+
+        # compact when more than half of the slots are empty
+        if len(self._slots) > 64 and len(self._by_id) < len(self._slots) // 2:
+            self._rebuild(list(self))
+
+    def _rebuild(self, tasks, gaps=False):
+        if gaps:
+            slots = []
+            for i in range(0, len(tasks), GAP - 1):
+                slots += tasks[i:i + GAP - 1]
+                slots.append(None)
+        else:
+            slots = tasks
+        self._slots = slots
+        tree = [0] * (len(slots) + 1)
+        for i, t in enumerate(slots):
+            if t is not None:
+                t._slot = i
+                tree[i + 1] += 1
+            j = (i + 1) + ((i + 1) & -(i + 1))
+            if j < len(tree):
+                tree[j] += tree[i + 1]
+        self._tree = tree
+
+    def _slice(self, s):
+        start, stop, step = s.indices(len(self))
+        if step != 1:
+            return [ self[i] for i in range(start, stop, step) ]
+        tasks = []
+        if start >= stop:
+            return tasks
+        # walk the slots from the first one, only up to the last task
+        slots = self._slots
+        slot = self._slot_find(start)
+        count = stop - start
+        while len(tasks) < count:
+            t = slots[slot]
+            if t is not None:
+                tasks.append(t)
+            slot += 1
+        return tasks
+
+    ### Fenwick tree ###
+    def _update(self, slot, delta):
+        i = slot + 1
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, n):
+        """ Number of tasks in the first n slots """
+        tree = self._tree
+        count = 0
+        while n > 0:
+            count += tree[n]
+            n -= n & -n
+        return count
+
+    def _slot_find(self, pos):
+        """ The slot of the task at the given position """
+        if pos < 0:
+            pos += len(self)
+        if not 0 <= pos < len(self):
+            raise IndexError('list index out of range')
+        tree = self._tree
+        slot = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            i = slot + step
+            if i < len(tree) and tree[i] <= pos:
+                slot = i
+                pos -= tree[i]
+            step >>= 1
+        return slot
+
+
+def _slot_key(task):
+    return task._slot
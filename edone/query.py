@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Query expressions for the search entry, for example:
+
+    +work @phone pri:A-B -done due:<2026-11-01 "invoice"
+
+Terms are AND-ed, OR (or |) and parenthesis can be used, a leading - negate
+a term. Known terms:
+
+    +project @context       tasks with the tag (or a subtag, as +project.web)
+    done                    completed tasks
+    pri:A  pri:A-C          priority (or priority range)
+    due: t: created: completed:   dates, with optional < <= > >= and the
+                            special values today, tomorrow and yesterday
+    key:value               any other key:value extension (also < <= > >=)
+    word  "some words"      text search (case insensitive)
+
+Queries are parsed into a tree of nodes and compiled into a plan: terms
+that have an index (tags, due and threshold dates, key:values) are
+resolved with lookups and intersected, all the others are applied as
+predicates on the resulting candidates (or on all the tasks).
+"""
+
+import re
+import datetime
+from functools import lru_cache
+
+from edone.tasks import TASKS, TAG_TREE, DUE, THRESHOLD, keys_index, \
+                        value_sort_key
+
+
+class QueryError(Exception):
+    pass
+
+
+_token_re = re.compile(r'-?\(|\)|-?"[^"]*"|[^\s()]+')
+_cmp_re = re.compile(r'(<=|>=|<|>|=)?(.*)$')
+
+DATE_KEYS = {  # key: task attribute
+    'due': 'due',
+    't': 'threshold',
+    'created': 'creation_date',
+    'completed': 'completion_date',
+}
+DATE_INDEXES = { 'due': DUE, 'threshold': THRESHOLD }
+
+
+### AST nodes and their compiled form ###
+# Every node implement:
+#   match(task): the predicate
+#   indexed: True if lookup() can be used
+#   lookup(): the exact set of matching tasks, from the indexes
+#   explain(indent): lines describing the plan
+
+class Node(object):
+    indexed = False
+
+    def explain(self, indent=0):
+        return [ '  ' * indent + 'filter %s' % self ]
+
+
+class All(Node):
+    def match(self, task):
+        return True
+
+    def __str__(self):
+        return 'all'
+
+
+class Text(Node):
+    def __init__(self, text):
+        self.text = text.lower()
+
+    def match(self, task):
+        return self.text in task.raw_txt.lower()
+
+    def __str__(self):
+        return 'text "%s"' % self.text
+
+
+class Tag(Node):
+    indexed = True
+
+    def __init__(self, name):
+        self.name = name
+
+    def match(self, task):
+        return task in TAG_TREE.tasks(self.name)
+
+    def lookup(self):
+        return TAG_TREE.tasks(self.name)
+
+    def explain(self, indent=0):
+        return [ '  ' * indent + 'index tags %s (%d tasks)' %
+                 (self.name, TAG_TREE.count(self.name)) ]
+
+    def __str__(self):
+        return 'tag %s' % self.name
+
+
+class Done(Node):
+    def match(self, task):
+        return task.completed
+
+    def __str__(self):
+        return 'done'
+
+
+class Priority(Node):
+    def __init__(self, first, last):
+        self.first, self.last = first, last
+
+    def match(self, task):
+        return task.priority is not None and \
+               self.first <= task.priority <= self.last
+
+    def __str__(self):
+        return 'pri %s-%s' % (self.first, self.last)
+
+
+def _compare(op, a, b):
+    if op == '<': return a < b
+    if op == '<=': return a <= b
+    if op == '>': return a > b
+    if op == '>=': return a >= b
+    return a == b
+
+
+def _bounds(op, value, next_value):
+    """ The [start, end) range of values for the comparison """
+    if op == '<': return None, value
+    if op == '<=': return None, next_value
+    if op == '>': return next_value, None
+    if op == '>=': return value, None
+    return value, next_value
+
+
+class DateCmp(Node):
+    def __init__(self, attr, op, date):
+        self.attr, self.op, self.date = attr, op, date
+        self.indexed = attr in DATE_INDEXES
+
+    def match(self, task):
+        date = getattr(task, self.attr)
+        return date is not None and _compare(self.op, date.date(), self.date)
+
+    def lookup(self):
+        next_day = self.date + datetime.timedelta(days=1)
+        index = DATE_INDEXES[self.attr]
+        return set(index.range(*_bounds(self.op, self.date, next_day)))
+
+    def explain(self, indent=0):
+        if self.indexed:
+            return [ '  ' * indent + 'index %s (%d tasks)' %
+                     (self, len(self.lookup())) ]
+        return Node.explain(self, indent)
+
+    def __str__(self):
+        return '%s %s %s' % (self.attr, self.op, self.date)
+
+
+class KeyCmp(Node):
+    indexed = True
+
+    def __init__(self, key, op, value):
+        self.key, self.op, self.value = key, op, value
+
+    def match(self, task):
+        value = task.keys.get(self.key)
+        if value is None:
+            return False
+        if self.op == '=':
+            return value == self.value
+        # same ordering used by the index
+        return _compare(self.op, value_sort_key(value),
+                        value_sort_key(self.value))
+
+    def lookup(self):
+        index = keys_index(self.key)
+        if self.op == '<': return index.range(None, self.value)
+        if self.op == '<=': return index.range(None, self.value,
+                                               include_end=True)
+        if self.op == '>': return index.range(self.value, None,
+                                              include_start=False)
+        if self.op == '>=': return index.range(self.value, None)
+        return set(index.get(self.value))
+
+    def explain(self, indent=0):
+        return [ '  ' * indent + 'index %s (%d tasks)' %
+                 (self, len(self.lookup())) ]
+
+    def __str__(self):
+        return 'key %s %s %s' % (self.key, self.op, self.value)
+
+
+class Not(Node):
+    def __init__(self, child):
+        self.child = child
+
+    def match(self, task):
+        return not self.child.match(task)
+
+    def __str__(self):
+        return 'not %s' % self.child
+
+
+class And(Node):
+    def __init__(self, children):
+        self.children = children
+        # children resolved with an index, and children used as predicates
+        self.lookups = [ c for c in children if c.indexed ]
+        self.filters = [ c for c in children if not c.indexed ]
+        self.indexed = not self.filters
+
+    def match(self, task):
+        for child in self.children:
+            if not child.match(task):
+                return False
+        return True
+
+    def lookup(self):
+        # smallest first, stop as soon as the result is empty
+        sets = sorted((c.lookup() for c in self.lookups), key=len)
+        result = set(sets[0])
+        for s in sets[1:]:
+            if not result:
+                break
+            result.intersection_update(s)
+        return result
+
+    def candidates(self):
+        """ The tasks that can match, using only the indexed children """
+        if self.lookups:
+            return self.lookup()
+
+    def explain(self, indent=0):
+        lines = [ '  ' * indent + 'and' ]
+        for child in self.lookups + self.filters:
+            lines += child.explain(indent + 1)
+        return lines
+
+    def __str__(self):
+        return '(%s)' % ' and '.join(str(c) for c in self.children)
+
+
+class Or(Node):
+    def __init__(self, children):
+        self.children = children
+        self.indexed = all(c.indexed for c in children)
+
+    def match(self, task):
+        for child in self.children:
+            if child.match(task):
+                return True
+        return False
+
+    def lookup(self):
+        result = set()
+        for child in self.children:
+            result |= child.lookup()
+        return result
+
+    def explain(self, indent=0):
+        if not self.indexed:
+            return Node.explain(self, indent)
+        lines = [ '  ' * indent + 'union' ]
+        for child in self.children:
+            lines += child.explain(indent + 1)
+        return lines
+
+    def __str__(self):
+        return '(%s)' % ' or '.join(str(c) for c in self.children)
+
+
+### parser ###
+
+def _date_parse(value, today):
+    if value == 'today': return today
+    if value == 'tomorrow': return today + datetime.timedelta(days=1)
+    if value == 'yesterday': return today - datetime.timedelta(days=1)
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise QueryError('Invalid date: %s' % value)
+
+
+def _term_parse(word, today):
+    if word.startswith('"'):
+        return Text(word.strip('"'))
+
+    if word[0] in '+@' and len(word) > 1:
+        return Tag(word)
+
+    if word == 'done':
+        return Done()
+
+    key, sep, value = word.partition(':')
+    if sep and value:
+        if key == 'pri':
+            first, _, last = value.upper().partition('-')
+            if not re.match('[A-Z]$', first) or \
+               (last and not re.match('[A-Z]$', last)):
+                raise QueryError('Invalid priority: %s' % value)
+            return Priority(first, last or first)
+
+        op, value = _cmp_re.match(value).groups()
+        op = op or '='
+        if key in DATE_KEYS:
+            return DateCmp(DATE_KEYS[key], op, _date_parse(value, today))
+        if value and not value.startswith('/') and re.match('[A-Za-z]', key):
+            return KeyCmp(key, op, value)
+
+    return Text(word)
+
+
+def parse(text, today=None):
+    """ Parse the query text into a tree of nodes """
+    today = today or datetime.date.today()
+    tokens = _token_re.findall(text)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def expr():
+        children = [ and_expr() ]
+        while peek() in ('OR', '|'):
+            pos[0] += 1
+            children.append(and_expr())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def and_expr():
+        children = []
+        while peek() not in (None, ')', 'OR', '|'):
+            children.append(unary())
+        if not children:
+            raise QueryError('Empty expression')
+        return children[0] if len(children) == 1 else And(children)
+
+    def unary():
+        tok = tokens[pos[0]]
+        pos[0] += 1
+        if tok in ('(', '-('):
+            node = expr()
+            if peek() != ')':
+                raise QueryError('Missing closing parenthesis')
+            pos[0] += 1
+            return Not(node) if tok == '-(' else node
+        if tok.startswith('-') and len(tok) > 1:
+            return Not(_term_parse(tok[1:], today))
+        return _term_parse(tok, today)
+
+    if not tokens:
+        return All()
+    node = expr()
+    if peek() is not None:
+        raise QueryError('Unexpected "%s"' % peek())
+    return node
+
+
+### compiled queries ###
+
+class Query(object):
+    """ A compiled query, with its execution plan """
+
+    def __init__(self, text, root):
+        self.text = text
+        self.root = root
+
+    def match(self, task):
+        return self.root.match(task)
+
+    def candidates(self):
+        """ Set of tasks that can match (from the indexes), None for all """
+        if isinstance(self.root, And):
+            return self.root.candidates()
+        if self.root.indexed:
+            return self.root.lookup()
+
+    def run(self):
+        """ The matching tasks, in file order """
+        if self.root.indexed:
+            found = self.root.lookup()
+        else:
+            candidates = self.candidates()
+            if candidates is None:
+                return [ t for t in TASKS if self.root.match(t) ]
+            found = [ t for t in candidates if self.root.match(t) ]
+        return TASKS.sorted(found)
+
+    def explain(self):
+        """ Text description of the plan chosen for this query """
+        lines = [ 'query: %s' % self.text ]
+        candidates = self.candidates()
+        if candidates is None:
+            lines.append('scan all the tasks (%d)' % len(TASKS))
+        else:
+            lines.append('index lookups (%d candidates)' % len(candidates))
+        lines += self.root.explain(1)
+        return '\n'.join(lines)
+
+
+@lru_cache(maxsize=64)
+def _compile(text, today):
+    return Query(text, parse(text, today))
+
+
+def compile(text):
+    """ Compile (or get from the cache) the query for the given text
+
+    Relative dates (today, tomorrow...) are resolved at compile time, so the
+    cache is also keyed by the current day. Raise QueryError.
+    """
+    return _compile(text.strip(), datetime.date.today())
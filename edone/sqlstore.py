@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+SQLite storage, for very big task sets (see tasks.TextStorage).
+
+The database keeps all the tasks with indexed columns for priority,
+completion, dates, tags and key:values, so the filters, the sorting and the
+search queries of the gui run in SQL. The storage is also an index (see
+tasks.INDEXES): changed tasks are written to the database, in a transaction
+that is committed on save, so only the changed rows are ever written.
+
+The todo.txt files are a mirror of the database, rewritten by a background
+thread after every save, so the other Todo.txt clients still work. A file
+changed by another client is merged at the next save (as by TextStorage), or
+imported again at the next load.
+"""
+
+import os
+import sqlite3
+import datetime
+import threading
+
+from edone.tasks import TASKS, INDEXES, Task, index_register, index_unregister, \
+                        model_reset, model_fill, mark_saved, tasks_read, \
+                        value_sort_key, due_range, merge_from_file, FileLock
+from edone import query
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    seq REAL NOT NULL,        -- order of the tasks in their file
+    file TEXT NOT NULL,
+    raw TEXT NOT NULL,
+    search TEXT NOT NULL,     -- lowercase raw text, for the text search
+    done INTEGER NOT NULL,
+    priority TEXT,
+    created TEXT,             -- dates are YYYY-MM-DD strings
+    completed TEXT,
+    due TEXT,
+    threshold TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_file ON tasks (file, seq);
+CREATE INDEX IF NOT EXISTS tasks_done ON tasks (done);
+CREATE INDEX IF NOT EXISTS tasks_priority ON tasks (priority);
+CREATE INDEX IF NOT EXISTS tasks_created ON tasks (created);
+CREATE INDEX IF NOT EXISTS tasks_completed ON tasks (completed);
+CREATE INDEX IF NOT EXISTS tasks_due ON tasks (due);
+CREATE INDEX IF NOT EXISTS tasks_threshold ON tasks (threshold);
+
+CREATE TABLE IF NOT EXISTS tags (
+    task_id INTEGER NOT NULL,
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag, task_id);
+CREATE INDEX IF NOT EXISTS tags_task ON tags (task_id);
+
+CREATE TABLE IF NOT EXISTS keys (
+    task_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    num REAL                  -- the value, if it is a number
+);
+CREATE INDEX IF NOT EXISTS keys_key ON keys (key, num, value);
+CREATE INDEX IF NOT EXISTS keys_task ON keys (task_id);
+
+-- the todo.txt mirrors, as last written (or imported)
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+'''
+
+DATE_COLUMNS = {  # key: task attribute (see query.DATE_KEYS)  val: column
+    'creation_date': 'created',
+    'completion_date': 'completed',
+    'due': 'due',
+    'threshold': 'threshold',
+}
+
+
+def _day(date):
+    return date.strftime('%Y-%m-%d') if date else None
+
+
+def _file_stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+### search queries ###
+
+def tags_sql(names):
+    """ Condition for the tasks with one of the tags, or of their subtags """
+    conds, params = [], []
+    for name in sorted(names):
+        # '/' follows '.', the range holds all the names starting with 'name.'
+        conds.append('tag = ? OR (tag >= ? AND tag < ?)')
+        params += [name, name + '.', name + '/']
+    return 'id IN (SELECT task_id FROM tags WHERE %s)' % \
+           ' OR '.join(conds), params
+
+
+def node_sql(node):
+    """ SQL condition (and its params) equivalent to the query node
+
+    Conditions never evaluate to NULL, so NOT works as in query.Not.
+    """
+    if isinstance(node, query.All):
+        return '1', []
+    if isinstance(node, query.Text):
+        return 'instr(search, ?) > 0', [node.text]
+    if isinstance(node, query.Tag):
+        return tags_sql([node.name])
+    if isinstance(node, query.Done):
+        return 'done = 1', []
+    if isinstance(node, query.Priority):
+        return 'coalesce(priority BETWEEN ? AND ?, 0)', [node.first, node.last]
+    if isinstance(node, query.DateCmp):
+        return 'coalesce(%s %s ?, 0)' % (DATE_COLUMNS[node.attr], node.op), \
+               [node.date.isoformat()]
+    if isinstance(node, query.KeyCmp):
+        cond, params = _key_sql(node.op, node.value)
+        return 'id IN (SELECT task_id FROM keys WHERE key = ? AND %s)' % cond, \
+               [node.key] + params
+    if isinstance(node, query.Not):
+        cond, params = node_sql(node.child)
+        return 'NOT (%s)' % cond, params
+    if isinstance(node, (query.And, query.Or)):
+        parts = [ node_sql(c) for c in node.children ]
+        sep = ' AND ' if isinstance(node, query.And) else ' OR '
+        return sep.join('(%s)' % c for c, _ in parts), \
+               [ p for _, params in parts for p in params ]
+    raise ValueError('Unknown query node: %r' % node)
+
+
+def _key_sql(op, value):
+    # same order of value_sort_key: numbers (by value) before strings
+    if op == '=':
+        return 'value = ?', [value]
+    kind, num, _ = value_sort_key(value)
+    if kind == 0:
+        if op in ('<', '<='):
+            return 'num %s ?' % op, [num]
+        return '(num %s ? OR num IS NULL)' % op, [num]
+    if op in ('<', '<='):
+        return '(num IS NOT NULL OR value %s ?)' % op, [value]
+    return '(num IS NULL AND value %s ?)' % op, [value]
+
+
+### the todo.txt mirror ###
+
+class _Mirror(object):
+    """ Rewrite the todo.txt files from the database, in a worker thread """
+
+    def __init__(self, db_path, errors):
+        self.db_path = db_path
+        self.errors = errors
+        self.written = {}  # key: path  val: ((mtime_ns, size), save) written
+        self._paths = None # files to write at the next run
+        self._writing = set() # files of the current run
+        self._cond = threading.Condition()
+        self._thread = None
+        self._quit = False
+
+    def schedule(self, paths):
+        with self._cond:
+            self._paths = set(paths) | (self._paths or set())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='edone-mirror')
+                self._thread.start()
+            self._cond.notify_all()
+
+    def written_pop(self):
+        """ The files written since the last call, and the ones still to write
+
+        save is the number of the save (see SqliteStorage.saves) whose
+        content was written.
+        """
+        with self._cond:
+            written, self.written = self.written, {}
+            return written, (self._paths or set()) | self._writing
+
+    def close(self):
+        """ Wait for the pending writes and stop the worker """
+        with self._cond:
+            self._quit = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        db = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            while True:
+                with self._cond:
+                    while self._paths is None and not self._quit:
+                        self._cond.wait()
+                    if self._paths is None:
+                        return
+                    paths, self._paths = self._paths, None
+                    self._writing = paths
+                for path in paths:
+                    try:
+                        self._write(db, path)
+                    except (OSError, sqlite3.Error) as e:
+                        print('ERROR: Cannot write mirror "%s": %s' % (path, e))
+                    finally:
+                        if db.in_transaction:
+                            db.execute('ROLLBACK')
+                with self._cond:
+                    self._writing = set()
+        finally:
+            db.close()
+
+    def _write(self, db, path):
+        # never overwrite the changes made by others since our last write,
+        # the next save merges them (see SqliteStorage.save)
+        with self._cond:
+            known = self.written.get(path)
+        if known is not None:
+            known = known[0]
+        else:
+            known = db.execute('SELECT mtime_ns, size FROM files WHERE path = ?',
+                               (path,)).fetchone()
+        stat = _file_stat(path)
+        if stat is not None and (known is None or tuple(known) != stat):
+            print('WARNING: File changed by another program, not written: '
+                  '"%s"' % path)
+            return
+
+        # the rows and the number of the save they come from, in one read
+        db.execute('BEGIN')
+        save = db.execute('PRAGMA user_version').fetchone()[0]
+        rows = db.execute('SELECT raw FROM tasks WHERE file = ? ORDER BY seq',
+                          (path,))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for raw, in rows:
+                f.write(raw.encode('utf-8', self.errors))
+                f.write(b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        db.execute('COMMIT')
+
+        # check again while holding the lock
+        with FileLock(path):
+            if _file_stat(path) != stat:
+                os.remove(tmp)
+                print('WARNING: File changed by another program, not '
+                      'written: "%s"' % path)
+                return
+            os.replace(tmp, path)
+        with self._cond:
+            self.written[path] = (_file_stat(path), save)
+
+
+### the storage ###
+
+class SqliteStorage(object):
+    """ Tasks stored in a SQLite database, with todo.txt mirrors """
+    queries = True
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.ids = {}       # key: task  val: row id
+        self.tasks = {}     # key: row id  val: task
+        self.seqs = {}      # key: task  val: seq
+        self.changed = set()  # tasks to write
+        self.deleted = set()  # row ids to delete
+        self.mirror = None
+        self.bases = {}     # key: path  val: the lines of the mirror as written
+        self._pending = {}  # key: path  val: [(save, lines)] not yet written
+        self.saves = 0      # number of the last save (PRAGMA user_version)
+        self._next_id = 1
+        self._paths = []
+
+    ### index interface (see tasks.INDEXES) ###
+    def clear(self):
+        self.changed = set()
+        self.deleted = set()
+
+    def add(self, task):
+        self.changed.add(task)
+        self.deleted.discard(self.ids.get(task))
+
+    def remove(self, task):
+        self.changed.discard(task)
+        if task in self.ids:
+            self.deleted.add(self.ids[task])
+
+    ### storage interface ###
+    def load(self, paths, errors='replace'):
+        """ Load the tasks of the given files from the database
+
+        Files never seen before, or changed by another program after the
+        last mirror write, are (re)imported.
+        """
+        if self in INDEXES:
+            index_unregister(self)
+        if self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+        if self.mirror is not None:
+            self.mirror.close()
+            self._files_update()
+        self.mirror = _Mirror(self.db_path, errors)
+        self._paths = list(paths)
+        self.bases = {}
+        self._pending = {}
+        self.saves = self.db.execute('PRAGMA user_version').fetchone()[0]
+
+        model_reset(paths, errors)
+        self.ids = {}
+        self.tasks = {}
+        self.seqs = {}
+        self.clear()
+        self._next_id = self.db.execute(
+            'SELECT coalesce(max(id), 0) + 1 FROM tasks').fetchone()[0]
+
+        known = dict((p, (m, s)) for p, m, s in
+                     self.db.execute('SELECT path, mtime_ns, size FROM files'))
+        for path in paths:
+            stat = _file_stat(path)
+            if stat is not None and known.get(path) != stat:
+                self._import(path, errors, stat)
+
+        print('Loading tasks from database: "%s"' % self.db_path)
+        seq = None
+        ordered = True
+        for path in paths:
+            tasks = []
+            for rowid, row_seq, raw in self.db.execute(
+                    'SELECT id, seq, raw FROM tasks WHERE file = ? '
+                    'ORDER BY seq', (path,)):
+                t = Task(raw, path)
+                self.ids[t] = rowid
+                self.tasks[rowid] = t
+                self.seqs[t] = row_seq
+                if seq is not None and row_seq <= seq:
+                    ordered = False
+                seq = row_seq
+                tasks.append(t)
+            model_fill(tasks)
+            self.bases[path] = [ t._raw_txt for t in tasks ]
+
+        # seq must follow the order of TASKS (files order)
+        if not ordered:
+            self._renumber()
+        index_register(self)
+        self.clear()
+
+    def _import(self, path, errors, stat):
+        print('Importing tasks from file: "%s"' % path)
+        self.db.execute('BEGIN')
+        self._rows_delete([ rowid for rowid, in self.db.execute(
+                            'SELECT id FROM tasks WHERE file = ?', (path,)) ])
+        seq = self.db.execute('SELECT coalesce(max(seq), 0) FROM tasks') \
+                     .fetchone()[0]
+        rows = []
+        for t in tasks_read(path, errors):
+            seq += 1.0
+            rows.append((self._next_id, seq, t))
+            self._next_id += 1
+            if len(rows) >= 10000:
+                self._rows_insert(rows)
+                rows = []
+        self._rows_insert(rows)
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                        (path,) + stat)
+        self.db.execute('COMMIT')
+
+    def sync(self):
+        """ Write the changed tasks in the (not yet committed) transaction """
+        if not self.changed and not self.deleted:
+            return
+        if not self.db.in_transaction:
+            self.db.execute('BEGIN')
+
+        for rowid in self.deleted:
+            task = self.tasks.pop(rowid)
+            del self.ids[task]
+            del self.seqs[task]
+        self._rows_delete(self.deleted)
+
+        old = [ t for t in self.changed if t in self.ids ]
+        self._rows_delete([ self.ids[t] for t in old ], tasks=False)
+        self.db.executemany(
+            'UPDATE tasks SET file = ?, raw = ?, search = ?, done = ?, '
+            'priority = ?, created = ?, completed = ?, due = ?, threshold = ? '
+            'WHERE id = ?', [ self._values(t) + (self.ids[t],) for t in old ])
+        self._children_insert([ (self.ids[t], t) for t in old ])
+
+        new = TASKS.sorted(t for t in self.changed if t not in self.ids)
+        rows = []
+        for t, seq in zip(new, self._seqs_new(new)):
+            rows.append((self._next_id, seq, t))
+            self.ids[t] = self._next_id
+            self.tasks[self._next_id] = t
+            self.seqs[t] = seq
+            self._next_id += 1
+        self._rows_insert(rows)
+
+        self.changed = set()
+        self.deleted = set()
+
+    def save(self):
+        """ Commit the changes and update the mirrors in background
+
+        The files changed by others since the last mirror write are merged
+        first (see tasks.merges_pop).
+        """
+        print('Saving tasks to database: "%s"' % self.db_path)
+        if not self.db.in_transaction:
+            self.db.execute('BEGIN')
+        writing = self._files_update()
+        self._files_merge(writing)
+
+        changed = set(t._file for t in self.changed)
+        changed.update(self.tasks[rowid]._file for rowid in self.deleted)
+        self.sync()
+        self.saves += 1
+        self.db.execute('PRAGMA user_version = %d' % self.saves)
+        self.db.execute('COMMIT')
+        mark_saved()
+
+        # the lines the mirrors will have, once this save is written
+        lines = dict((path, []) for path in changed)
+        for t in TASKS:
+            if t._file in lines:
+                lines[t._file].append(t._raw_txt)
+        for path in changed:
+            self._pending.setdefault(path, []).append((self.saves, lines[path]))
+        self.mirror.schedule(self._paths)
+        return list(self._paths)
+
+    def close(self):
+        """ Wait for the mirrors, the uncommitted changes are discarded """
+        if self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+        if self.mirror is not None:
+            self.mirror.close()
+            self._files_update()
+        self.db.close()
+
+    def _files_update(self):
+        # remember the mirrors as written, to detect changes by others,
+        # return the files still to write
+        written, writing = self.mirror.written_pop()
+        for path, (stat, save) in written.items():
+            if stat is not None:
+                self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                                (path,) + stat)
+            # the file has the lines of the last save up to the written one
+            pending = self._pending.pop(path, [])
+            for s, lines in pending:
+                if s <= save:
+                    self.bases[path] = lines
+            pending = [ (s, lines) for s, lines in pending if s > save ]
+            if pending:
+                self._pending[path] = pending
+        return writing
+
+    def _files_merge(self, writing=()):
+        # merge the files changed by others since the last mirror write
+        # (the ones being written are checked by the mirror itself)
+        known = dict((p, (m, s)) for p, m, s in
+                     self.db.execute('SELECT path, mtime_ns, size FROM files'))
+        for path in self._paths:
+            if path in writing:
+                continue
+            stat = _file_stat(path)
+            if stat is not None and known.get(path) != stat:
+                merge_from_file(path, self.bases.get(path, []))
+                self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                                (path,) + stat)
+
+    ### rows ###
+    def _values(self, t):
+        return (t._file, t._raw_txt, t._raw_txt.lower(), int(bool(t.completed)),
+                t.priority, _day(t.creation_date), _day(t.completion_date),
+                _day(t.due), _day(t.threshold))
+
+    def _rows_insert(self, rows):
+        """ Insert the given (id, seq, task) """
+        self.db.executemany(
+            'INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [ (rowid, seq) + self._values(t) for rowid, seq, t in rows ])
+        self._children_insert([ (rowid, t) for rowid, _, t in rows ])
+
+    def _children_insert(self, rows):
+        """ Insert the tags and the key:values of the given (id, task) """
+        self.db.executemany('INSERT INTO tags VALUES (?, ?)',
+            [ (rowid, tag) for rowid, t in rows
+              for tag in t.projects + t.contexts ])
+        keys = []
+        for rowid, t in rows:
+            for key, value in t._keys.items():
+                kind, num, _ = value_sort_key(value)
+                keys.append((rowid, key, value, num if kind == 0 else None))
+        self.db.executemany('INSERT INTO keys VALUES (?, ?, ?, ?)', keys)
+
+    def _rows_delete(self, rowids, tasks=True):
+        params = [ (i,) for i in rowids ]
+        self.db.executemany('DELETE FROM tags WHERE task_id = ?', params)
+        self.db.executemany('DELETE FROM keys WHERE task_id = ?', params)
+        if tasks:
+            self.db.executemany('DELETE FROM tasks WHERE id = ?', params)
+
+    def _seqs_new(self, new):
+        """ Seqs for the new tasks (in file order), between the tasks around
+
+        Every run of new tasks at consecutive positions gets seqs evenly
+        spaced between the ones of the tasks before and after the run.
+        """
+        pos = [ TASKS.index(t) for t in new ]
+        seqs = []
+        i = 0
+        while i < len(new):
+            j = i + 1
+            while j < len(new) and pos[j] == pos[j - 1] + 1:
+                j += 1
+            prev = self.seqs[TASKS[pos[i] - 1]] if pos[i] > 0 else 0.0
+            if pos[j - 1] + 1 < len(TASKS):
+                after = self.seqs[TASKS[pos[j - 1] + 1]]
+            else:
+                after = prev + j - i + 1.0
+            step = (after - prev) / (j - i + 1)
+            run = [ prev + step * (k + 1) for k in range(j - i) ]
+            if not prev < run[0] < after or not run[-1] < after or \
+               any(a >= b for a, b in zip(run, run[1:])):
+                # no more room between the two: number all the tasks again
+                self._renumber()
+                return self._seqs_new(new)
+            seqs += run
+            i = j
+        return seqs
+
+    def _renumber(self):
+        seqs = []
+        for i, t in enumerate(TASKS):
+            if t in self.seqs:
+                self.seqs[t] = float(i + 1)
+                seqs.append((float(i + 1), self.ids[t]))
+        own = not self.db.in_transaction
+        if own:
+            self.db.execute('BEGIN')
+        self.db.executemany('UPDATE tasks SET seq = ? WHERE id = ?', seqs)
+        if own:
+            self.db.execute('COMMIT')
+
+    ### gui queries ###
+    def filtered(self, q, view, projects, contexts, files, due_view,
+                 hide_future, sort_by, prj_facet, ctx_facet):
+        """ Run the gui filters in SQL (see gui.TasksList._filtered_tasks)
+
+        Return the ordered list of visible tasks and the sets of tasks for
+        the projects and contexts facets (None if not requested).
+        """
+        self.sync()
+        today = datetime.date.today()
+        f0, p0 = [], []
+        if view == 'done':
+            f0.append('done = 1')
+        elif view == 'todo':
+            f0.append('done = 0')
+        if q is not None:
+            cond, params = node_sql(q.root)
+            f0.append(cond)
+            p0 += params
+        if hide_future:
+            f0.append('coalesce(threshold <= ?, 1)')
+            p0.append(today.isoformat())
+        if due_view != 'all':
+            start, end = due_range(due_view, today)
+            f0.append('due IS NOT NULL')
+            if start is not None:
+                f0.append('due >= ?')
+                p0.append(start.isoformat())
+            if end is not None:
+                f0.append('due < ?')
+                p0.append(end.isoformat())
+            if due_view == 'overdue':
+                f0.append('done = 0')
+        if files is not None:
+            f0.append('file IN (%s)' % ', '.join('?' * len(files)))
+            p0 += sorted(files)
+
+        f1, p1, f2, p2 = [], [], [], []
+        if contexts:
+            c, p1 = tags_sql(contexts)
+            f1.append(c)
+        if projects:
+            c, p2 = tags_sql(projects)
+            f2.append(c)
+
+        order = 'raw, seq' if sort_by == 'pri' else 'seq'
+        visible = [ self.tasks[i] for i in
+                    self._select(f0 + f1 + f2, p0 + p1 + p2, order) ]
+        prj_base = set(self.tasks[i] for i in
+                       self._select(f0 + f1, p0 + p1)) if prj_facet else None
+        ctx_base = set(self.tasks[i] for i in
+                       self._select(f0 + f2, p0 + p2)) if ctx_facet else None
+        return visible, prj_base, ctx_base
+
+    def _select(self, conds, params, order=None):
+        sql = 'SELECT id FROM tasks'
+        if conds:
+            sql += ' WHERE ' + ' AND '.join('(%s)' % c for c in conds)
+        if order:
+            sql += ' ORDER BY ' + order
+        return [ rowid for rowid, in self.db.execute(sql, params) ]
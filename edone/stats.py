@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Completion history: tasks created and completed per day, in total and for
+every +project and @context (subtags also count for their parents).
+
+The daily counts (rollups) of every file are arrays of counters, updated as
+the tasks change (Rollups is one of the tasks indexes). Each file has its
+own cache file, in the cache folder, with the size and mtime of the file it
+comes from: files not in the view (as the done.txt archive) are parsed again
+only when changed, and the totals are always ready to be shown.
+
+Cache files format: a magic line, a json line (the file path and stat, and
+the name, first day and number of days of every series) followed by the
+zlib compressed int32 counters of the series (created then completed).
+"""
+
+import os
+import sys
+import json
+import zlib
+import hashlib
+import datetime
+from array import array
+
+from edone.tasks import tasks_read, tag_parents, tags_ids, TAG_NAMES
+
+
+CACHE_MAGIC = b'edone rollups 1\n'
+
+# tasks created and completed per day, as bars of 8 levels
+BARS = ' ▁▂▃▄▅▆▇█'
+
+
+def archive_path(txt_file):
+    """ The done.txt archive next to the given todo.txt file """
+    return os.path.join(os.path.dirname(txt_file), 'done.txt')
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+_names_cache = {}  # key: packed tags  val: series names
+
+
+def _series_names(tags):
+    """ '' (all the tasks) and every tag (packed), with their parents """
+    try:
+        return _names_cache[tags]
+    except KeyError:
+        names = {''}
+        for i in tags_ids(tags):
+            tag = TAG_NAMES[i]
+            names.add(tag)
+            names.update(tag_parents(tag))
+        names = _names_cache[tags] = tuple(names)
+        return names
+
+
+def _block_add(block, tags, created, completed, n):
+    """ Count n tasks (with the given tags and dates) in the block """
+    created = created.toordinal() if created else None
+    completed = completed.toordinal() if completed else None
+    for name in _series_names(tags):
+        series = block.get(name)
+        if series is None:
+            series = block[name] = Series()
+        series.add(created, completed, n)
+
+
+class Series(object):
+    """ Tasks created and completed per day, from the day first (ordinal) """
+    __slots__ = ('first', 'created', 'completed')
+
+    def __init__(self, first=0, created=None, completed=None):
+        self.first = first
+        self.created = created if created is not None else array('i')
+        self.completed = completed if completed is not None else array('i')
+
+    def add(self, created, completed, n=1):
+        """ Count n tasks created and/or completed (ordinals or None) """
+        if created is not None:
+            i = created - self.first
+            if not 0 <= i < len(self.created):
+                i = self._fit(created)
+            self.created[i] += n
+        if completed is not None:
+            i = completed - self.first
+            if not 0 <= i < len(self.completed):
+                i = self._fit(completed)
+            self.completed[i] += n
+
+    def _fit(self, day):
+        """ Grow the arrays (with some room) to hold day, return its index """
+        size = len(self.created)
+        if size == 0:
+            self.first = day
+            self._grow(0, 1)
+        elif day < self.first:
+            self._grow(max(self.first - day, size // 2), 0)
+        else:
+            self._grow(0, max(day - self.first - size + 1, size // 2))
+        return day - self.first
+
+    def _grow(self, before, after):
+        if before:
+            self.created[0:0] = array('i', bytes(4 * before))
+            self.completed[0:0] = array('i', bytes(4 * before))
+            self.first -= before
+        if after:
+            self.created.frombytes(bytes(4 * after))
+            self.completed.frombytes(bytes(4 * after))
+
+    def trimmed(self):
+        """ (first, created, completed) without the empty days at the ends """
+        size = len(self.created)
+        i = 0
+        while i < size and not (self.created[i] or self.completed[i]):
+            i += 1
+        j = size
+        while j > i and not (self.created[j - 1] or self.completed[j - 1]):
+            j -= 1
+        return self.first + i, self.created[i:j], self.completed[i:j]
+
+    def days(self, kind, start, end):
+        """ The counters (kind: 'created' or 'completed') of [start, end) """
+        counts = getattr(self, kind)
+        i, j = start - self.first, end - self.first
+        head = [0] * min(max(-i, 0), end - start)
+        body = counts[max(i, 0):max(j, 0)].tolist()
+        return head + body + [0] * (end - start - len(head) - len(body))
+
+    def total(self, kind, start, end):
+        counts = getattr(self, kind)
+        i, j = max(start - self.first, 0), max(end - self.first, 0)
+        return sum(counts[i:j])
+
+
+class Rollups(object):
+    """ Daily counters of the tasks of every file
+
+    As an index it keeps the counters of the loaded files (live), the ones
+    of the other files (the archive) are read from the cache or parsed.
+    Changes are queued (with the values of the task at that time) and
+    counted at the next read, a whole load is counted in a single pass.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.blocks = {}   # key: file path  val: {series name: Series}
+        self.stats = {}    # key: file path  val: stat of the file as counted
+                           #                      (None: unsaved changes)
+        self.live = set()  # paths of the files loaded in TASKS
+        self.written = {}  # key: file path  val: stat saved in the cache
+        self.pending = []  # (path, tags, created, completed, n) to count
+
+    ### index interface ###
+    def clear(self):
+        for path in self.live:
+            self.blocks.pop(path, None)
+            self.stats.pop(path, None)
+        self.live.clear()
+        self.pending = []
+
+    def add(self, task):
+        self._count(task, 1)
+
+    def remove(self, task):
+        self._count(task, -1)
+
+    def _count(self, task, n):
+        created = task._creation_date
+        completed = task._completion_date
+        if created is not None or completed is not None:
+            self.pending.append((task._file, task._tags, created, completed, n))
+            self.stats[task._file] = None
+
+    def _apply(self):
+        """ Count the queued changes """
+        pending, self.pending = self.pending, []
+        for path, tags, created, completed, n in pending:
+            block = self.blocks.get(path) if path in self.live else None
+            if block is None:
+                block = self._live_add(path)
+            _block_add(block, tags, created, completed, n)
+
+    def _live_add(self, path):
+        # the counters of the file on disk (if any) are replaced
+        self.live.add(path)
+        self.stats.setdefault(path, None)
+        block = self.blocks[path] = {}
+        return block
+
+    ### totals ###
+    def names(self):
+        """ The names of all the series ('', +projects and @contexts) """
+        if self.pending:
+            self._apply()
+        return set().union(*self.blocks.values())
+
+    def total(self, name, kind, start, end):
+        """ Tasks created or completed (kind) in [start, end) (ordinals) """
+        if self.pending:
+            self._apply()
+        return sum(block[name].total(kind, start, end)
+                   for block in self.blocks.values() if name in block)
+
+    def days(self, name, kind, start, end):
+        """ Tasks created or completed (kind) in every day of [start, end) """
+        if self.pending:
+            self._apply()
+        counts = [0] * (end - start)
+        for block in self.blocks.values():
+            if name in block:
+                for i, n in enumerate(block[name].days(kind, start, end)):
+                    counts[i] += n
+        return counts
+
+    ### files ###
+    def loaded(self, paths):
+        """ The given files have just been loaded (in TASKS) """
+        for path in paths:
+            if path not in self.live:
+                self._live_add(path)
+            self.stats[path] = _stat(path)
+
+    def saved(self, paths):
+        """ The given files have been saved, with all their changes """
+        for path in paths:
+            if path in self.live and self.stats.get(path) is None:
+                self.stats[path] = _stat(path)
+
+    def archive(self, paths, errors='replace', rebuild=False):
+        """ Count also the given files, that are not loaded
+
+        Their counters are read from the cache, or (if the file changed
+        since, or rebuild is True) counted again parsing the file. The
+        counters of the other files not loaded are dropped.
+        """
+        for path in set(self.blocks) - self.live - set(paths):
+            del self.blocks[path]
+            self.stats.pop(path, None)
+        for path in paths:
+            if path in self.live:
+                continue
+            stat = _stat(path)
+            if stat is None:
+                self.blocks.pop(path, None)
+                self.stats.pop(path, None)
+            elif rebuild or path not in self.blocks or \
+                 self.stats.get(path) != stat:
+                block = None if rebuild else self._read(path, stat)
+                if block is None:
+                    block = self._parse(path, errors)
+                self.blocks[path] = block
+                self.stats[path] = stat
+
+    def _parse(self, path, errors):
+        print('Counting tasks in file: "%s"' % path)
+        block = {}
+        for t in tasks_read(path, errors):
+            if t._creation_date is not None or t._completion_date is not None:
+                _block_add(block, t._tags, t._creation_date,
+                           t._completion_date, 1)
+        return block
+
+    ### cache ###
+    def _cache_file(self, path):
+        key = hashlib.blake2b(os.path.abspath(path).encode('utf-8', 'replace'),
+                              digest_size=12).hexdigest()
+        return os.path.join(self.cache_dir, key + '.rollups')
+
+    def _read(self, path, stat):
+        """ The block of path from the cache (None if missing or stale) """
+        try:
+            with open(self._cache_file(path), 'rb') as f:
+                if f.readline() != CACHE_MAGIC:
+                    return None
+                header = json.loads(f.readline().decode('utf-8'))
+                if header['path'] != path or header['stat'] != stat:
+                    return None
+                data = zlib.decompress(f.read())
+        except (OSError, ValueError, KeyError, zlib.error):
+            return None
+
+        counts = array('i', data)
+        if sys.byteorder == 'big':
+            counts.byteswap()
+        block = {}
+        pos = 0
+        for name, first, days in header['series']:
+            block[name] = Series(first, counts[pos:pos + days],
+                                 counts[pos + days:pos + 2 * days])
+            pos += 2 * days
+        self.written[path] = stat
+        return block
+
+    def _cached_stat(self, path):
+        try:
+            with open(self._cache_file(path), 'rb') as f:
+                if f.readline() == CACHE_MAGIC:
+                    return json.loads(f.readline().decode('utf-8'))['stat']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def flush(self):
+        """ Write the cache of the files counted as they are on disk """
+        if self.pending:
+            self._apply()
+        for path, stat in self.stats.items():
+            if stat is not None and path not in self.written:
+                # already in the cache from a previous run?
+                self.written[path] = self._cached_stat(path)
+            if stat is not None and self.written.get(path) != stat:
+                try:
+                    self._write(path, stat)
+                except OSError as e:
+                    print('WARNING: Cannot write the stats cache: %s' % e)
+                    return
+
+    def _write(self, path, stat):
+        series = []
+        counts = array('i')
+        for name, s in sorted(self.blocks[path].items()):
+            first, created, completed = s.trimmed()
+            if created:
+                series.append([name, first, len(created)])
+                counts.extend(created)
+                counts.extend(completed)
+        if sys.byteorder == 'big':
+            counts.byteswap()
+        header = {'path': path, 'stat': stat, 'series': series}
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fname = self._cache_file(path)
+        with open(fname + '.tmp', 'wb') as f:
+            f.write(CACHE_MAGIC)
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(zlib.compress(counts.tobytes()))
+        os.replace(fname + '.tmp', fname)
+        self.written[path] = stat
+
+
+def report(rollups, today=None, days=28, top=10):
+    """ The stats of the last days, as lines of text
+
+    Only the last days of every series are read (in every file), the time
+    does not depend on the number of tasks (nor on how old they are).
+    """
+    today = today or datetime.date.today()
+    end = today.toordinal() + 1
+    start = end - days
+    week = end - 7
+    total = rollups.total
+
+    lines = [ 'Last %d days: %d created, %d completed' %
+              (days, total('', 'created', start, end),
+               total('', 'completed', start, end)) ]
+    if days > 7:
+        lines.append('Last 7 days: %d created, %d completed' %
+                     (total('', 'created', week, end),
+                      total('', 'completed', week, end)))
+    lines.append('')
+    for kind in 'created', 'completed':
+        counts = rollups.days('', kind, start, end)
+        high = max(counts) or 1
+        lines.append('%-10s %s' % (kind, ''.join(
+                     BARS[(n * 8 + high - 1) // high] for n in counts)))
+
+    for title, sigil in ('Projects', '+'), ('Contexts', '@'):
+        rows = []
+        for name in rollups.names():
+            if name[:1] != sigil:
+                continue
+            row = (total(name, 'completed', start, end),
+                   total(name, 'created', start, end), name)
+            if row[0] or row[1]:
+                rows.append(row)
+        rows.sort(key=lambda r: (-r[0], -r[1], r[2]))
+        lines += [ '', '%-30s %9s %9s' % (title, 'created', 'completed') ]
+        lines += [ '%-30s %9d %9d' % (name, created, completed)
+                   for completed, created, name in rows[:top] ]
+        if len(rows) > top:
+            lines.append('... and %d more' % (len(rows) - top))
+    return lines
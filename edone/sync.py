@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Line level synchronization of the todo files with a remote server.
+
+Every file is a collection on the server (url/<file name>) of lines, with a
+stable id and a version incremented at every change, the collection has a
+revision incremented at every line change. The protocol (JSON over HTTP,
+see bench/sync_server.py for a stand-in server):
+
+    GET  url/<name>/lines?since=REV
+         -> {"rev": REV, "lines": [{"id", "ver", "text"} or
+                                   {"id", "ver", "deleted": true}, ...]}
+         the lines changed after the given revision
+
+    POST url/<name>/lines  {"ops": [{"id", "base", "text"} or
+                                    {"id", "base", "deleted": true}, ...]}
+         -> {"rev": REV, "applied": [{"id", "ver"}, ...],
+             "conflicts": [lines as in GET]}
+         ops are applied only if base is the current version of the line
+         (0 for new lines), the others are returned as conflicts
+
+The state of the last sync (revision and id, version and hash of every
+line, in file order) is kept for every file: local changes are found
+comparing the line hashes with it, so only the changed lines are sent and
+received. Changes on different lines are merged, when the same line is
+changed on both sides both versions are kept (the local one as a new line)
+and a line deleted on one side and changed on the other is kept.
+
+The network runs in a worker thread, the changes to apply to the tasks are
+then delivered to the main loop (see Sync.start).
+"""
+
+import os
+import json
+import gzip
+import uuid
+import hashlib
+import difflib
+import threading
+import http.client
+from urllib.parse import urlsplit, quote
+
+from edone.tasks import TASKS, Task, HISTORY, tasks_add
+from edone.utils import config_path
+
+
+STATE_PATH = os.path.join(config_path, 'sync')
+BATCH = 500        # line operations per request
+TIMEOUT = 20       # seconds, for every request
+MAX_ROUNDS = 3     # push attempts when the server keeps changing
+GZIP_MIN = 1024    # compress request bodies bigger than this
+
+
+class SyncError(Exception):
+    pass
+
+
+def line_hash(text):
+    data = text.encode('utf-8', 'backslashreplace')
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def _new_id():
+    return uuid.uuid4().hex[:16]
+
+
+def _direct_call(func, *args):
+    func(*args)
+
+
+class SyncState(object):
+    """ Revision and lines (id, ver, hash) of a file at the last sync """
+
+    def __init__(self, path, url, state_path=STATE_PATH):
+        key = hashlib.sha1(('%s\n%s' % (path, url)).encode('utf-8'))
+        self.file = os.path.join(state_path, key.hexdigest()[:16] + '.state')
+        self.rev = 0
+        self.lines = []
+        try:
+            with open(self.file, encoding='utf-8') as f:
+                self.rev = int(f.readline())
+                for line in f:
+                    lid, ver, h = line.split()
+                    self.lines.append((lid, int(ver), h))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            print('WARNING: Invalid sync state, starting over: "%s"' % self.file)
+            self.rev = 0
+            self.lines = []
+
+    def save(self):
+        folder = os.path.dirname(self.file)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write('%d\n' % self.rev)
+            f.writelines('%s %d %s\n' % l for l in self.lines)
+        os.replace(tmp, self.file)
+
+
+class Remote(object):
+    """ The server, all the requests reuse the same connection """
+
+    def __init__(self, url, timeout=TIMEOUT):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise SyncError('Unsupported sync url: %s' % url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.base = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.conn = None
+        self.requests = 0
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.scheme == 'https' \
+              else http.client.HTTPConnection
+        self.conn = cls(self.netloc, timeout=self.timeout)
+
+    def request(self, method, path, data=None):
+        """ Send a request (data is json encoded) and return the json reply """
+        body = None
+        headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip'}
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+            if len(body) > GZIP_MIN:
+                body = gzip.compress(body)
+                headers['Content-Encoding'] = 'gzip'
+
+        # a kept alive connection can be closed by the server at any time
+        for attempt in (1, 2):
+            if self.conn is None:
+                self._connect()
+            try:
+                self.conn.request(method, self.base + path, body, headers)
+                resp = self.conn.getresponse()
+                reply = resp.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionError) as e:
+                self.close()
+                if attempt == 2:
+                    raise SyncError(str(e))
+            except (OSError, http.client.HTTPException) as e:
+                self.close()
+                raise SyncError(str(e))
+        self.requests += 1
+
+        if resp.getheader('Content-Encoding') == 'gzip':
+            reply = gzip.decompress(reply)
+        if resp.status != 200:
+            raise SyncError('%s %s: %d %s' % (method, path, resp.status,
+                                              resp.reason))
+        return json.loads(reply.decode('utf-8'))
+
+    def changes(self, name, since):
+        return self.request('GET', '/%s/lines?since=%d' % (quote(name), since))
+
+    def push(self, name, ops):
+        """ Send the ops in batches, return the merged replies """
+        result = {'rev': None, 'applied': [], 'conflicts': []}
+        for i in range(0, len(ops), BATCH):
+            reply = self.request('POST', '/%s/lines' % quote(name),
+                                 {'ops': ops[i:i + BATCH]})
+            result['rev'] = reply['rev']
+            result['applied'] += reply['applied']
+            result['conflicts'] += reply['conflicts']
+        return result
+
+
+def _align(base, hashes):
+    """ Match the base lines (id, ver, hash) with the current lines hashes
+
+    Return the base line (or None for new lines) of every current line and
+    the list of base lines not found (deleted). Changed lines are the ones
+    in place of other lines.
+    """
+    if len(base) == len(hashes) and \
+       all(b[2] == h for b, h in zip(base, hashes)):
+        return list(base), []
+    matched = [None] * len(hashes)
+    deleted = []
+    sm = difflib.SequenceMatcher(None, [b[2] for b in base], hashes,
+                                 autojunk=False)
+    for op, i1, i2, j1, j2 in sm.get_opcodes():
+        n = min(i2 - i1, j2 - j1) if op in ('equal', 'replace') else 0
+        for k in range(n):
+            matched[j1 + k] = base[i1 + k]
+        deleted.extend(base[i1 + n:i2])
+    return matched, deleted
+
+
+class FileSync(object):
+    """ Sync of a single file, the result of Sync.start
+
+    changed, deleted and added are the changes to apply to the tasks (see
+    apply), state is the new sync state, to save after the tasks.
+    """
+
+    def __init__(self, path, tasks, state):
+        self.path = path
+        self.tasks = tasks    # list of (task, raw text) when sync started
+        self.state = state
+        self.changed = []     # (task, old text, new text)
+        self.deleted = []     # (task, old text)
+        self.added = []       # new text
+        self.sent = 0         # number of pushed lines
+        self.received = 0     # number of received lines
+
+    def run(self, remote):
+        name = os.path.basename(self.path)
+        texts = [ raw for _, raw in self.tasks ]
+        base, gone = _align(self.state.lines, [ line_hash(t) for t in texts ])
+
+        # the current lines: [id, ver, text, index in self.tasks]
+        lines = []
+        ops = {}  # key: line id  val: op to push
+        for i, (text, b) in enumerate(zip(texts, base)):
+            if b is None:
+                lid = _new_id()
+                lines.append([lid, 0, text, i])
+                ops[lid] = {'id': lid, 'base': 0, 'text': text}
+            else:
+                lines.append([b[0], b[1], text, i])
+                if b[2] != line_hash(text):
+                    ops[b[0]] = {'id': b[0], 'base': b[1], 'text': text}
+        for lid, ver, _ in gone:
+            ops[lid] = {'id': lid, 'base': ver, 'deleted': True}
+        by_id = dict((l[0], l) for l in lines)
+
+        reply = remote.changes(name, self.state.rev)
+        first = not self.state.lines
+        rev = reply['rev']
+        remote_lines = reply['lines']
+        for _ in range(MAX_ROUNDS):
+            self.received += len(remote_lines)
+            self._merge(remote_lines, lines, by_id, ops, first)
+            first = False
+            if not ops:
+                break
+            self.sent += len(ops)
+            reply = remote.push(name, list(ops.values()))
+            for a in reply['applied']:
+                if a['id'] in by_id:
+                    by_id[a['id']][1] = a['ver']
+                del ops[a['id']]
+            remote_lines = reply['conflicts']
+            # every applied op is a revision: if there are no others nobody
+            # else changed the file, otherwise our own changes will be
+            # received again at the next sync (and skipped, see _merge)
+            if not remote_lines and reply['rev'] == rev + len(reply['applied']):
+                rev = reply['rev']
+        if ops:
+            raise SyncError('Too many concurrent changes on "%s"' % name)
+
+        self.state.rev = rev
+        self.state.lines = [ (l[0], l[1], line_hash(l[2]))
+                             for l in lines if l[0] is not None ]
+
+    def _merge(self, remote_lines, lines, by_id, ops, first):
+        """ Merge the remote changes with the local ones (in ops) """
+        if first:
+            # no previous sync: the new local lines equal to remote lines
+            # are the same lines
+            news = {}
+            for l in lines:
+                if ops.get(l[0], {}).get('base') == 0:
+                    news.setdefault(line_hash(l[2]), []).append(l)
+            for r in remote_lines:
+                same = news.get(line_hash(r.get('text', '')))
+                if not r.get('deleted') and same:
+                    l = same.pop()
+                    del by_id[l[0]]
+                    del ops[l[0]]
+                    l[0:2] = r['id'], r['ver']
+                    by_id[l[0]] = l
+                    r['known'] = True
+
+        for r in remote_lines:
+            lid, ver, text = r['id'], r['ver'], r.get('text')
+            l = by_id.get(lid)
+            op = ops.get(lid)
+            if r.get('known') or (l is not None and l[1] == ver):
+                continue
+            if op is None and l is None:
+                if text is not None:
+                    self._add(lines, by_id, lid, ver, text)
+            elif op is None:
+                # changed only remotely
+                self._set(l, text)
+                l[1] = ver
+                if text is None:
+                    l[0] = None
+                    del by_id[lid]
+            elif op.get('deleted'):
+                # deleted here: a remote change wins
+                del ops[lid]
+                if text is not None:
+                    self._add(lines, by_id, lid, ver, text)
+            elif text is None or text != op['text']:
+                # changed here, and deleted or changed remotely: the local
+                # line is kept as a new line
+                del ops[lid]
+                del by_id[lid]
+                l[0:2] = _new_id(), 0
+                by_id[l[0]] = l
+                ops[l[0]] = {'id': l[0], 'base': 0, 'text': l[2]}
+                if text is not None:
+                    self._add(lines, by_id, lid, ver, text)
+            else:
+                # same change on both sides
+                del ops[lid]
+                l[1] = ver
+
+    def _add(self, lines, by_id, lid, ver, text):
+        # added lines have a negative index: -1 - index in self.added
+        l = [lid, ver, text, -1 - len(self.added)]
+        lines.append(l)
+        by_id[lid] = l
+        self.added.append(text)
+
+    def _set(self, line, text):
+        """ Change (or delete if text is None) a local line """
+        if line[3] < 0:
+            self.added[-1 - line[3]] = text
+        else:
+            task, old = self.tasks[line[3]]
+            if text is None:
+                self.deleted.append((task, old))
+            else:
+                self.changed.append((task, old, text))
+        if text is not None:
+            line[2] = text
+
+    def apply(self):
+        """ Apply the changes to the tasks, in the main loop
+
+        Tasks changed locally while syncing are left as they are, they will
+        be sent at the next sync. All the changes are a single undo step.
+        Return True if something changed.
+        """
+        with HISTORY.group():
+            for task, old, new in self.changed:
+                if task in TASKS and task.raw_txt == old:
+                    task.raw_txt = new
+            for task, old in self.deleted:
+                if task in TASKS and task.raw_txt == old:
+                    task.delete()
+            tasks_add(Task(text, self.path) for text in self.added
+                      if text is not None)
+        return bool(self.changed or self.deleted or self.added)
+
+
+class Sync(object):
+    """ Sync the todo files with the server at url, in a worker thread
+
+    post(func, *args) must call func in the main loop (see NoteStore).
+    """
+
+    def __init__(self, url, post=None, state_path=STATE_PATH):
+        self.url = url
+        self.post = post or _direct_call
+        self.state_path = state_path
+        self._jobs = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._quit = False
+
+    @property
+    def busy(self):
+        with self._cond:
+            return self._running or bool(self._jobs)
+
+    def start(self, files, callback, *args):
+        """ Sync the given files, files is a list of (path, tasks)
+
+        When done callback(results, error, *args) is called in the main
+        loop, results is a list of FileSync (to apply, then save the files
+        and then their state) and error a SyncError (or None). Return False
+        if a sync is running yet.
+        """
+        snapshot = [ (path, [ (t, t.raw_txt) for t in tasks ])
+                     for path, tasks in files ]
+        with self._cond:
+            if self._running or self._jobs:
+                return False
+            self._jobs.append((snapshot, callback, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='edone-sync')
+                self._thread.start()
+            self._cond.notify_all()
+        return True
+
+    def close(self):
+        """ Wait for the running sync (its result is not delivered) """
+        with self._cond:
+            self._quit = True
+            self._jobs = []
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        remote = None
+        while True:
+            with self._cond:
+                while not self._jobs and not self._quit:
+                    self._cond.wait()
+                if self._quit:
+                    break
+                snapshot, callback, args = self._jobs.pop(0)
+                self._running = True
+
+            results, error = [], None
+            try:
+                if remote is None:
+                    remote = Remote(self.url)
+                for path, tasks in snapshot:
+                    fs = FileSync(path, tasks,
+                                  SyncState(path, self.url, self.state_path))
+                    fs.run(remote)
+                    results.append(fs)
+            except SyncError as e:
+                error = e
+            except (ValueError, KeyError, TypeError) as e:
+                error = SyncError('Invalid reply from server: %s' % e)
+
+            with self._cond:
+                self._running = False
+                quit = self._quit
+            if not quit:
+                self.post(callback, results, error, *args)
+        if remote is not None:
+            remote.close()
@@ -19,78 +19,558 @@
 # along with Edone.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
+import mmap
+import time
+import codecs
+import hashlib
 import datetime
+import threading
+from bisect import bisect_left, insort
+from operator import itemgetter
+from collections import OrderedDict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 
+from edone.history import History
+from edone.ordered import OrderedTasks
+from edone.merge import merge3
 
-TASKS = []
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no advisory file locks (ex: on windows)
+
+
+TASKS = OrderedTasks()
+
+TAG_IDS = {}    # key: tag_name  val: tag_id (interned tags)
+TAG_NAMES = []  # tag names, indexed by tag_id
+
+# tasks with tag ids above this store a sorted tuple of ids instead of a mask
+WIDE_TAGS = 256
+
+# seconds to wait for the lock of a file before saving anyway
+LOCK_TIMEOUT = 5.0
+
+# key:value indexes kept (the least recently searched ones are dropped)
+KEYS_MAX = 8
+
+_notes_path = None   # notes folder of the main file
+_notes_trash = set()  # notes of the deleted tasks, removed on save
+_files = []         # the loaded files, new tasks go in the first one
+_sources = {}       # key: path  val: _Source (the loaded files)
+_dirty = set()      # files with unsaved changes
+_errors = 'replace' # how to decode invalid utf-8 (see bytes.decode)
+_bases = {}         # key: path  val: the lines of the file as loaded (or saved)
+_merges = []        # (path, conflicts) merged with changes by others on save
+_tags_lock = threading.Lock()  # tags are also interned by the loader threads
+_key_re = re.compile(r'[A-Za-z][\w.-]*$')  # the key in key:value extensions
+_word_re = re.compile(r'\S+')  # the words of the text, as split()
+
+
+def tag_id(name):
+    """ Intern the given tag name and return its integer id """
+    try:
+        return TAG_IDS[name]
+    except KeyError:
+        with _tags_lock:
+            if name not in TAG_IDS:
+                TAG_NAMES.append(name)
+                TAG_IDS[name] = len(TAG_NAMES) - 1
+            return TAG_IDS[name]
+
+
+def _tags_pack(ids):
+    """ Compact form of a set of tag ids: a bitmask or a sorted tuple """
+    if not ids:
+        return 0
+    ids = sorted(set(ids))
+    if ids[-1] >= WIDE_TAGS:
+        return tuple(ids)
+    mask = 0
+    for i in ids:
+        mask |= 1 << i
+    return mask
+
+
+def tags_ids(tags):
+    """ Iterate the tag ids of a packed set of tags """
+    if tags.__class__ is tuple:
+        for i in tags:
+            yield i
+    else:
+        while tags:
+            low = tags & -tags
+            yield low.bit_length() - 1
+            tags ^= low
+
+
+def _tags_unpack(tags):
+    """ Iterate the tag names of a packed set of tags """
+    for i in tags_ids(tags):
+        yield TAG_NAMES[i]
+
+
+def tag_parents(tag):
+    """ The names of the ancestors of a dotted tag (+a.b.c: +a and +a.b) """
+    i = tag.find('.', 2)
+    while i != -1:
+        yield tag[:i]
+        i = tag.find('.', i + 1)
+
+
+def tag_in(tag, names):
+    """ True if the tag, or one of its ancestors, is in names """
+    return tag in names or any(p in names for p in tag_parents(tag))
+
+
+class TagsFilter(object):
+    """ Match the tasks that have at least one of the given tags
+
+    A tag also matches its subtags (+acme matches +acme.web), the tags
+    interned after the creation of the filter are checked on match.
+    """
+
+    def __init__(self, names):
+        self.names = frozenset(names)
+        for n in self.names:
+            tag_id(n)
+        self.ids = set()
+        self.mask = 0
+        self._known = 0  # number of TAG_NAMES already checked
+        self._update()
+
+    def _update(self):
+        for i in range(self._known, len(TAG_NAMES)):
+            if tag_in(TAG_NAMES[i], self.names):
+                self.ids.add(i)
+                self.mask |= 1 << i
+        self._known = len(TAG_NAMES)
+
+    def match(self, task):
+        if self._known != len(TAG_NAMES):
+            self._update()
+        tags = task._tags
+        if tags.__class__ is tuple:
+            return not self.ids.isdisjoint(tags)
+        return tags & self.mask != 0
+
+
+class TagNode(object):
+    """ A level of the tags tree (ex: +acme.web) """
+    __slots__ = ('parent', 'children', 'tasks')
+
+    def __init__(self, parent):
+        self.parent = parent   # parent node name (None on the first level)
+        self.children = set()  # names of the children nodes
+        self.tasks = set()     # tasks with this tag or one of its subtags
+
+
+class TagsTree(object):
+    """ Prefix tree of the tag names, split at the dots
+
+    A task tagged +acme.web.frontend is in the +acme, +acme.web and
+    +acme.web.frontend nodes, so the tasks of a whole subtree (and their
+    number) are a single lookup. Nodes only exist while they have tasks.
+    """
+
+    def __init__(self):
+        self.nodes = {}       # key: node name  val: TagNode (of all levels)
+        self.roots = set()    # names of the first level nodes
+        self.changed = set()  # nodes changed since the last changed_pop()
+
+    def clear(self):
+        self.changed.update(self.nodes)
+        self.nodes.clear()
+        self.roots.clear()
+
+    def add(self, task):
+        for tag in _tags_unpack(task._tags):
+            parent = None
+            for name in chain(tag_parents(tag), (tag,)):
+                node = self.nodes.get(name)
+                if node is None:
+                    node = self.nodes[name] = TagNode(parent)
+                    if parent is None:
+                        self.roots.add(name)
+                    else:
+                        self.nodes[parent].children.add(name)
+                node.tasks.add(task)
+                self.changed.add(name)
+                parent = name
+
+    def remove(self, task):
+        for tag in _tags_unpack(task._tags):
+            names = list(tag_parents(tag))
+            names.append(tag)
+            for name in reversed(names):  # leaf first
+                node = self.nodes.get(name)
+                if node is None:
+                    continue
+                node.tasks.discard(task)
+                if not node.tasks:
+                    del self.nodes[name]
+                    if node.parent is None:
+                        self.roots.discard(name)
+                    else:
+                        self.nodes[node.parent].children.discard(name)
+                self.changed.add(name)
+
+    def tasks(self, name):
+        """ The tasks with the given tag or one of its subtags """
+        node = self.nodes.get(name)
+        return node.tasks if node is not None else set()
+
+    def count(self, name, tasks=None):
+        """ Number of tasks in the subtree, optionally only in tasks """
+        node = self.nodes.get(name)
+        if node is None:
+            return 0
+        if tasks is None:
+            return len(node.tasks)
+        return len(node.tasks & tasks)
+
+    def parent(self, name):
+        node = self.nodes.get(name)
+        return node.parent if node is not None else None
+
+    def children(self, name=None, sigil=None):
+        """ Sorted names of the children of a node (or of the roots)
+
+        sigil ('+' or '@') only selects the roots of that kind.
+        """
+        if name is None:
+            names = self.roots
+            if sigil is not None:
+                names = [ n for n in names if n[0] == sigil ]
+        else:
+            node = self.nodes.get(name)
+            names = node.children if node is not None else ()
+        return sorted(names)
+
+    def has_children(self, name):
+        node = self.nodes.get(name)
+        return node is not None and len(node.children) > 0
+
+    def subtree(self, name):
+        """ Iterate the names of a node and of all its descendants """
+        todo = [name] if name in self.nodes else []
+        while todo:
+            name = todo.pop()
+            yield name
+            todo.extend(self.nodes[name].children)
+
+    def changed_pop(self):
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+TAG_TREE = TagsTree()
+
+
+class DatesIndex(object):
+    """ Tasks sorted by one of their dates (ex: 'due' or 'threshold') """
+
+    def __init__(self, attr):
+        self.attr = attr
+        self.keys = []   # sorted list of (date_ordinal, task_id)
+        self.tasks = {}  # key: task_id  val: task
+
+    def clear(self):
+        self.keys = []
+        self.tasks = {}
+
+    def add(self, task):
+        date = getattr(task, self.attr)
+        if date is not None:
+            insort(self.keys, (date.toordinal(), task._id))
+            self.tasks[task._id] = task
+
+    def remove(self, task):
+        date = getattr(task, self.attr)
+        if date is not None:
+            key = (date.toordinal(), task._id)
+            i = bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+                del self.tasks[task._id]
+
+    def range(self, start=None, end=None):
+        """ Tasks with start <= date < end (datetime.date or None) """
+        i = 0 if start is None else \
+            bisect_left(self.keys, (start.toordinal(), -1))
+        j = len(self.keys) if end is None else \
+            bisect_left(self.keys, (end.toordinal(), -1))
+        return [ self.tasks[tid] for _, tid in self.keys[i:j] ]
+
+    def first_after(self, date):
+        """ The first date in the index after the given one (or None) """
+        i = bisect_left(self.keys, (date.toordinal() + 1, -1))
+        if i < len(self.keys):
+            return datetime.date.fromordinal(self.keys[i][0])
+
+DUE = DatesIndex('due')
+THRESHOLD = DatesIndex('threshold')
+
+
+
+def value_sort_key(value):
+    # numbers sort numerically and before strings (dates sort as strings)
+    try:
+        return (0, float(value), '')
+    except ValueError:
+        return (1, 0.0, value)
+
+
+class KeysIndex(object):
+    """ Tasks by value of a key:value extension (ex: 'rec', 'id' or 'est') """
+
+    def __init__(self, key):
+        self.key = key
+        self.values = {}  # key: value  val: set of tasks
+        self.sorted = []  # sorted list of (value_sort_key, value)
+
+    def clear(self):
+        self.values = {}
+        self.sorted = []
+
+    def add(self, task):
+        value = task._keys.get(self.key)
+        if value is None:
+            return
+        if value in self.values:
+            self.values[value].add(task)
+        else:
+            self.values[value] = {task}
+            insort(self.sorted, (value_sort_key(value), value))
+
+    def remove(self, task):
+        value = task._keys.get(self.key)
+        tasks = self.values.get(value)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self.values[value]
+                key = (value_sort_key(value), value)
+                del self.sorted[bisect_left(self.sorted, key)]
+
+    def get(self, value):
+        """ Tasks with exactly the given value """
+        return self.values.get(value, set())
+
+    def range(self, start=None, end=None, include_start=True,
+              include_end=False):
+        """ Tasks with start <= value < end (compared as numbers if both are) """
+        top = chr(0x10ffff)  # greater than any value
+        if start is None:
+            i = 0
+        elif include_start:
+            i = bisect_left(self.sorted, (value_sort_key(start),))
+        else:
+            i = bisect_left(self.sorted, (value_sort_key(start), top))
+        if end is None:
+            j = len(self.sorted)
+        elif include_end:
+            j = bisect_left(self.sorted, (value_sort_key(end), top))
+        else:
+            j = bisect_left(self.sorted, (value_sort_key(end),))
+        tasks = set()
+        for _, value in self.sorted[i:j]:
+            tasks.update(self.values[value])
+        return tasks
+
+KEYS = OrderedDict()  # key: extension key  val: KeysIndex (most recent last)
+
+
+class FilesIndex(object):
+    """ Tasks of each loaded file """
+
+    def __init__(self):
+        self.postings = {}  # key: path  val: set of tasks
+
+    def clear(self):
+        self.postings = {}
+
+    def add(self, task):
+        if task._file in self.postings:
+            self.postings[task._file].add(task)
+        else:
+            self.postings[task._file] = {task}
+
+    def remove(self, task):
+        tasks = self.postings.get(task._file)
+        if tasks is not None:
+            tasks.discard(task)
+
+    def tasks(self, path):
+        return self.postings.get(path, set())
+
+    def count(self, path, tasks=None):
+        """ Number of tasks in the given file, optionally only in tasks """
+        postings = self.tasks(path)
+        return len(postings) if tasks is None else len(postings & tasks)
+
+FILES = FilesIndex()
+
+
+def keys_index(key):
+    """ The index for the given key:value extension, created on demand
+
+    Only the KEYS_MAX most recently used indexes are kept, an index only
+    holds the tasks having its key.
+    """
+    index = KEYS.get(key)
+    if index is not None:
+        KEYS.move_to_end(key)
+        return index
+    index = KEYS[key] = KeysIndex(key)
+    index_register(index)
+    while len(KEYS) > KEYS_MAX:
+        index_unregister(KEYS.popitem(last=False)[1])
+    return index
+
+
+# undo/redo history of all the changes to TASKS
+HISTORY = History()
+
+
+# every index must implement add(task), remove(task) and clear()
+INDEXES = [TAG_TREE, DUE, THRESHOLD, FILES]
+
+
+def index_register(index):
+    """ Keep the given index in sync with TASKS from now on """
+    INDEXES.append(index)
+    for t in TASKS:
+        index.add(t)
+
+
+def index_unregister(index):
+    INDEXES.remove(index)
+    index.clear()
+
+
+def _index_add(task):
+    task._indexed = True
+    for index in INDEXES:
+        index.add(task)
+
+
+def _index_remove(task):
+    task._indexed = False
+    for index in INDEXES:
+        index.remove(task)
+
+
+def _date_parse(text):
+    """ datetime of a YYYY-MM-DD string, a lot faster than strptime """
+    if len(text) == 10 and text[4] == '-' and text[7] == '-' and \
+       text[:4].isdigit() and text[5:7].isdigit() and text[8:].isdigit():
+        return datetime.datetime(int(text[:4]), int(text[5:7]), int(text[8:]))
+    return datetime.datetime.strptime(text, '%Y-%m-%d')
+
+
+def _notes_dir(path):
+    """ The notes folder of the given todo file (None: the main file) """
+    return _notes_path if path is None else path + '.notes'
+
+
+def _history_record(task, old, new):
+    # the position is in TASKS, the file is needed to undo a deletion
+    HISTORY.record((TASKS.index(task), task._file), old, new)
 
-_notes_path = None
-_need_save = False
 
 class Task(object):
     """ Class to describe a single task """
 
-    def __init__(self, raw_text=''):
+    def __init__(self, raw_text='', file=None):
+        self._indexed = False  # True while the task is part of TASKS
+        self._id = None        # stable id, given when added to TASKS
+        self._file = file      # the todo file of the task (None: the main)
+        self._span = None      # (start, end) of the unchanged line in the file
+        self._slot = None      # slot in TASKS (see ordered.OrderedTasks)
         self._raw_txt = raw_text
         self._completed = False
         self._text = 'todo'
         self._priority = None  # 'A'
-        self._projects = []  # +
-        self._contexts = []  # @
-        self._creation_date = '2014-12-30'
-        self._completion_date = '2014-12-31'
+        self._tags = 0  # +projects and @contexts (see _tags_pack)
+        self._creation_date = None    # datetime
+        self._completion_date = None  # datetime
 
         self._progress = None  # int(0-100)     TAG = prog:XX
         self._note = None      # note file name TAG = note:XXXX.txt
+        self._due = None       # due date       TAG = due:YYYY-MM-DD
+        self._threshold = None # start date     TAG = t:YYYY-MM-DD
+        self._keys = {}        # all the key:value extensions (in order)
+        self._keys_at = None   # key: key  val: position in the text words
         # self._files = []     # files:
 
         if raw_text:
             self._parse_from_raw()
 
     def __repr__(self):
-        return '<Task: "%s" +%s @%s>' % (self._raw_txt, self._projects, self._contexts)
+        return '<Task: "%s" +%s @%s>' % (self._raw_txt, self.projects, self.contexts)
+
+    @property
+    def projects(self):
+        return [ x for x in _tags_unpack(self._tags) if x[0] == '+' ]
+
+    @property
+    def contexts(self):
+        return [ x for x in _tags_unpack(self._tags) if x[0] == '@' ]
 
     def __getattr__(self, name):
         return getattr(self, '_' + name)
 
     def __setattr__(self, name, value):
-        global _need_save
-
         if name.startswith('_'):
             object.__setattr__(self, name, value)
         else:
+            indexed = self._indexed
+            old_raw = self._raw_txt
+            self._span = None
+            if indexed:
+                _index_remove(self)
             object.__setattr__(self, '_' + name, value)
             if name == 'raw_txt':
                 self._parse_from_raw()
             else:
                 self._raw_from_props()
-            _need_save = True
+            if indexed:
+                _index_add(self)
+                if self._raw_txt != old_raw:
+                    _history_record(self, old_raw, self._raw_txt)
+                _dirty.add(self._file)
 
     def delete(self):
-        global _need_save
-
-        if self._note and os.path.exists(self._note):
-            os.remove(self._note)
+        # the note is removed on save (the delete can be undone)
+        if self._note:
+            _notes_trash.add(self._note)
 
+        _history_record(self, self._raw_txt, None)
+        _index_remove(self)
         TASKS.remove(self)
-        _need_save = True
+        _dirty.add(self._file)
 
     def create_note_filename(self):
         # create notes folder if needed
-        if not os.path.exists(_notes_path):
-            os.mkdir(_notes_path)
+        notes_path = _notes_dir(self._file)
+        if not os.path.exists(notes_path):
+            os.mkdir(notes_path)
 
-        # find a free file name
+        # find a free file name (notes are written later, see notes.py)
         if self.note is None:
+            used = set(t._note for t in TASKS)
             i = 1
             while True:
-                fname = os.path.join(_notes_path, '%03d.txt' % i)
-                if not os.path.exists(fname):
+                fname = os.path.join(notes_path, '%03d.txt' % i)
+                if not os.path.exists(fname) and fname not in used:
                     break
                 i += 1
 
             # store filename triggering _raw_from_props()
-            self.note = os.path.join(_notes_path, fname)
+            self.note = os.path.join(notes_path, fname)
 
     def _parse_from_raw(self):
         txt = self._raw_txt
@@ -112,10 +592,12 @@ class Task(object):
         # two dates (format: 2014-12-30)
         date1 = date2 = None
         try:
-            date1 = datetime.datetime.strptime(txt[:9], '%Y-%m-%d')
-            txt = txt[9:]
-            date2 = datetime.datetime.strptime(txt[:9], '%Y-%m-%d')
-            txt = txt[9:]
+            if txt[4:5] == '-':
+                date1 = _date_parse(txt[:10])
+                txt = txt[11:]
+                if txt[4:5] == '-':
+                    date2 = _date_parse(txt[:10])
+                    txt = txt[11:]
         except:
             pass
 
@@ -131,29 +613,83 @@ class Task(object):
 
         # contexts & projects lists
         words = txt.split()
-        self._contexts = [ x for x in words if x[0] == '@' and len(x) > 1 ]
-        self._projects = [ x for x in words if x[0] == '+' and len(x) > 1 ]
-
-        # custom attributes
-        self._progress = None
-        for x in words:
-            # completion progress
-            if x.startswith('prog:'):
-                try:
-                    self._progress = int(x.split(':')[1])
-                    txt = txt.replace(x, '')
-                except: pass
-
-            # note file
-            elif x.startswith('note:'):
-                try:
-                    fname = x.split(':')[1]
-                    self._note = os.path.join(_notes_path, fname)
-                    txt = txt.replace(x, '')
-                except: pass
+        self._tags = _tags_pack([ tag_id(x) for x in words
+                                  if x[0] in '@+' and len(x) > 1 ])
+
+        # key:value extensions (prog, note, due and t are also parsed)
+        self._keys = {}
+        self._progress = self._note = self._due = self._threshold = None
+        tokens = []
+        for i, x in enumerate(words):
+            key, sep, value = x.partition(':')
+            if value and not value.startswith('/') and _key_re.match(key):
+                tokens.append((i, key, value))
+
+        # repeated keys are left in the text (so they round-trip unchanged)
+        keys = [ key for _, key, _ in tokens ]
+        removed = []
+        at = {}
+        for i, key, value in tokens:
+            if keys.count(key) > 1:
+                continue
+            try:
+                # completion progress
+                if key == 'prog':
+                    self._progress = int(value)
+
+                # note file (just the name if no file is loaded)
+                elif key == 'note':
+                    notes_path = _notes_dir(self._file)
+                    self._note = value if notes_path is None else \
+                                 os.path.join(notes_path, value)
+
+                # due and threshold (start) dates
+                elif key == 'due':
+                    self._due = _date_parse(value)
+                elif key == 't':
+                    self._threshold = _date_parse(value)
+            except (ValueError, TypeError):
+                continue
+            self._keys[key] = value
+            # the number of text words before the token, to put it back there
+            at[key] = i - len(removed)
+            removed.append(i)
+        self._keys_at = at or None
+
+        # remove the tokens from the text (by position, from the last one),
+        # together with one space
+        if removed:
+            spans = [ m.span() for m in _word_re.finditer(txt) ]
+            for i in reversed(removed):
+                start, end = spans[i]
+                if start > 0 and txt[start-1] == ' ':
+                    start -= 1
+                elif txt[end:end+1] == ' ':
+                    end += 1
+                txt = txt[:start] + txt[end:]
 
         self._text = txt
 
+    def key_set(self, key, value):
+        """ Set (or remove, if value is None) a key:value extension """
+        if key in ('prog', 'note', 'due', 't'):
+            # known keys are kept in sync from their own attributes
+            if key == 'prog':
+                self.progress = None if value is None else int(value)
+            elif key == 'note':
+                self.note = None if value is None else \
+                            os.path.join(_notes_dir(self._file), value)
+            else:
+                date = None if value is None else _date_parse(value)
+                setattr(self, 'due' if key == 'due' else 'threshold', date)
+        else:
+            keys = dict(self._keys)
+            if value is None:
+                keys.pop(key, None)
+            else:
+                keys[key] = str(value)
+            self.keys = keys
+
     def _raw_from_props(self):
         self._raw_txt = ''
 
@@ -171,43 +707,625 @@ class Task(object):
         if self._creation_date:
             self._raw_txt += '%s ' % self._creation_date.strftime('%Y-%m-%d')
 
-        # clean text
-        self._raw_txt += self._text
+        # update the known key:value extensions from their attributes
+        keys = self._keys
+        for key, value in (
+            ('due', self._due and self._due.strftime('%Y-%m-%d')),
+            ('t', self._threshold and self._threshold.strftime('%Y-%m-%d')),
+            ('prog', None if self._progress is None else '%d' % self._progress),
+            ('note', self._note and os.path.basename(self._note))):
+            if value is None:
+                keys.pop(key, None)
+            else:
+                keys[key] = value
 
-        # completion progress
-        if self._progress is not None:
-            self._raw_txt += ' prog:%d' % self._progress
+        # key:value extensions back in their place in the text (before the
+        # same text word they were), the new ones at the end
+        txt = self._text
+        starts = [ m.start() for m in _word_re.finditer(txt) ]
+        at = self._keys_at or {}
+        inserts = []  # (char position in txt, token)
+        tail = []
+        for key, value in keys.items():
+            token = '%s:%s' % (key, value)
+            pos = at.get(key)
+            if pos is None or pos >= len(starts):
+                tail.append(token)
+            else:
+                inserts.append((starts[pos], token))
+        inserts.sort(key=itemgetter(0))  # stable: tokens keep their order
 
-        # note file
-        if self._note is not None:
-            self._raw_txt += ' note:%s' % os.path.basename(self._note)
+        parts = []
+        last = 0
+        for pos, token in inserts:
+            parts.append(txt[last:pos] + token + ' ')
+            last = pos
+        parts.append(txt[last:])
+        body = ''.join(parts)
+        if tail:
+            body = ' '.join([body] + tail) if txt else ' '.join(tail)
+        self._raw_txt += body
 
 
 def need_save():
-    return _need_save
+    return bool(_dirty)
+
+
+def files():
+    """ The loaded files, the first one is the main file """
+    return list(_files)
+
+
+def file_need_save(path):
+    return path in _dirty
 
 
-def load_from_file(path):
-    global _notes_path
+def _main_file():
+    return _files[0] if _files else None
 
-    print('Loading tasks from file: "%s"' % path)
 
-    _notes_path = path + '.notes'
-    del TASKS[:]
+def task_add(task):
+    if task._file is None:
+        task._file = _main_file()
+    TASKS.append(task)
+    _index_add(task)
+    _history_record(task, None, task.raw_txt)
+    _dirty.add(task._file)
 
-    with open(path) as f:
-        for line in f:
-            t = Task(line.strip())
+
+def tasks_add(tasks):
+    """ Add all the tasks from the given iterable, as a single undo step
+
+    Tasks are consumed one at a time (the iterable can be a generator).
+    Return the number of added tasks.
+    """
+    count = 0
+    with HISTORY.group():
+        for t in tasks:
+            if t._file is None:
+                t._file = _main_file()
             TASKS.append(t)
+            _index_add(t)
+            _history_record(t, None, t.raw_txt)
+            _dirty.add(t._file)
+            count += 1
+    return count
+
+
+def _delta_apply(delta):
+    """ Apply a single history delta, return (task, action)
+
+    action is one of 'add', 'delete' or 'change'
+    """
+    (pos, path), old, new = delta
+    _dirty.add(path)
+    if old is None:
+        task = Task(new, path)
+        TASKS.insert(pos, task)
+        _index_add(task)
+        return task, 'add'
+    task = TASKS[pos]
+    if new is None:
+        _index_remove(task)
+        del TASKS[pos]
+        return task, 'delete'
+    task.raw_txt = new
+    return task, 'change'
+
+
+def _deltas_apply(deltas):
+    if deltas is None:
+        return []
+    with HISTORY.paused_block():
+        return [ _delta_apply(d) for d in deltas ]
+
+
+def history_undo():
+    """ Revert the last change (or group), return the changed tasks
+
+    The result is a list of (task, action) with action 'add', 'delete' or
+    'change'. Deleted tasks come back as new Task instances.
+    """
+    return _deltas_apply(HISTORY.undo_pop())
+
+
+def history_redo():
+    """ Apply again the last undone change, same result as history_undo() """
+    return _deltas_apply(HISTORY.redo_pop())
+
+
+# date buckets used to group tasks by creation date (in display order)
+DATE_BUCKETS = ('Today', 'Yesterday', 'This week', 'This month', 'This year',
+                'Older', 'No date')
+
+
+def date_bucket(date, today=None):
+    """ Index in DATE_BUCKETS of the given date """
+    if date is None:
+        return 6
+    today = today or datetime.date.today()
+    days = (today - date.date()).days
+    if days <= 0:
+        return 0
+    if days == 1:
+        return 1
+    if days <= today.weekday():
+        return 2
+    if date.year == today.year:
+        return 3 if date.month == today.month else 4
+    return 5
+
+
+def group_keys(task, group_by, today=None):
+    """ The groups the given task belong to
+
+    For 'prj' and 'ctx' a task is in every group of its tags, tasks without
+    tags go in the '+' (or '@') group. For 'pri' the key is the priority
+    letter ('' for no priority). For 'date' the key is the DATE_BUCKETS
+    index of the creation date.
+    """
+    if group_by == 'prj':
+        return task.projects or ['+']
+    if group_by == 'ctx':
+        return task.contexts or ['@']
+    if group_by == 'pri':
+        return [task.priority or '']
+    if group_by == 'date':
+        return [date_bucket(task.creation_date, today)]
+    return []
+
+
+def _group_sort_key(key):
+    # tags first (alphabetically), the "without tags" group at the end
+    if key in ('+', '@', ''):
+        return (1, key)
+    return (0, key)
+
+
+def group_tasks(tasks, group_by):
+    """ Group the (ordered) tasks in a single pass
+
+    Return the ordered list of (group_key, tasks) for all the non empty
+    groups, tasks keep their order inside each group.
+    """
+    today = datetime.date.today()
+    groups = {}  # key: group_key  val: list of tasks
+    for t in tasks:
+        for key in group_keys(t, group_by, today):
+            if key in groups:
+                groups[key].append(t)
+            else:
+                groups[key] = [t]
+
+    return [ (key, groups[key]) for key in sorted(groups, key=_group_sort_key) ]
+
+
+def due_range(due_view, today=None):
+    """ Start and end dates (end excluded) of the given due view
+
+    due_view can be: 'overdue', 'today' or 'week' (from today to sunday)
+    """
+    today = today or datetime.date.today()
+    if due_view == 'overdue':
+        return None, today
+    if due_view == 'today':
+        return today, today + datetime.timedelta(days=1)
+    if due_view == 'week':
+        return today, today + datetime.timedelta(days=7 - today.weekday())
+    return None, None
+
+
+def due_tasks(due_view, today=None):
+    """ The tasks in the given due view, using the DUE index """
+    tasks = DUE.range(*due_range(due_view, today))
+    if due_view == 'overdue':
+        tasks = [ t for t in tasks if not t.completed ]
+    return tasks
+
+
+def not_started_tasks(today=None):
+    """ The tasks with a threshold date in the future """
+    today = today or datetime.date.today()
+    return THRESHOLD.range(today + datetime.timedelta(days=1), None)
+
+
+def dates_next_change(today=None):
+    """ The first date, after today, when the due views will change """
+    today = today or datetime.date.today()
+    tomorrow = today + datetime.timedelta(days=1)
+    dates = []
+
+    # tasks due today will be overdue tomorrow
+    if DUE.range(today, tomorrow):
+        dates.append(tomorrow)
+
+    # the next due date will enter the week view and then the today view
+    due = DUE.first_after(today)
+    if due is not None:
+        dates.append(due)
+        dates.append(due - datetime.timedelta(days=due.weekday()))
+
+    # the next task to start
+    start = THRESHOLD.first_after(today)
+    if start is not None:
+        dates.append(start)
+
+    dates = [ d for d in dates if d > today ]
+    return min(dates) if dates else None
+
+
+class _Source(object):
+    """ The loaded file, memory mapped, to copy back the unchanged lines """
+
+    def __init__(self, path):
+        self.path = path
+        self.stat = os.stat(path)
+        self.map = None
+        self.bom = False
+        self._digest = None
+        if self.stat.st_size > 0:
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.bom = self.map[:3] == codecs.BOM_UTF8
+
+    def prefetch(self):
+        """ Ask the kernel to start reading the whole file in background """
+        if self.map is not None and hasattr(mmap, 'MADV_WILLNEED'):
+            try:
+                self.map.madvise(mmap.MADV_WILLNEED)
+            except OSError:
+                pass
+
+    def digest(self):
+        """ Hash of the content (computed at the first call) """
+        if self._digest is None:
+            self._digest = hashlib.blake2b(self.map or b'').digest()
+        return self._digest
+
+    def valid(self, path):
+        """ True if path is still the mapped file, not changed by others """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return self.map is not None and path == self.path and \
+               (st.st_ino, st.st_size, st.st_mtime_ns) == \
+               (self.stat.st_ino, self.stat.st_size, self.stat.st_mtime_ns)
+
+    def lines(self, errors):
+        """ Iterate (raw_text, span) for each line, decoded as utf-8
+
+        span is the (start, end) of the stripped line in the file, or None
+        if the decoded text need a different strip.
+        """
+        mm = self.map
+        if mm is None:
+            return
+        mm.seek(3 if self.bom else 0)
+        readline = mm.readline
+        while True:
+            start = mm.tell()
+            line = readline()
+            if not line:
+                break
+            stripped = line.strip()
+            text = stripped.decode('utf-8', errors)
+            raw = text.strip()
+            if len(raw) == len(text):
+                start += len(line) - len(line.lstrip())
+                yield raw, (start, start + len(stripped))
+            else:
+                yield raw, None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def tasks_read(path, errors='replace'):
+    """ Iterate the tasks of the given file, without adding them to TASKS """
+    source = _Source(path)
+    try:
+        for raw, span in source.lines(errors):
+            if raw:
+                yield Task(raw, path)
+    finally:
+        source.close()
+
+
+def _file_parse(source, errors):
+    # runs in the loader threads: only create the tasks, do not index them
+    # (the hash is taken now, the mapped file can be changed by others)
+    source.digest()
+    tasks = []
+    for raw, span in source.lines(errors):
+        t = Task(raw, source.path)
+        t._span = span
+        tasks.append(t)
+    return tasks
+
+
+def load_from_files(paths, errors='replace'):
+    """ Load the tasks from all the given todo.txt files, in a single view
+
+    Files are memory mapped and decoded line by line as utf-8, using the
+    given error policy for invalid bytes ('strict', 'replace', ...). Every
+    file is parsed in its own thread, the tasks are then added to TASKS in
+    files order. The first file is the main one: new tasks are added there.
+    """
+    for path in paths:
+        print('Loading tasks from file: "%s"' % path)
+
+    model_reset(paths, errors)
+
+    # all the files are read ahead at once, the parsing (that needs the GIL)
+    # then overlap with the reading of the other files
+    for path in paths:
+        _sources[path] = _Source(path)
+        _sources[path].prefetch()
+    if len(paths) > 1:
+        with ThreadPoolExecutor(len(paths)) as pool:
+            parsed = list(pool.map(_file_parse, _sources.values(),
+                                   [errors] * len(paths)))
+    else:
+        parsed = [ _file_parse(s, errors) for s in _sources.values() ]
+
+    for path, tasks in zip(paths, parsed):
+        _bases[path] = [ t._raw_txt for t in tasks ]
+        model_fill(tasks)
+
+
+def model_reset(paths, errors='replace'):
+    """ Forget all the tasks (and the history), to load the given files """
+    global _notes_path, _errors
+
+    _notes_path = _notes_dir(paths[0]) if paths else None
+    _notes_trash.clear()
+    _dirty.clear()
+    HISTORY.clear()
+    for t in TASKS:
+        t._indexed = False
+    TASKS.clear()
+    for index in INDEXES:
+        index.clear()
+
+    for source in _sources.values():
+        source.close()
+    _sources.clear()
+    _bases.clear()
+    del _merges[:]
+    _files[:] = paths
+    _errors = errors
+
+
+def model_fill(tasks):
+    """ Add the loaded tasks to TASKS, without recording any change """
+    for t in tasks:
+        TASKS.append(t)
+        _index_add(t)
+
+
+def mark_saved(paths=None):
+    """ The given files (all if None) have been saved by a storage
+
+    Forget their unsaved changes and remove the notes of their deleted
+    tasks (if not used by another task).
+    """
+    if paths is None:
+        paths = list(_files)
+        _dirty.clear()
+    else:
+        _dirty.difference_update(paths)
+
+    used = set(t._note for t in TASKS)
+    for path in paths:
+        notes_path = os.path.join(_notes_dir(path), '')
+        trash = set(n for n in _notes_trash if n.startswith(notes_path))
+        for note in trash - used:
+            if os.path.exists(note):
+                os.remove(note)
+        _notes_trash.difference_update(trash)
+
+
+def load_from_file(path, errors='replace'):
+    """ Load the tasks from the given todo.txt file (see load_from_files) """
+    load_from_files([path], errors)
+
+
+class FileLock(object):
+    """ Exclusive advisory lock (flock) of a file, as a context manager
+
+    The lock is taken on a hidden sidecar file (.todo.txt.lock), so it
+    still holds when the file is replaced by a new one. Only other programs
+    using the same lock are kept out, after timeout seconds the lock is
+    given up (with a warning).
+    """
+
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return self
+        head, tail = os.path.split(self.path)
+        lock_path = os.path.join(head, '.%s.lock' % tail)
+        self.fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return self
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    print('WARNING: File locked by another program, saving '
+                          'anyway: "%s"' % self.path)
+                    return self
+                time.sleep(0.05)
+
+    def __exit__(self, *args):
+        if self.fd is not None:
+            os.close(self.fd)  # also release the lock
+            self.fd = None
+
+
+def _task_insert(pos, task):
+    TASKS.insert(pos, task)
+    _index_add(task)
+    _history_record(task, None, task._raw_txt)
+    _dirty.add(task._file)
+
+
+def _disk_merge(path, disk, base):
+    """ Merge the changes made by others to the file (disk is the new one)
+
+    Lines changed only on disk are applied to their tasks, as a single undo
+    step (untouched tasks are not parsed again). Lines changed on both sides
+    are conflicts: the local ones are kept and the ones on disk added after
+    them. Return the conflicts, as a list of (local lines, disk lines).
+    """
+    tasks = [ t for t in TASKS if t._file == path ]
+    local = [ t._raw_txt for t in tasks ]
+    other = [ raw for raw, _ in disk.lines(_errors) ]
+    chunks = merge3(base, local, other)
+    conflicts = []
+    with HISTORY.group():
+        # from the end, so the tasks positions before are still valid
+        for kind, (i1, i2), (j1, j2), (k1, k2) in reversed(chunks):
+            if kind == 'other':
+                news = other[k1 + j2 - j1:k2]
+            elif kind == 'conflict':
+                news = [ l for l in other[k1:k2] if l not in local[j1:j2] ]
+                # lines added at the same place on both sides are not a
+                # real conflict, all of them are kept
+                if i1 != i2:
+                    conflicts.append((local[j1:j2], other[k1:k2]))
+            else:
+                continue
+            if j2 < len(tasks):
+                pos = TASKS.index(tasks[j2])
+            else:
+                pos = TASKS.index(tasks[-1]) + 1 if tasks else len(TASKS)
+            for raw in reversed(news):
+                _task_insert(pos, Task(raw, path))
+            if kind == 'other':
+                for t, raw in zip(tasks[j1:j2], other[k1:k2]):
+                    t.raw_txt = raw
+                for t in tasks[j1 + k2 - k1:j2]:
+                    t.delete()
+    conflicts.reverse()
+    return conflicts
+
+
+def merge_from_file(path, base):
+    """ Merge the changes made by others to the (loaded) file
+
+    base are the lines of the file as last loaded (or written) by the
+    storage. The merge is reported by merges_pop(), as for save_to_file().
+    """
+    print('Merging changes made by others: "%s"' % path)
+    disk = _Source(path)
+    try:
+        _merges.append((path, _disk_merge(path, disk, base)))
+    finally:
+        disk.close()
+
+
+def merges_pop():
+    """ The files merged with changes made by others, since the last call
+
+    Return a list of (path, conflicts), see _disk_merge.
+    """
+    merges = list(_merges)
+    del _merges[:]
+    return merges
 
 
 def save_to_file(path):
-    global _need_save
+    """ Save the tasks of the given (loaded) file
 
+    The file is locked while saving. If it was changed by others since it
+    was loaded (or saved) their changes are merged first (see merges_pop).
+    The unchanged lines are copied from the loaded file.
+    """
     print('Saving tasks to file: "%s"' % path)
+    with FileLock(path):
+        _save_locked(path)
+
+
+def _save_locked(path):
+    old = _sources.get(path)
+    bom = old is not None and old.bom
+    if old is not None and not old.valid(path) and os.path.exists(path):
+        disk = _Source(path)
+        try:
+            if disk.digest() != old.digest():
+                print('Merging changes made by others: "%s"' % path)
+                _merges.append((path, _disk_merge(path, disk,
+                                                  _bases.get(path, []))))
+            bom = disk.bom
+        finally:
+            disk.close()
+
+    source = old if old is not None and old.valid(path) else None
+    chunks = []
+    spans = []
+    tasks = [ t for t in TASKS if t._file == path ]
+    pos = 0
+    if bom:
+        chunks.append(codecs.BOM_UTF8)
+        pos = 3
+    for t in tasks:
+        if source is not None and t._span is not None:
+            line = source.map[t._span[0]:t._span[1]]
+        else:
+            line = t._raw_txt.encode('utf-8', _errors)
+        chunks.append(line)
+        chunks.append(b'\n')
+        spans.append((pos, pos + len(line)))
+        pos += len(line) + 1
+
+    # the map must be closed before truncating the file
+    if old is not None:
+        old.close()
+    with open(path, 'wb') as f:
+        f.writelines(chunks)
+    del chunks
+
+    _sources[path] = _Source(path)
+    _sources[path].digest()
+    _bases[path] = [ t._raw_txt for t in tasks ]
+    for t, span in zip(tasks, spans):
+        t._span = span
+    mark_saved([path])
+
+
+def save_to_files():
+    """ Save only the loaded files with unsaved changes, return their paths """
+    saved = [ path for path in _files if path in _dirty ]
+    for path in saved:
+        save_to_file(path)
+    _dirty.clear()
+    return saved
+
+
+class TextStorage(object):
+    """ The default storage: the todo.txt files themselves
+
+    A storage loads the files in TASKS and saves the changes, storages able
+    to run the gui filters themselves (see sqlstore.SqliteStorage) also
+    implement filtered().
+    """
+    queries = False  # True if filtered() is implemented
+
+    def load(self, paths, errors='replace'):
+        load_from_files(paths, errors)
 
-    with open(path, 'w') as f:
-        for t in TASKS:
-            print(t.raw_txt, file=f)
-    _need_save = False
+    def save(self):
+        """ Save the changes, return the paths of the saved files """
+        return save_to_files()
 
+    def close(self):
+        pass
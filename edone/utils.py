@@ -26,6 +26,7 @@ from xdg.BaseDirectory import xdg_config_home, xdg_cache_home
 script_path = os.path.dirname(__file__)
 config_path = os.path.join(xdg_config_home, 'edone')
 config_file = os.path.join(config_path, 'config.pickle')
+cache_path = os.path.join(xdg_cache_home, 'edone')
 
 
 class Options(object):
@@ -34,10 +35,24 @@ class Options(object):
         self.theme_name = 'default'
         self.horiz_layout = False
         self.txt_file = os.path.join(config_path, 'Todo.txt')
-        self.group_by = 'none' # or 'prj' or 'ctx'
+        self.other_files = [] # more todo.txt files in the view (ex: done.txt)
+        self.encoding_errors = 'replace' # for invalid utf-8 in txt_file
+        self.group_by = 'none' # or 'prj', 'ctx', 'pri' or 'date'
+        self.tree_groups = False # collapsible groups, children created on expand
+        self.expanded_groups = {} # key: group_by  data: set of expanded groups
+        self.expanded_tags = set() # expanded +project.sub and @context.sub
         self.sort_by = 'pri' # or 'none'
         self.view = 'all' # or 'todo' or 'done'
+        self.due_view = 'all' # or 'overdue', 'today' or 'week'
+        self.hide_future = False # hide tasks with threshold date in the future
+        self.columnar_store = False # filter and sort using numpy (if available)
+        self.storage = 'txt' # or 'sqlite' (txt files become mirrors of the db)
+        self.sqlite_file = os.path.join(config_path, 'edone.db')
+        self.sync_url = '' # line level sync server (see sync.py), '' = no sync
+        self.sync_interval = 5 # minutes between automatic syncs (0 = never)
         self.tag_colors = {} # key: tag_name  data: color_tuple
+        self.saved_views = [] # list of dicts (see views.SavedView)
+        self.undo_budget = 1024 * 1024 # max bytes used by the undo history
         self.def_prj_color = (0, 0, 255, 255)
         self.def_ctx_color = (255, 0, 0, 255)
 
@@ -65,7 +80,13 @@ def theme_resource_get(fname):
 
 
 def tag_color_get(tag, hex=False):
-    color = options.tag_colors.get(tag, options.def_prj_color if tag[0] == '+' \
-                                        else options.def_ctx_color)
+    # subtags without a color of their own use the one of the parent
+    color = options.tag_colors.get(tag)
+    while color is None and tag.rfind('.') > 1:
+        tag = tag[:tag.rfind('.')]
+        color = options.tag_colors.get(tag)
+    if color is None:
+        color = options.def_prj_color if tag[0] == '+' \
+                else options.def_ctx_color
     return ('#%02x%02x%02x%02x' % color) if hex else color
     
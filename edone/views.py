@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015-2018 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Edone.
+#
+# Edone is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Edone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Edone.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+from edone.tasks import TASKS, TagsFilter, due_range, \
+                        index_register, index_unregister
+from edone import query
+
+
+class SavedView(object):
+    """ A named filters combination with its materialized result
+
+    The view is an index (see tasks.INDEXES) so the set of matching tasks
+    is updated on every task change and switching to the view does not need
+    to look at all the tasks. Settings are stored in options.saved_views as
+    a dict with keys: name, view, due_view, projects, contexts, query,
+    sort_by and group_by.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.members = set()  # the tasks matching the view
+        self.facets = {}      # key: '+' or '@'  val: tasks matching the view
+                              # without its projects (or contexts) filter
+        self._day = None      # day of the last full materialization
+        self._match = None
+        self._facets = {}     # key: '+' or '@'  val: match without those tags
+        self._compile()
+        self.clear()
+        index_register(self)
+
+    @property
+    def name(self):
+        return self.settings['name']
+
+    def delete(self):
+        index_unregister(self)
+
+    def materialize(self):
+        """ Compile the filters again and recompute all the members """
+        self._compile()
+        self.clear()
+        for t in TASKS:
+            self.add(t)
+
+    def _compile(self):
+        today = datetime.date.today()
+        st = self.settings
+        view, due_view = st['view'], st['due_view']
+        due_start, due_end = due_range(due_view, today)
+        prj = TagsFilter(st['projects']).match if st['projects'] else None
+        ctx = TagsFilter(st['contexts']).match if st['contexts'] else None
+        try:
+            q = query.compile(st['query']) if st['query'].strip() else None
+        except query.QueryError:
+            q = query.Query(st['query'], query.Text(st['query']))
+
+        def matcher(prj, ctx):
+            def match(t):
+                if (view == 'done' and not t.completed) or \
+                   (view == 'todo' and t.completed):
+                    return False
+                if due_view != 'all':
+                    if t.due is None or \
+                       (due_start is not None and t.due.date() < due_start) or \
+                       (due_end is not None and t.due.date() >= due_end) or \
+                       (due_view == 'overdue' and t.completed):
+                        return False
+                return (prj is None or prj(t)) and (ctx is None or ctx(t)) \
+                       and (q is None or q.match(t))
+            return match
+
+        self._match = matcher(prj, ctx)
+        self._facets = {}
+        if prj is not None:
+            self._facets['+'] = matcher(None, ctx)
+        if ctx is not None:
+            self._facets['@'] = matcher(prj, None)
+        self._day = today
+
+    def tasks(self, facet=None):
+        """ The members, re-materialized once a day (for relative dates)
+
+        With facet '+' (or '@') the tasks matching all the filters of the
+        view but the projects (or the contexts) one, for the side lists.
+        """
+        if self._day != datetime.date.today():
+            self.materialize()
+        return self.facets.get(facet, self.members)
+
+    # index interface
+    def clear(self):
+        self.members = set()
+        self.facets = dict((facet, set()) for facet in self._facets)
+
+    def add(self, task):
+        if self._match(task):
+            self.members.add(task)
+        for facet, match in self._facets.items():
+            if match(task):
+                self.facets[facet].add(task)
+
+    def remove(self, task):
+        self.members.discard(task)
+        for tasks in self.facets.values():
+            tasks.discard(task)
+
+
+def current_settings(name, view, due_view, projects, contexts, search,
+                     sort_by, group_by):
+    return {
+        'name': name, 'view': view, 'due_view': due_view,
+        'projects': sorted(projects or ()), 'contexts': sorted(contexts or ()),
+        'query': search, 'sort_by': sort_by, 'group_by': group_by,
+    }
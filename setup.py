@@ -35,6 +35,9 @@ setup(
     author_email = 'dave@gurumeditation.it',
     packages = ['edone'],
     requires = ['efl (>=1.18)', 'xdg'],
+    extras_require = {
+        'columnar': ['numpy'],  # the columnar store (see edone/columns.py)
+    },
     provides = ['edone'],
     scripts = ['bin/edone'],
     package_data = {